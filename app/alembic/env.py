@@ -6,6 +6,9 @@ from sqlalchemy import pool
 from alembic import context
 
 from app.models.servers import Server # noqa
+from app.models.notifications import HubNotification # noqa
+from app.models.events import ServerEvent # noqa
+from app.models.logs import LogPosting # noqa
 from app.core.config import settings
 
 # this is the Alembic Config object, which provides
@@ -0,0 +1,36 @@
+"""Add failure reason
+
+Revision ID: 8c1f4e2a9b37
+Revises: 5dafb37c0cbb
+Create Date: 2026-10-18 10:12:41.218733
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8c1f4e2a9b37'
+down_revision: Union[str, None] = '5dafb37c0cbb'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+failure_reason_enum = sa.Enum('exited', 'timed_out',
+                              name='serverfailurereasonenum')
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    failure_reason_enum.create(op.get_bind(), checkfirst=True)
+    op.add_column('server', sa.Column('failure_reason', failure_reason_enum,
+                                      nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('server') as batch_op:
+        batch_op.drop_column('failure_reason')
+    failure_reason_enum.drop(op.get_bind(), checkfirst=True)
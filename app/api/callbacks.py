@@ -1,22 +1,50 @@
 from fastapi import APIRouter
 from pydantic import BaseModel
-from app.models.servers import ServerStateEnum
+from app.models.notifications import (
+        HubNotificationBody,
+        HubNotificationBatchBody
+        )
 
 
 class ServerStartedRecieved(BaseModel):
     ok: bool
 
 
-class ServerStarted(BaseModel):
-    state: ServerStateEnum
-
-
+# Every notification is sent with an Idempotency-Key header, the same key
+# is used for every retry of a notification
 server_callback_router = APIRouter()
 
 
+# Sent for failed starts too, with event "failed" and state "failed"
 @server_callback_router.post(
     "{$callback_url}/hubs/{$request.body.hub_id}/games/{$request.bod.game_id}/started",
     response_model=ServerStartedRecieved
 )
-def server_started_notification(body: ServerStarted):
+def server_started_notification(body: HubNotificationBody):
+    pass
+
+
+@server_callback_router.post(
+    "{$callback_url}/hubs/{$request.body.hub_id}/games/{$request.bod.game_id}/stopped",
+    response_model=ServerStartedRecieved
+)
+def server_stopped_notification(body: HubNotificationBody):
+    pass
+
+
+@server_callback_router.post(
+    "{$callback_url}/hubs/{$request.body.hub_id}/games/{$request.bod.game_id}/crashed",
+    response_model=ServerStartedRecieved
+)
+def server_crashed_notification(body: HubNotificationBody):
+    pass
+
+
+# Used when several notifications for the same hub are due at once, hubs
+# that answer 404/405 get the notifications one by one instead
+@server_callback_router.post(
+    "{$callback_url}/hubs/{$request.body.hub_id}/games/events",
+    response_model=ServerStartedRecieved
+)
+def server_batch_notification(body: HubNotificationBatchBody):
     pass
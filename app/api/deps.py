@@ -1,6 +1,16 @@
 from typing import Annotated
 from fastapi import Depends
 from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 from app.db import session_handler
+from app.utils.controller import (
+        LocalController,
+        RemoteController,
+        get_controller
+        )
 
 SessionDep = Annotated[Session, Depends(session_handler.get_session)]
+AsyncSessionDep = Annotated[AsyncSession,
+                            Depends(session_handler.get_async_session)]
+ControllerDep = Annotated[LocalController | RemoteController,
+                          Depends(get_controller)]
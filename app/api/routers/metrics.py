@@ -0,0 +1,34 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import PlainTextResponse
+from app.api.deps import ControllerDep
+from app.core.config import settings
+from app.models.metrics import MetricFamily, MetricSample
+from app.utils.metrics import merge_families, registry, render
+
+router = APIRouter(tags=["metrics"])
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def read_metrics(controller: ControllerDep):
+    """
+    The metrics of the node in the Prometheus text format. In remote mode
+    the supervisor has the server metrics and this worker the request
+    ones, both are merged.
+    """
+    families = registry.collect()
+    if settings.SUPERVISOR_MODE == "remote":
+        try:
+            supervisor_families = await controller.read_metrics()
+            up = 1
+        except HTTPException:
+            supervisor_families = []
+            up = 0
+        name = "archipelago_supervisor_up"
+        families = merge_families(families, supervisor_families) + [
+            MetricFamily(name=name, type="gauge",
+                         help="Whether the supervisor answered the scrape",
+                         samples=[MetricSample(name=name, labels={},
+                                               value=up)])
+            ]
+    return PlainTextResponse(render(families),
+                             media_type="text/plain; version=0.0.4")
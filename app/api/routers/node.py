@@ -0,0 +1,21 @@
+from fastapi import APIRouter
+from app.api.deps import ControllerDep
+from app.models.servers import NodeCapacity, NodeResources
+
+router = APIRouter(prefix="/node", tags=["node"])
+
+
+@router.get("/resources", response_model=NodeResources)
+async def read_node_resources(controller: ControllerDep):
+    """
+    What the machine has, and what the server processes on it use
+    """
+    return await controller.read_node_resources()
+
+
+@router.get("/capacity", response_model=NodeCapacity)
+async def read_capacity(controller: ControllerDep):
+    """
+    How many more servers fit on the node, for the hub to place games
+    """
+    return await controller.read_capacity()
@@ -1,27 +1,53 @@
-import httpx
-from pathlib import Path
-from pydantic import HttpUrl, BaseModel
+import asyncio
+from datetime import datetime
+from pydantic import HttpUrl, BaseModel, Field
 from typing import Annotated, List
 from fastapi import (
         APIRouter,
+        Header,
         Query,
         HTTPException,
         BackgroundTasks,
-        UploadFile
+        Response,
+        UploadFile,
+        WebSocket,
+        WebSocketDisconnect
         )
 from sqlmodel import select
-from app.api.deps import SessionDep
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.api.deps import AsyncSessionDep, ControllerDep
+from app.core.config import settings
 from app.models.servers import (
         Server,
         ServerPublic,
-        ServerCreateInternal,
+        ServerDetail,
+        ServerListItem,
+        ServerListField,
         ServerStateEnum,
-        ServerWrongStateException,
-        ServerNotInitializedException
+        ServerOutput,
+        ServerChanges,
+        ServerLogs,
+        CommandResult,
+        BulkStartServer,
+        BulkServerResult
         )
+from fastapi.responses import StreamingResponse
 from app.api.callbacks import server_callback_router
-from app.utils.asyncserver import AsyncServer, ProcessNotRunningException
-from app.utils.server_utils import server_manager, port_handler
+from app.models.logs import LogSearchResult
+from app.models.events import (
+        ServerEvent,
+        ServerEventPublic,
+        ServerEventKindEnum
+        )
+from app.utils.files import (
+        game_file_path,
+        remove_file,
+        stream_upload_to_temp,
+        FileTooLargeException
+        )
+from app.utils.blob_store import blob_store
+from app.utils.log_store import unix_time
+from app.utils.output_stream import OutputViewer
 
 router = APIRouter(prefix="/servers", tags=["server"])
 
@@ -33,159 +59,415 @@ class StartServerCBInfo(BaseModel):
 
 
 class SendCmdBody(BaseModel):
+    # Several commands are queued back to back
+    cmd: str | Annotated[List[str], Field(min_length=1, max_length=100)]
+    # Wait for the output every command is answered with
+    wait: bool = False
+    quiet_period: Annotated[float, Field(gt=0)] | None = None
+    timeout: Annotated[float, Field(
+        gt=0, le=settings.SERVER_CMD_MAX_TIMEOUT)] | None = None
+
+
+class BulkStartBody(BaseModel):
+    hub_id: int
+    callback_url: HttpUrl
+    servers: Annotated[List[BulkStartServer], Field(max_length=100)]
+
+
+class BulkServerIdsBody(BaseModel):
+    server_ids: Annotated[List[int], Field(max_length=100)]
+
+
+class BulkSendCmdBody(BulkServerIdsBody):
     cmd: str
 
 
 @router.post("/", response_model=ServerPublic)
-def create_server(session: SessionDep):
-    port = port_handler.get_new_port()
-    db_server = Server.model_validate(ServerCreateInternal(
-        address="localhost",
-        port=port
-        ))
-    session.add(db_server)
-    session.commit()
-    session.refresh(db_server)
-    sm = AsyncServer(db_server.id, db_server.port)
-    server_manager.servers[db_server.id] = sm
-    return db_server
+async def create_server(controller: ControllerDep):
+    return (await controller.create_servers(1))[0]
+
+
+@router.post("/bulk", response_model=List[ServerPublic])
+async def create_servers(controller: ControllerDep,
+                         count: Annotated[int, Query(ge=1, le=100)] = 1):
+    return await controller.create_servers(count)
+
+
+# Declared before the /{server_id} routes, which would match "bulk"
+@router.post("/bulk/start", response_model=List[BulkServerResult],
+             callbacks=server_callback_router.routes)
+async def bulk_start_servers(body: BulkStartBody, controller: ControllerDep):
+    """
+    Starts the servers, at most SERVER_BULK_PARALLELISM at a time, and
+    returns once every server is running or has failed to start
+    """
+    return await controller.bulk_start(body.hub_id, str(body.callback_url),
+                                       body.servers)
+
+
+@router.post("/bulk/stop", response_model=List[BulkServerResult])
+async def bulk_stop_servers(body: BulkServerIdsBody,
+                            controller: ControllerDep):
+    return await controller.bulk_stop(body.server_ids)
+
+
+@router.post("/bulk/send_cmd", response_model=List[BulkServerResult])
+async def bulk_send_cmd_to_servers(body: BulkSendCmdBody,
+                                   controller: ControllerDep):
+    return await controller.bulk_send_cmd(body.server_ids, body.cmd)
+
+
+@router.get("/changes", response_model=ServerChanges)
+async def read_server_changes(
+        controller: ControllerDep,
+        since: Annotated[int, Query(ge=0)] = 0,
+        epoch: str | None = None,
+        timeout: Annotated[float, Query(
+            ge=0, le=settings.SERVER_CHANGES_MAX_WAIT)] = 30
+        ):
+    """
+    Returns the state transitions after version since, waiting up to
+    timeout seconds for one if there are none yet. Pass the returned
+    version and epoch with the next request. If reset is set the changes
+    since that version are gone and the servers have to be reread.
+    """
+    return await controller.wait_for_changes(since, epoch, timeout)
+
+
+@router.websocket("/changes/ws")
+async def watch_server_changes(websocket: WebSocket,
+                               controller: ControllerDep,
+                               since: int = 0,
+                               epoch: str | None = None):
+    """
+    Sends every batch of state transitions after version since as a
+    ServerChanges message, like repeated long polls
+    """
+    await websocket.accept()
+
+    async def wait_for_disconnect():
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+    disconnected = asyncio.create_task(wait_for_disconnect())
+    try:
+        while True:
+            poll = asyncio.create_task(controller.wait_for_changes(
+                since, epoch, settings.SERVER_CHANGES_MAX_WAIT
+                ))
+            await asyncio.wait([poll, disconnected],
+                               return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                poll.cancel()
+                break
+            changes = poll.result()
+            if changes.changes or changes.reset:
+                await websocket.send_text(changes.model_dump_json())
+            since, epoch = changes.version, changes.epoch
+    except WebSocketDisconnect:
+        pass
+    except HTTPException as e:
+        await websocket.close(code=1011, reason=str(e.detail))
+    finally:
+        disconnected.cancel()
+
+
+async def read_events_page(session: AsyncSession, response: Response,
+                           server_ids: List[int] | None,
+                           kind: List[ServerEventKindEnum] | None,
+                           player: str | None, after: int | None,
+                           since: datetime | None, until: datetime | None,
+                           limit: int) -> List[ServerEvent]:
+    statement = select(ServerEvent)
+    if server_ids:
+        statement = statement.where(ServerEvent.server_id.in_(server_ids))
+    if kind:
+        statement = statement.where(ServerEvent.kind.in_(kind))
+    if player is not None:
+        statement = statement.where(ServerEvent.player == player)
+    if after is not None:
+        statement = statement.where(ServerEvent.id > after)
+    if since is not None:
+        statement = statement.where(ServerEvent.at >= since)
+    if until is not None:
+        statement = statement.where(ServerEvent.at < until)
+    statement = statement.order_by(ServerEvent.id).limit(limit)
+    events = (await session.exec(statement)).all()
+    if len(events) == limit:
+        response.headers["X-Next-After"] = str(events[-1].id)
+    return events
+
+
+@router.get("/events", response_model=List[ServerEventPublic])
+async def read_events(session: AsyncSessionDep,
+                      response: Response,
+                      server_id: Annotated[List[int] | None, Query()] = None,
+                      kind: Annotated[List[ServerEventKindEnum] | None,
+                                      Query()] = None,
+                      player: str | None = None,
+                      after: int | None = None,
+                      since: datetime | None = None,
+                      until: datetime | None = None,
+                      limit: Annotated[int, Query(ge=1, le=1000)] = 100
+                      ):
+    """
+    Lists the events read from the output of the servers on this node,
+    ordered by id. Pass the id of the last event as after to get the next
+    page, the X-Next-After header holds it while there are more.
+    """
+    return await read_events_page(session, response, server_id, kind,
+                                  player, after, since, until, limit)
+
+
+@router.get("/logs/search", response_model=LogSearchResult)
+async def search_logs(controller: ControllerDep,
+                      q: Annotated[str, Query(min_length=1, max_length=200)],
+                      server_id: Annotated[List[int] | None, Query()] = None,
+                      since: datetime | None = None,
+                      until: datetime | None = None,
+                      limit: Annotated[int, Query(ge=1, le=1000)] = 100
+                      ):
+    """
+    Searches the stored output of the servers on this node for lines with
+    every word of q, oldest first. Continue after a truncated result with
+    the time of its last hit as since.
+    """
+    return await controller.search_logs(q, server_id, unix_time(since),
+                                        unix_time(until), limit)
+
+
+@router.websocket("/output/ws")
+async def watch_servers_output(websocket: WebSocket,
+                               controller: ControllerDep,
+                               server_id: Annotated[List[int], Query()] = [],
+                               since: int | None = None):
+    """
+    Streams the output of the servers in server_id, and of servers
+    subscribed to later with {"action": "subscribe", "server_id": ...,
+    "since": ...} messages, as ServerOutputBatch messages
+    """
+    await websocket.accept()
+    viewer = OutputViewer(controller)
+    for subscribed_id in server_id:
+        try:
+            await viewer.subscribe(subscribed_id, since)
+        except HTTPException as e:
+            viewer.put({"server_id": subscribed_id,
+                        "status_code": e.status_code,
+                        "detail": e.detail})
+    await viewer.serve_websocket(websocket)
 
 
 @router.delete("/{server_id}")
-def delete_server(server_id: int, session: SessionDep):
-    server = session.get(Server, server_id)
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-    session.delete(server)
-    session.commit()
+async def delete_server(server_id: int, controller: ControllerDep):
+    await controller.delete_server(server_id)
     return {"ok": True}
 
 
-@router.get("/", response_model=List[ServerPublic])
-def read_servers(session: SessionDep,
-                 offset: int = 0,
-                 limit: Annotated[int, Query(le=100)] = 25
-                 ):
-    servers = session.exec(select(Server).offset(offset).limit(limit)).all()
+@router.get("/", response_model=List[ServerListItem],
+            response_model_exclude_unset=True)
+async def read_servers(session: AsyncSessionDep,
+                       response: Response,
+                       after: int | None = None,
+                       limit: Annotated[int, Query(ge=1, le=1000)] = 25,
+                       state: Annotated[List[ServerStateEnum] | None,
+                                        Query()] = None,
+                       initialized: bool | None = None,
+                       port_min: int | None = None,
+                       port_max: int | None = None,
+                       fields: Annotated[List[ServerListField] | None,
+                                         Query()] = None,
+                       offset: Annotated[int, Query(deprecated=True)] = 0
+                       ):
+    """
+    Lists servers ordered by id. Pass the id of the last server as after to
+    get the next page, the X-Next-After header holds it while there are
+    more. fields narrows every server down to the given fields.
+    """
+    if fields:
+        columns = [Server.id] + [getattr(Server, field)
+                                 for field in dict.fromkeys(fields)]
+        statement = select(*columns)
+    else:
+        statement = select(Server)
+    if after is not None:
+        statement = statement.where(Server.id > after)
+    if state:
+        statement = statement.where(Server.state.in_(state))
+    if initialized is not None:
+        statement = statement.where(Server.initialized == initialized)
+    if port_min is not None:
+        statement = statement.where(Server.port >= port_min)
+    if port_max is not None:
+        statement = statement.where(Server.port <= port_max)
+    statement = statement.order_by(Server.id).offset(offset).limit(limit)
+    result = await session.exec(statement)
+    if fields:
+        servers = [dict(row._mapping) for row in result.all()]
+    else:
+        servers = [ServerPublic.model_validate(server).model_dump()
+                   for server in result.all()]
+    if len(servers) == limit:
+        response.headers["X-Next-After"] = str(servers[-1]["id"])
     return servers
 
 
-@router.get("/{server_id}", response_model=ServerPublic)
-def read_server(server_id: int, session: SessionDep):
-    server = session.get(Server, server_id)
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-    return server
+@router.get("/{server_id}", response_model=ServerDetail)
+async def read_server(server_id: int, controller: ControllerDep):
+    """
+    The server, with what its process currently uses and a short history
+    """
+    server = await controller.get_server(server_id)
+    resources = await controller.read_resources(server_id)
+    return ServerDetail.model_validate(server,
+                                       update={"resources": resources})
+
+
+@router.get("/{server_id}/events", response_model=List[ServerEventPublic])
+async def read_server_events(server_id: int,
+                             session: AsyncSessionDep,
+                             response: Response,
+                             controller: ControllerDep,
+                             kind: Annotated[List[ServerEventKindEnum] | None,
+                                             Query()] = None,
+                             player: str | None = None,
+                             after: int | None = None,
+                             since: datetime | None = None,
+                             until: datetime | None = None,
+                             limit: Annotated[int, Query(ge=1, le=1000)] = 100
+                             ):
+    await controller.get_server(server_id)
+    return await read_events_page(session, response, [server_id], kind,
+                                  player, after, since, until, limit)
+
+
+@router.get("/{server_id}/output", response_model=ServerOutput)
+async def read_server_output(server_id: int,
+                             controller: ControllerDep,
+                             since: int | None = None,
+                             last: Annotated[int, Query(ge=1, le=1000)] = 100,
+                             limit: Annotated[int, Query(ge=1, le=1000)] = 100
+                             ):
+    return await controller.read_output(server_id, since, last, limit)
+
+
+@router.get("/{server_id}/logs", response_model=ServerLogs)
+async def read_server_logs(
+        server_id: int,
+        controller: ControllerDep,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        tail: Annotated[int | None,
+                        Query(ge=1, le=settings.SERVER_LOG_READ_MAX_LINES)
+                        ] = None,
+        limit: Annotated[int,
+                         Query(ge=1, le=settings.SERVER_LOG_READ_MAX_LINES)
+                         ] = 1000
+        ):
+    """
+    Reads the stored output of the server, which outlives restarts of the
+    server and the node. Returns the last tail lines, or else the first
+    limit lines from since until until, continue after a truncated page
+    with the time of its last line as since.
+    """
+    return await controller.read_logs(server_id, unix_time(since),
+                                      unix_time(until), tail, limit)
+
+
+@router.get("/{server_id}/output/stream")
+async def stream_server_output(
+        server_id: int,
+        controller: ControllerDep,
+        since: int | None = None,
+        last_event_id: Annotated[int | None, Header()] = None
+        ):
+    """
+    Streams the output of the server as server-sent events, from line since
+    or the line after Last-Event-ID if given, else from the next new line
+    """
+    if last_event_id is not None:
+        since = last_event_id + 1
+    viewer = OutputViewer(controller)
+    await viewer.subscribe(server_id, since)
+    return StreamingResponse(viewer.stream_events(),
+                             media_type="text/event-stream")
 
 
 @router.post("/{server_id}/init", response_model=ServerPublic)
-async def init_server(server_id: int, session: SessionDep,
-                      archipelago_file: UploadFile,
+async def init_server(server_id: int,
+                      controller: ControllerDep,
+                      archipelago_file: UploadFile | None = None,
+                      file_hash: str | None = None,
                       overwrite: bool = False
                       ):
-    server = session.get(Server, server_id)
-    folder_str = f"arch_games_dev/{server.id}/"
-    if (Path(folder_str) / "game.archipelago").is_file() and \
-            not overwrite:
+    """
+    Initializes the server with a game file, either uploaded or referenced
+    by the sha256 of a file that was uploaded to this node before
+    """
+    server = await controller.get_server(server_id)
+    if archipelago_file is None and file_hash is None:
+        raise HTTPException(status_code=400,
+                            detail="Either archipelago_file or file_hash "
+                                   "is required")
+    if game_file_path(server.id).is_file() and not overwrite:
         raise HTTPException(status_code=400,
                             detail=("Archipelago file already exists, "
                                     "rerun the command with overwrite=True "
                                     "to overwrite")
                             )
-    Path(folder_str).mkdir(parents=True, exist_ok=True)
-    # TODO: Make into aiofiles?
-    with open(Path(folder_str) / "game.archipelago", "wb") as f:
-        arch_content = await archipelago_file.read()
-        f.write(arch_content)
-    await archipelago_file.close()
-    server.archipelago_file_name = archipelago_file.filename
-    server.initialized = True
-    session.add(server)
-    session.commit()
-    session.refresh(server)
-    return server
-
-
-async def wait_start_archipelago_server(server: Server,
-                                        session: SessionDep,
-                                        callback_info: StartServerCBInfo):
-    sm = server_manager.servers[server.id]
-    is_started = await sm.wait_for_startup()
-    if is_started:
-        server.state = ServerStateEnum.running
-    else:
-        server.state = ServerStateEnum.failed
-    session.add(server)
-    session.commit()
-    session.refresh(server)
-    callback_url = callback_info.callback_url
-    hub_id = callback_info.hub_id
-    game_id = callback_info.game_id
-    body = {"state": server.state}
-    _ = httpx.post(
-            f"{callback_url}/hubs/{hub_id}/games/{game_id}/started",
-            json=body
-            )
+    if archipelago_file is None:
+        return await controller.init_server(server_id, file_hash)
+    # The upload is received by the API, the controller moves it into the
+    # blob store
+    try:
+        tmp_path, uploaded_hash, _ = await stream_upload_to_temp(
+                archipelago_file,
+                blob_store.tmp_dir,
+                settings.ARCHIPELAGO_FILE_MAX_SIZE,
+                settings.ARCHIPELAGO_FILE_CHUNK_SIZE
+                )
+    except FileTooLargeException as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    finally:
+        await archipelago_file.close()
+    if file_hash is not None and file_hash != uploaded_hash:
+        remove_file(tmp_path)
+        raise HTTPException(status_code=400,
+                            detail="Uploaded file does not match file_hash")
+    try:
+        return await controller.init_server(server_id, uploaded_hash,
+                                            str(tmp_path),
+                                            archipelago_file.filename)
+    finally:
+        remove_file(tmp_path)
 
 
 @router.post("/{server_id}/start", response_model=ServerPublic,
              callbacks=server_callback_router.routes)
-async def start_server(server_id: int, session: SessionDep,
+async def start_server(server_id: int,
                        callback_info: StartServerCBInfo,
-                       background_tasks: BackgroundTasks):
-    server = session.get(Server, server_id)
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-    sm = server_manager.servers[server_id]
-    try:
-        await sm.start()
-    except ServerWrongStateException as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    except ServerNotInitializedException:
-        server.state = ServerStateEnum.failed
-        session.add(server)
-        session.commit()
-        raise HTTPException(status_code=400,
-                            detail=("Server is not initialized, "
-                                    "call /server/{server_id}/init to "
-                                    "initialize."
-                                    )
-                            )
-    server.state = ServerStateEnum.starting
-    session.add(server)
-    session.commit()
-    session.refresh(server)
-    background_tasks.add_task(wait_start_archipelago_server,
-                              server, session,
-                              callback_info
-                              )
+                       background_tasks: BackgroundTasks,
+                       controller: ControllerDep):
+    server = await controller.start_server(server_id, callback_info.hub_id,
+                                           callback_info.game_id,
+                                           str(callback_info.callback_url))
+    background_tasks.add_task(controller.finish_start, server_id)
     return server
 
 
 @router.post("/{server_id}/stop", response_model=ServerPublic)
-async def stop_server(server_id, session: SessionDep):
-    server = session.get(Server, server_id)
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-    sm = server_manager.servers[server.id]
-    try:
-        await sm.stop()
-    except ServerWrongStateException as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    server.state = ServerStateEnum.stopped
-    session.add(server)
-    session.commit()
-    session.refresh(server)
-    return server
+async def stop_server(server_id: int, controller: ControllerDep):
+    return await controller.stop_server(server_id)
 
 
-@router.post("/{server_id}/send_cmd")
-async def send_cmd_to_sever(server_id, session: SessionDep, cmd: SendCmdBody):
-    server = session.get(Server, server_id)
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-    sm = server_manager.servers[server.id]
-    try:
-        await sm.send_cmd(cmd.cmd)
-    except ProcessNotRunningException as e:
-        raise HTTPException(status_code=400, detail=str(e))
+@router.post("/{server_id}/send_cmd",
+             response_model=List[CommandResult] | None)
+async def send_cmd_to_sever(server_id: int, cmd: SendCmdBody,
+                            controller: ControllerDep):
+    """
+    Sends the commands to the server. With wait, returns the lines the
+    server wrote in response to each of them: everything until it was quiet
+    for quiet_period seconds, for at most timeout seconds per command.
+    """
+    cmds = [cmd.cmd] if isinstance(cmd.cmd, str) else cmd.cmd
+    return await controller.send_cmds(server_id, cmds, cmd.wait,
+                                      cmd.quiet_period, cmd.timeout)
@@ -26,15 +26,172 @@ class Settings(BaseSettings):
 
     ARCHIPELAGO_PORT_START: int = 38281
     ARCHIPELAGO_PORT_END: int = 38300
+    # Skip ports that are already bound by something else on the host
+    ARCHIPELAGO_PORT_CHECK_BOUND: bool = True
+
+    # Seconds to wait for a started server to report it is listening
+    SERVER_STARTUP_TIMEOUT: float = 5.0
+
+    # Output is read in chunks of READ_CHUNK_SIZE bytes, a line without a
+    # newline is cut off after READ_MAX_LINE_LENGTH characters
+    SERVER_READ_CHUNK_SIZE: int = 65536
+    SERVER_READ_MAX_LINE_LENGTH: int = 65536
+    # Every output callback gets its own queue of CALLBACK_QUEUE_SIZE lines,
+    # CALLBACK_POLICY decides what happens when a slow callback fills it
+    SERVER_CALLBACK_QUEUE_SIZE: int = 1000
+    SERVER_CALLBACK_POLICY: Literal["block", "drop_oldest", "coalesce"] = \
+        "drop_oldest"
+    # Seconds callbacks get to work through their queue after a server exits
+    SERVER_CALLBACK_DRAIN_TIMEOUT: float = 1.0
+
+    # Servers keep running while the node restarts and are adopted again
+    # when it comes back, unless STOP_ON_SHUTDOWN is set. Their output goes
+    # to log files that are read when inotify reports a write or the
+    # process exits, without a pidfd the exit is checked for every
+    # LOG_EXIT_CHECK_INTERVAL seconds. Without inotify they are polled every
+    # LOG_POLL_INTERVAL seconds. Output that was read is freed from the disk
+    # every LOG_RECLAIM_SIZE bytes.
+    SERVER_STOP_ON_SHUTDOWN: bool = False
+    SERVER_LOG_POLL_INTERVAL: float = 0.05
+    SERVER_LOG_EXIT_CHECK_INTERVAL: float = 5.0
+    SERVER_LOG_RECLAIM_SIZE: int = 1024 * 1024
+
+    # The response to a command is every line the server writes until it
+    # was quiet for QUIET_PERIOD seconds, cut off after TIMEOUT seconds.
+    # Requests can ask for up to MAX_TIMEOUT seconds.
+    SERVER_CMD_QUIET_PERIOD: float = 0.2
+    SERVER_CMD_TIMEOUT: float = 5.0
+    SERVER_CMD_MAX_TIMEOUT: float = 60.0
+
+    # Seconds to wait for a server to exit after /exit, and after SIGTERM
+    # before escalating to SIGKILL
+    SERVER_STOP_TIMEOUT: float = 10.0
+    SERVER_STOP_TERM_TIMEOUT: float = 5.0
+
+    # Delivery of state transitions to the hub. Failed deliveries are
+    # retried with exponential backoff, starting at BACKOFF_BASE seconds
+    HUB_CALLBACK_TIMEOUT: float = 10.0
+    HUB_CALLBACK_MAX_CONNECTIONS: int = 20
+    HUB_CALLBACK_MAX_ATTEMPTS: int = 10
+    HUB_CALLBACK_BACKOFF_BASE: float = 1.0
+    HUB_CALLBACK_BACKOFF_MAX: float = 300.0
+    HUB_CALLBACK_POLL_INTERVAL: float = 5.0
+    HUB_CALLBACK_BATCH_SIZE: int = 100
+
+    # Output lines kept in memory per server, lines longer than the max
+    # length are truncated. Caps output memory at roughly
+    # LINES * MAX_LINE_LENGTH characters per server
+    SERVER_OUTPUT_BUFFER_LINES: int = 1000
+    SERVER_OUTPUT_MAX_LINE_LENGTH: int = 1024
+    # Live output viewers get up to BATCH_LINES lines per message. Every
+    # viewer has a queue of QUEUE_SIZE messages, viewers that fill it or do
+    # not take a message within SEND_TIMEOUT seconds are disconnected
+    SERVER_OUTPUT_STREAM_BATCH_LINES: int = 500
+    SERVER_OUTPUT_STREAM_QUEUE_SIZE: int = 16
+    SERVER_OUTPUT_STREAM_SEND_TIMEOUT: float = 10.0
+
+    # Seconds between inserts of the events read from server output
+    SERVER_EVENTS_FLUSH_INTERVAL: float = 0.5
+
+    # Server output is stored per server, written every FLUSH_INTERVAL
+    # seconds. The active file is rotated into a compressed segment once it
+    # is SEGMENT_SIZE bytes or SEGMENT_AGE seconds old, segments are
+    # compressed in BLOCK_SIZE byte blocks and the active file is indexed
+    # every INDEX_INTERVAL bytes. Segments older than RETENTION seconds, and
+    # the oldest ones beyond MAX_BYTES per server, are deleted.
+    SERVER_LOG_FLUSH_INTERVAL: float = 1.0
+    SERVER_LOG_SEGMENT_SIZE: int = 8 * 1024 * 1024
+    SERVER_LOG_SEGMENT_AGE: float = 3600.0
+    SERVER_LOG_BLOCK_SIZE: int = 64 * 1024
+    SERVER_LOG_INDEX_INTERVAL: int = 64 * 1024
+    SERVER_LOG_RETENTION: float = 7 * 24 * 3600.0
+    SERVER_LOG_MAX_BYTES: int = 256 * 1024 * 1024
+    SERVER_LOG_READ_MAX_LINES: int = 10000
+
+    # The CPU, memory and file descriptors of every server process are
+    # read from /proc every SAMPLE_INTERVAL seconds, the last
+    # SAMPLE_HISTORY samples are kept per server
+    SERVER_SAMPLE_INTERVAL: float = 5.0
+    SERVER_SAMPLE_HISTORY: int = 60
+
+    # Starts are admitted while the servers that are starting or running,
+    # plus one more, fit in CPU_BUDGET of all cores and MEMORY_BUDGET of
+    # the memory. A server counts with the peak of its samples, one
+    # without samples with the average peak of the sampled ones, or with
+    # SERVER_CPU_ESTIMATE percent of a core and SERVER_MEMORY_ESTIMATE
+    # bytes while nothing was sampled. MAX_RUNNING_SERVERS caps the count.
+    NODE_CPU_BUDGET: float = 0.8
+    NODE_MEMORY_BUDGET: float = 0.8
+    NODE_MAX_RUNNING_SERVERS: int | None = None
+    SERVER_CPU_ESTIMATE: float = 10.0
+    SERVER_MEMORY_ESTIMATE: int = 256 * 1024 * 1024
+    # Starts that do not fit wait up to START_QUEUE_TIMEOUT seconds for
+    # capacity, at most START_QUEUE_SIZE at a time. With a timeout of 0
+    # they are rejected right away.
+    NODE_START_QUEUE_TIMEOUT: float = 30.0
+    NODE_START_QUEUE_SIZE: int = 100
+
+    # Uploaded .archipelago files are copied in CHUNK_SIZE byte chunks,
+    # larger files than MAX_SIZE bytes are rejected
+    ARCHIPELAGO_FILE_MAX_SIZE: int = 64 * 1024 * 1024
+    ARCHIPELAGO_FILE_CHUNK_SIZE: int = 1024 * 1024
+    # Garbage collection leaves temp files that were written to in the
+    # last TMP_MAX_AGE seconds alone, they can be uploads in progress
+    ARCHIPELAGO_FILE_TMP_MAX_AGE: float = 3600.0
+    # Uploaded files are parsed in a pool of PARSE_WORKERS processes, files
+    # that need a newer server than ARCHIPELAGO_VERSION are rejected
+    ARCHIPELAGO_PARSE_WORKERS: int = 2
+    ARCHIPELAGO_VERSION: str = "0.6.0"
+
+    # Servers started, stopped or commanded at once by the bulk endpoints,
+    # across all bulk requests
+    SERVER_BULK_PARALLELISM: int = 8
+
+    # Seconds between retries of server state writes that failed to reach
+    # the DB
+    STATE_CACHE_FLUSH_INTERVAL: float = 5.0
+    # Seconds state writes are held back, so the transitions of a server,
+    # and of servers started or stopped together, are written in one
+    # transaction. State is always written before the hub is notified.
+    STATE_CACHE_WRITE_DELAY: float = 0.05
+
+    # State transitions kept for GET /servers/changes, clients that fall
+    # further behind have to reread the servers. Long polls wait at most
+    # CHANGES_MAX_WAIT seconds.
+    SERVER_CHANGES_HISTORY: int = 10000
+    SERVER_CHANGES_MAX_WAIT: float = 60.0
+
+    # In embedded mode the API manages the game servers itself. In remote
+    # mode a supervisor process (python -m app.supervisor) does, and the
+    # API talks to it over SUPERVISOR_SOCKET, so it can run several workers
+    SUPERVISOR_MODE: Literal["embedded", "remote"] = "embedded"
+    SUPERVISOR_SOCKET: str = "archipelago-node.sock"
 
     ENVIRONMENT: Literal["local", "staging", "production"] = "local"
 
     DB_BACKEND: Literal["sqlite", "postgres"] = "sqlite"
 
     SQLITE_FILE_NAME: str | None = f"database_{ENVIRONMENT}.db"
+    # Pragmas set on every sqlite connection. WAL lets readers and the
+    # writer work at the same time, with synchronous NORMAL a commit only
+    # syncs at checkpoints. CACHE_SIZE is in KiB when negative.
+    SQLITE_JOURNAL_MODE: Literal["WAL", "DELETE", "TRUNCATE"] = "WAL"
+    SQLITE_SYNCHRONOUS: Literal["OFF", "NORMAL", "FULL"] = "NORMAL"
+    SQLITE_BUSY_TIMEOUT: int = 5000
+    SQLITE_CACHE_SIZE: int = -65536
+    SQLITE_MMAP_SIZE: int = 268435456
 
     POSTGRES: PostgresSettings | None = None
 
+    # Connection pool of the postgres engines. Connections are checked with
+    # a ping before use and replaced after DB_POOL_RECYCLE seconds, so
+    # connections dropped by the DB or a proxy are not handed out
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+
     @computed_field
     @property
     def SQLALCHEMY_DATABASE_URI(self) -> AnyUrl | PostgresDsn:
@@ -50,5 +207,20 @@ class Settings(BaseSettings):
         else:  # Default to sqlite
             return AnyUrl(f"sqlite:///{self.SQLITE_FILE_NAME}")
 
+    @computed_field
+    @property
+    def SQLALCHEMY_ASYNC_DATABASE_URI(self) -> AnyUrl | PostgresDsn:
+        if self.DB_BACKEND == "postgres":
+            return MultiHostUrl.build(
+                scheme="postgresql+asyncpg",
+                username=self.POSTGRES.USER,
+                password=self.POSTGRES.PASSWORD,
+                host=self.POSTGRES.SERVER,
+                port=self.POSTGRES.PORT,
+                path=self.POSTGRES.DB,
+            )
+        else:  # Default to sqlite
+            return AnyUrl(f"sqlite+aiosqlite:///{self.SQLITE_FILE_NAME}")
+
 
 settings = Settings()
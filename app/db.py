@@ -1,19 +1,72 @@
 import logging
+from typing import AsyncGenerator
 from sqlmodel import create_engine, Session
-from sqlalchemy import Engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import Engine, event
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from alembic.config import Config
 from alembic import command
 from app.core.config import settings
+from app.utils.metrics import before_cursor_execute, after_cursor_execute
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT}")
+    cursor.execute(f"PRAGMA cache_size={settings.SQLITE_CACHE_SIZE}")
+    cursor.execute(f"PRAGMA mmap_size={settings.SQLITE_MMAP_SIZE}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+def tune_sqlite_engine(engine: Engine | AsyncEngine):
+    if isinstance(engine, AsyncEngine):
+        engine = engine.sync_engine
+    event.listen(engine, "connect", set_sqlite_pragmas)
+
+
+def instrument_engine(engine: Engine | AsyncEngine):
+    """
+    Times every query of the engine for the metrics
+    """
+    if isinstance(engine, AsyncEngine):
+        engine = engine.sync_engine
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
 if settings.DB_BACKEND == "sqlite":
     connect_args = {"check_same_thread": False}
     engine = create_engine(str(settings.SQLALCHEMY_DATABASE_URI),
                            connect_args=connect_args)
+    # aiosqlite runs every connection in its own thread already
+    async_engine = create_async_engine(
+            str(settings.SQLALCHEMY_ASYNC_DATABASE_URI)
+            )
+    tune_sqlite_engine(engine)
+    tune_sqlite_engine(async_engine)
+else:
+    pool_args = {
+            "pool_size": settings.DB_POOL_SIZE,
+            "max_overflow": settings.DB_MAX_OVERFLOW,
+            "pool_timeout": settings.DB_POOL_TIMEOUT,
+            "pool_recycle": settings.DB_POOL_RECYCLE,
+            "pool_pre_ping": settings.DB_POOL_PRE_PING,
+            }
+    engine = create_engine(str(settings.SQLALCHEMY_DATABASE_URI),
+                           **pool_args)
+    async_engine = create_async_engine(
+            str(settings.SQLALCHEMY_ASYNC_DATABASE_URI),
+            **pool_args
+            )
+instrument_engine(engine)
+instrument_engine(async_engine)
 
 
 def create_db_and_tables():
@@ -25,15 +78,34 @@ def create_db_and_tables():
 
 
 class SessionHandler():
-    def __init__(self, engine: Engine):
+    """
+    Hands out sessions of the sync engine, used by code that runs outside
+    of a request, and of the async engine, used by the routes so queries
+    do not block the event loop
+    """
+    def __init__(self, engine: Engine, async_engine: AsyncEngine):
         self.engine = engine
+        self.async_engine = async_engine
 
     def get_session(self) -> Session:
         with Session(self.engine) as session:
             yield session
 
-    def set_engine(self, engine: Engine):
+    async def get_async_session(self) -> AsyncGenerator[AsyncSession, None]:
+        # Objects are still read after commit, e.g. to return them
+        async with AsyncSession(self.async_engine,
+                                expire_on_commit=False) as session:
+            yield session
+
+    def async_session(self) -> AsyncSession:
+        return AsyncSession(self.async_engine, expire_on_commit=False)
+
+    def set_engine(self, engine: Engine, async_engine: AsyncEngine):
         self.engine = engine
+        self.async_engine = async_engine
+
+    async def dispose(self):
+        await self.async_engine.dispose()
 
 
-session_handler = SessionHandler(engine)
+session_handler = SessionHandler(engine, async_engine)
@@ -0,0 +1,54 @@
+from datetime import datetime
+from enum import Enum
+from sqlmodel import SQLModel, Field, Index
+
+
+class ServerEventKindEnum(str, Enum):
+    joined = "joined"
+    left = "left"
+    item_sent = "item_sent"
+    goal = "goal"
+    released = "released"
+    hint = "hint"
+    chat = "chat"
+    error = "error"
+
+
+#############################################################################
+#                               SERVER EVENT                                #
+#############################################################################
+# Something that happened in a multiworld, read from the output of its      #
+# archipelago server                                                        #
+#############################################################################
+class ServerEventBase(SQLModel):
+    server_id: int
+    at: datetime
+    kind: ServerEventKindEnum
+    # The player the event is about, for items and hints the sender/finder
+    player: str | None = None
+    # Who receives the item of an item_sent or hint event
+    receiver: str | None = None
+    item: str | None = None
+    location: str | None = None
+    game: str | None = None
+    # The whole output line
+    message: str
+
+
+class ServerEvent(ServerEventBase, table=True):
+    __tablename__ = "server_event"
+    # Serve the event queries of a server, filtered by kind or player and
+    # paged by id
+    __table_args__ = (
+            Index("ix_server_event_server_kind_id", "server_id", "kind",
+                  "id"),
+            Index("ix_server_event_server_player_id", "server_id", "player",
+                  "id"),
+            Index("ix_server_event_server_at", "server_id", "at"),
+            )
+
+    id: int | None = Field(default=None, primary_key=True)
+
+
+class ServerEventPublic(ServerEventBase):
+    id: int
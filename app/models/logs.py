@@ -0,0 +1,37 @@
+from sqlmodel import SQLModel, Field, Column, Index, JSON
+from app.models.servers import ServerLogLine
+
+
+#############################################################################
+#                               LOG POSTING                                 #
+#############################################################################
+# The blocks of a stored log segment of a server a token appears in, the    #
+# inverted index log searches look candidates up in                         #
+#############################################################################
+class LogPosting(SQLModel, table=True):
+    __tablename__ = "log_posting"
+    # Dropping the postings of a segment, or of every segment of a server
+    __table_args__ = (
+            Index("ix_log_posting_server_segment", "server_id", "segment"),
+            )
+
+    token: str = Field(primary_key=True)
+    server_id: int = Field(primary_key=True)
+    segment: int = Field(primary_key=True)
+    blocks: list[int] = Field(sa_column=Column(JSON, nullable=False))
+    # Unix times of the first and last line of the segment
+    first_at: float
+    last_at: float
+
+
+class LogSearchHit(ServerLogLine):
+    server_id: int
+
+
+class LogSearchResult(SQLModel):
+    """
+    Stored output lines that contain the query, oldest first
+    """
+    hits: list[LogSearchHit]
+    # More lines matched than the limit allowed
+    truncated: bool = False
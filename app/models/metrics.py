@@ -0,0 +1,19 @@
+from typing import Literal
+from sqlmodel import SQLModel
+
+
+class MetricSample(SQLModel):
+    name: str
+    labels: dict[str, str]
+    value: float
+
+
+class MetricFamily(SQLModel):
+    """
+    A metric with the current value of every label combination, how the
+    supervisor hands its metrics to the API
+    """
+    name: str
+    type: Literal["counter", "gauge", "histogram"]
+    help: str
+    samples: list[MetricSample]
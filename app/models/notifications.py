@@ -0,0 +1,69 @@
+from datetime import datetime
+from enum import Enum
+from sqlmodel import SQLModel, Field
+from app.models.servers import ServerStateEnum
+
+
+class HubEventEnum(str, Enum):
+    started = "started"
+    failed = "failed"
+    stopped = "stopped"
+    crashed = "crashed"
+
+
+HUB_EVENT_STATES = {
+        HubEventEnum.started: ServerStateEnum.running,
+        HubEventEnum.failed: ServerStateEnum.failed,
+        HubEventEnum.stopped: ServerStateEnum.stopped,
+        HubEventEnum.crashed: ServerStateEnum.failed,
+        }
+
+
+#############################################################################
+#                             HUB NOTIFICATION                              #
+#############################################################################
+# A server state transition waiting to be (or already) delivered to the     #
+# hub that started the server                                               #
+#############################################################################
+class HubNotificationBody(SQLModel):
+    server_id: int
+    game_id: int
+    event: HubEventEnum
+    state: ServerStateEnum
+    failure_reason: str | None = None
+    idempotency_key: str
+    created_at: datetime
+
+
+class HubNotificationBatchBody(SQLModel):
+    events: list[HubNotificationBody]
+
+
+class HubNotification(SQLModel, table=True):
+    __tablename__ = "hub_notification"
+
+    id: int | None = Field(default=None, primary_key=True)
+    server_id: int = Field(index=True)
+    hub_id: int
+    game_id: int
+    callback_url: str
+    event: HubEventEnum
+    failure_reason: str | None = None
+    idempotency_key: str = Field(unique=True)
+    created_at: datetime
+    attempts: int = 0
+    next_attempt_at: datetime = Field(index=True)
+    delivered_at: datetime | None = Field(default=None, index=True)
+    gave_up: bool = False
+    last_error: str | None = None
+
+    def to_body(self) -> HubNotificationBody:
+        return HubNotificationBody(
+                server_id=self.server_id,
+                game_id=self.game_id,
+                event=self.event,
+                state=HUB_EVENT_STATES[self.event],
+                failure_reason=self.failure_reason,
+                idempotency_key=self.idempotency_key,
+                created_at=self.created_at
+                )
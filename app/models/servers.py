@@ -1,5 +1,7 @@
+from datetime import datetime
 from enum import Enum
-from sqlmodel import SQLModel, Field
+from typing import Literal
+from sqlmodel import SQLModel, Field, Column, Index, JSON
 
 
 class ServerStateEnum(str, Enum):
@@ -10,6 +12,11 @@ class ServerStateEnum(str, Enum):
     failed = "failed"
 
 
+class ServerFailureReasonEnum(str, Enum):
+    exited = "exited"
+    timed_out = "timed_out"
+
+
 class ServerWrongStateException(Exception):
     pass
 
@@ -18,6 +25,31 @@ class ServerNotInitializedException(Exception):
     pass
 
 
+#############################################################################
+#                           ARCHIPELAGO METADATA                            #
+#############################################################################
+# What an uploaded .archipelago file contains, read once at upload time     #
+#############################################################################
+class ArchipelagoSlot(SQLModel):
+    slot: int
+    name: str
+    game: str
+
+
+class ArchipelagoMetadata(SQLModel):
+    format_version: int
+    generator_version: str
+    required_server_version: str
+    seed_name: str | None = None
+    player_count: int
+    games: list[str]
+    slots: list[ArchipelagoSlot]
+    race_mode: bool = False
+    has_password: bool = False
+    # Without passwords and the settings the node decides itself
+    server_options: dict = {}
+
+
 #############################################################################
 #                                  SERVER                                   #
 #############################################################################
@@ -35,14 +67,205 @@ class ServerCreateInternal(ServerBase):
 class ServerPublic(ServerBase):
     id: int
     state: ServerStateEnum
+    failure_reason: ServerFailureReasonEnum | None = None
     initialized: bool
+    archipelago_file_hash: str | None = None
+    archipelago_metadata: ArchipelagoMetadata | None = None
+
+
+# Fields the server list can be narrowed down to, id is always included
+ServerListField = Literal["address", "port", "state", "failure_reason",
+                          "initialized", "archipelago_file_hash",
+                          "archipelago_metadata"]
+
+
+class ServerListItem(SQLModel):
+    """
+    A server in the server list, only the fields that were asked for are
+    returned
+    """
+    id: int
+    address: str | None = None
+    port: int | None = None
+    state: ServerStateEnum | None = None
+    failure_reason: ServerFailureReasonEnum | None = None
+    initialized: bool | None = None
+    archipelago_file_hash: str | None = None
+    archipelago_metadata: ArchipelagoMetadata | None = None
 
 
 class Server(ServerBase, table=True):
+    # Serves the server list filtered by state and paged by id
+    __table_args__ = (Index("ix_server_state_id", "state", "id"),)
+
     id: int | None = Field(default=None, primary_key=True)
     state: ServerStateEnum = ServerStateEnum.created
+    failure_reason: ServerFailureReasonEnum | None = None
     initialized: bool = False
     address: str | None = None
     port: int | None = Field(default=None, index=True)
     process_id: int | None = None
     archipelago_file_name: str | None = None
+    archipelago_file_hash: str | None = None
+    archipelago_metadata: dict | None = Field(default=None,
+                                              sa_column=Column(JSON))
+    # Where to send state transitions, set by the hub when starting
+    hub_id: int | None = None
+    game_id: int | None = None
+    callback_url: str | None = None
+
+
+#############################################################################
+#                               BULK RESULTS                                #
+#############################################################################
+# Per server outcome of a bulk operation                                    #
+#############################################################################
+class BulkStartServer(SQLModel):
+    server_id: int
+    game_id: int
+
+
+class BulkServerResult(SQLModel):
+    server_id: int
+    status_code: int
+    detail: str | None = None
+    server: ServerPublic | None = None
+
+
+#############################################################################
+#                              SERVER CHANGES                               #
+#############################################################################
+# State transitions of the servers on a node, numbered by a version that    #
+# only grows while the node runs                                            #
+#############################################################################
+class ServerChange(SQLModel):
+    version: int
+    server_id: int
+    # None once the server was deleted
+    state: ServerStateEnum | None
+    failure_reason: ServerFailureReasonEnum | None = None
+    at: datetime
+
+
+class ServerChanges(SQLModel):
+    # Versions are only comparable within one epoch, a new epoch starts
+    # every time the node starts
+    epoch: str
+    version: int
+    # Set when changes since the given version are no longer known, the
+    # client has to reread the servers
+    reset: bool = False
+    changes: list[ServerChange]
+
+
+#############################################################################
+#                              SERVER OUTPUT                                #
+#############################################################################
+# Buffered stdout/stderr lines of a running archipelago server              #
+#############################################################################
+class ServerOutputLine(SQLModel):
+    seq: int
+    stream: str
+    line: str
+
+
+class ServerOutput(SQLModel):
+    first_seq: int
+    next_seq: int
+    lines: list[ServerOutputLine]
+
+
+class CommandResult(SQLModel):
+    """
+    The output a command was answered with, every line the server wrote
+    until it was quiet for a while
+    """
+    cmd: str
+    lines: list[ServerOutputLine]
+    # The server was still writing when the timeout cut the response off
+    timed_out: bool = False
+
+
+class ServerOutputBatch(ServerOutput):
+    """
+    New output of one of the servers a live viewer is subscribed to
+    """
+    server_id: int
+    # Lines that were overwritten before the viewer got them
+    skipped: int = 0
+
+
+class ServerResourceSample(SQLModel):
+    at: datetime
+    # Percent of one core used since the previous sample, None for the
+    # first sample of a process
+    cpu_percent: float | None = None
+    rss_bytes: int
+    open_fds: int
+
+
+class ServerResources(SQLModel):
+    """
+    What the process of a server uses, the history oldest first
+    """
+    server_id: int
+    current: ServerResourceSample | None = None
+    history: list[ServerResourceSample] = []
+
+
+class ServerDetail(ServerPublic):
+    resources: ServerResources | None = None
+
+
+class NodeResources(SQLModel):
+    """
+    The machine, and what all server processes on it use together
+    """
+    cpu_count: int
+    memory_total_bytes: int
+    memory_available_bytes: int
+    load_average: list[float]
+    servers_sampled: int
+    cpu_percent: float
+    rss_bytes: int
+    open_fds: int
+    # The current sample of every server, without history
+    servers: list[ServerResources]
+
+
+class NodeCapacity(SQLModel):
+    """
+    How many more servers the node can run, for the hub to place games
+    """
+    active_servers: int
+    queued_starts: int
+    # What one more server is expected to use, and how many servers were
+    # sampled to know that
+    server_cpu_percent: float
+    server_rss_bytes: int
+    sampled_servers: int
+    # In percent of one core
+    cpu_budget_percent: float
+    cpu_projected_percent: float
+    memory_budget_bytes: int
+    memory_projected_bytes: int
+    memory_available_bytes: int
+    free_slots: int
+    # Ports for new servers
+    free_ports: int
+    saturated: bool
+
+
+class ServerLogLine(SQLModel):
+    at: datetime
+    stream: str
+    line: str
+
+
+class ServerLogs(SQLModel):
+    """
+    Stored output of a server, oldest line first
+    """
+    lines: list[ServerLogLine]
+    # More lines matched than the limit allowed
+    truncated: bool = False
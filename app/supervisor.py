@@ -0,0 +1,62 @@
+"""
+Runs the game servers in their own process, for running the API in remote
+mode with several workers:
+
+    python -m app.supervisor
+    SUPERVISOR_MODE=remote fastapi run app/main.py --workers 4
+"""
+import asyncio
+import logging
+import signal
+from pydantic import validate_call
+from app.core.config import settings
+from app.utils.controller import (
+        LocalController,
+        local_controller,
+        RPC_METHODS
+        )
+from app.utils.node import node_runtime
+from app.utils.rpc import RpcServer
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def create_rpc_server(controller: LocalController, path: str) -> RpcServer:
+    handlers = {name: validate_call(getattr(controller, name))
+                for name in RPC_METHODS}
+    background_tasks = set()
+
+    async def start_server(**params):
+        # The API does not wait for the startup, the supervisor does
+        server = await handlers["start_server"](**params)
+        task = asyncio.create_task(
+                controller.finish_start(params["server_id"])
+                )
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+        return server
+    return RpcServer(path, handlers | {"start_server": start_server})
+
+
+async def run_supervisor():
+    rpc_server = create_rpc_server(local_controller,
+                                   settings.SUPERVISOR_SOCKET)
+    await node_runtime.start()
+    await rpc_server.start()
+    logger.info(f"Supervisor listening on {settings.SUPERVISOR_SOCKET}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    logger.info("Supervisor shutting down")
+    await rpc_server.stop()
+    await node_runtime.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_supervisor())
@@ -1,27 +1,44 @@
 import pytest
 from fastapi.testclient import TestClient
 from sqlmodel import Session, SQLModel, create_engine, delete
-from sqlmodel.pool import StaticPool
+from sqlalchemy.ext.asyncio import create_async_engine
 from app.main import app
-from app.db import session_handler
+from app.core.config import settings
+from app.db import session_handler, tune_sqlite_engine, instrument_engine
 from app.models.servers import Server
-from app.utils.server_utils import server_manager
+from app.utils.server_utils import server_manager, port_handler
+from app.utils.state_cache import state_cache
+from app.utils.change_feed import change_feed
+
+
+# Servers started by tests must not outlive the test client
+settings.SERVER_STOP_ON_SHUTDOWN = True
 
 
 @pytest.fixture(name="session")
-def session_fixture():
+def session_fixture(tmp_path):
+    # A file, so the sync and the async engine see the same DB
+    db_file = tmp_path / "test.db"
     engine = create_engine(
-        "sqlite://", connect_args={"check_same_thread": False},
-        poolclass=StaticPool
+        f"sqlite:///{db_file}", connect_args={"check_same_thread": False}
     )
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{db_file}")
+    tune_sqlite_engine(engine)
+    tune_sqlite_engine(async_engine)
+    instrument_engine(engine)
+    instrument_engine(async_engine)
     SQLModel.metadata.create_all(engine)
     # Make all code in tests use test engine
-    session_handler.set_engine(engine)
+    session_handler.set_engine(engine, async_engine)
     with Session(engine) as session:
         yield session
         statement = delete(Server)
         session.execute(statement)
         session.commit()
+        state_cache.clear()
+        port_handler.reset()
+        change_feed.reset()
+    engine.dispose()
 
 
 @pytest.fixture(name="client")
@@ -1,17 +1,75 @@
 import asyncio
+import hashlib
+import json
+import os
+import shutil
+import signal
+import threading
+import time
+from datetime import datetime
 import pytest
 import httpx
 from pytest_httpx import HTTPXMock
 from fastapi.testclient import TestClient
 from sqlmodel import Session, select
-from app.models.servers import ServerStateEnum, Server
-from app.utils.server_utils import server_manager
+from app.models.servers import (
+        ServerStateEnum,
+        ServerFailureReasonEnum,
+        Server
+        )
+from app.core.config import settings
+from app.models.notifications import HubNotification, HubEventEnum
+from app.utils.server_utils import server_manager, port_handler
+from app.utils.process import pid_exists
+from app.utils.blob_store import blob_store
+from app.utils.dispatch import BackpressurePolicyEnum
+from app.utils.events import event_writer
+from app.utils.files import log_dir, stdin_fifo_path
+from app.utils.log_store import log_store
+from app.utils.outbox import hub_outbox
+from app.utils.resources import resource_sampler
+from app.models.logs import LogPosting
+from app.utils.state_cache import state_cache
+from app.utils.node import reinit_server_objects
+from app.utils.controller import (
+        RemoteController,
+        local_controller,
+        get_controller
+        )
+from app.supervisor import create_rpc_server
+from app.main import app
 from app.tests.utils.creators import (
         create_random_server,
         create_random_initted_server
         )
 
 
+def read_start_count(client: TestClient) -> float:
+    prefix = 'archipelago_server_start_seconds_count{outcome="started"} '
+    for line in client.get("/metrics").text.splitlines():
+        if line.startswith(prefix):
+            return float(line[len(prefix):])
+    return 0
+
+
+async def wait_for_notification(session: Session, server_id: int,
+                                event: HubEventEnum,
+                                delivered: bool = True,
+                                attempts: int = 0) -> HubNotification:
+    for _ in range(50):
+        session.expire_all()
+        notification = session.exec(
+                select(HubNotification)
+                .where(HubNotification.server_id == server_id)
+                .where(HubNotification.event == event)
+                ).first()
+        if notification and (notification.delivered_at or not delivered) \
+                and notification.attempts >= attempts:
+            return notification
+        await asyncio.sleep(0.1)
+    return notification
+
+
 def test_create_server(client: TestClient):
     response = client.post("/servers/")
     data = response.json()
@@ -24,6 +82,39 @@ def test_create_server(client: TestClient):
     assert data["initialized"] is False
 
 
+def test_create_servers_bulk(client: TestClient):
+    response = client.post("/servers/bulk?count=3")
+    data = response.json()
+
+    assert response.status_code == 200
+    assert len(data) == 3
+    assert len({server["port"] for server in data}) == 3
+    assert all(server["state"] == ServerStateEnum.created
+               for server in data)
+
+
+def test_create_server_ports_exhausted(client: TestClient):
+    port_count = (settings.ARCHIPELAGO_PORT_END
+                  - settings.ARCHIPELAGO_PORT_START + 1)
+    port_handler.reserve(port_count)
+    response = client.post("/servers/")
+    data = response.json()
+
+    assert response.status_code == 503
+    assert data["detail"] == "Not enough free ports, requested 1"
+
+
+def test_delete_server_releases_port(client: TestClient, session: Session):
+    server = create_random_server(session)
+    response = client.delete(f"/servers/{server.id}")
+    assert response.status_code == 200
+
+    response = client.post("/servers/")
+    data = response.json()
+    assert response.status_code == 200
+    assert data["port"] == server.port
+
+
 def test_read_servers(client: TestClient, session: Session):
     server1 = create_random_server(session)
     server2 = create_random_server(session)
@@ -38,6 +129,301 @@ def test_read_servers(client: TestClient, session: Session):
     assert data[1]["id"] == server2.id
 
 
+def test_read_servers_pages_by_id(client: TestClient, session: Session):
+    servers = [create_random_server(session) for _ in range(5)]
+    response = client.get("/servers/?limit=2")
+    assert [s["id"] for s in response.json()] == \
+        [servers[0].id, servers[1].id]
+    after = response.headers["X-Next-After"]
+    assert after == str(servers[1].id)
+
+    response = client.get(f"/servers/?limit=2&after={after}")
+    assert [s["id"] for s in response.json()] == \
+        [servers[2].id, servers[3].id]
+
+    response = client.get(f"/servers/?limit=2&after={servers[3].id}")
+    assert [s["id"] for s in response.json()] == [servers[4].id]
+    assert "X-Next-After" not in response.headers
+
+
+def test_read_servers_filters(client: TestClient, session: Session):
+    server1 = create_random_server(session)
+    server2 = create_random_initted_server(session)
+    server3 = create_random_initted_server(session)
+    server3.state = ServerStateEnum.running
+    session.add(server3)
+    session.commit()
+
+    response = client.get("/servers/?state=running")
+    assert [s["id"] for s in response.json()] == [server3.id]
+    response = client.get("/servers/?state=created&state=running")
+    assert [s["id"] for s in response.json()] == \
+        [server1.id, server2.id, server3.id]
+    response = client.get("/servers/?initialized=false")
+    assert [s["id"] for s in response.json()] == [server1.id]
+    response = client.get(f"/servers/?port_min={server2.port}"
+                          f"&port_max={server2.port}")
+    assert [s["id"] for s in response.json()] == [server2.id]
+
+
+def test_read_servers_projection(client: TestClient, session: Session):
+    server = create_random_initted_server(session)
+    response = client.get("/servers/?fields=state&fields=port")
+    assert response.status_code == 200
+    assert response.json() == [{"id": server.id, "port": server.port,
+                                "state": ServerStateEnum.created}]
+
+    response = client.get("/servers/?fields=process_id")
+    assert response.status_code == 422
+
+
+def test_read_server_changes(client: TestClient, session: Session):
+    response = client.post("/servers/")
+    server_id = response.json()["id"]
+    response = client.get("/servers/changes")
+    data = response.json()
+    assert response.status_code == 200
+    assert data["reset"] is False
+    assert [(c["server_id"], c["state"]) for c in data["changes"]] == \
+        [(server_id, ServerStateEnum.created)]
+
+    version, epoch = data["version"], data["epoch"]
+    start = time.monotonic()
+    response = client.get(f"/servers/changes?since={version}"
+                          f"&epoch={epoch}&timeout=0.2")
+    assert time.monotonic() - start >= 0.2
+    assert response.json()["changes"] == []
+
+    client.delete(f"/servers/{server_id}")
+    response = client.get(f"/servers/changes?since={version}"
+                          f"&epoch={epoch}")
+    assert [(c["server_id"], c["state"])
+            for c in response.json()["changes"]] == [(server_id, None)]
+
+    response = client.get(f"/servers/changes?since={version}&epoch=old")
+    assert response.json()["reset"] is True
+
+
+def test_watch_server_changes(client: TestClient, session: Session):
+    server = create_random_server(session)
+    version = client.get("/servers/changes?timeout=0").json()["version"]
+    with client.websocket_connect(
+            f"/servers/changes/ws?since={version}") as websocket:
+        state_cache.update(server.id, state=ServerStateEnum.starting)
+        state_cache.update(server.id, state=ServerStateEnum.running)
+        received = []
+        while len(received) < 2:
+            received += websocket.receive_json()["changes"]
+    assert [c["state"] for c in received] == \
+        [ServerStateEnum.starting, ServerStateEnum.running]
+
+
+def test_watch_servers_output(client: TestClient, session: Session):
+    server1 = create_random_server(session)
+    server2 = create_random_server(session)
+    output1 = server_manager.servers[server1.id].output
+    output2 = server_manager.servers[server2.id].output
+    output1.append("old line")
+    with client.websocket_connect(
+            f"/servers/output/ws?server_id={server1.id}&since=0"
+            ) as websocket:
+        data = websocket.receive_json()
+        assert data["server_id"] == server1.id
+        assert [line["line"] for line in data["lines"]] == ["old line"]
+
+        websocket.send_json({"action": "subscribe",
+                             "server_id": server2.id})
+        websocket.send_json({"action": "subscribe",
+                             "server_id": server2.id + 1})
+        data = websocket.receive_json()
+        assert data == {"server_id": server2.id + 1, "status_code": 404,
+                        "detail": "Server not found"}
+        output2.append("from server 2")
+        data = websocket.receive_json()
+        assert data["server_id"] == server2.id
+        assert data["lines"][0]["line"] == "from server 2"
+
+        websocket.send_json({"action": "unsubscribe",
+                             "server_id": server1.id})
+        websocket.send_json({"action": "subscribe",
+                             "server_id": server1.id, "since": 0})
+        data = websocket.receive_json()
+        assert data["server_id"] == server1.id
+        assert data["lines"][0]["seq"] == 0
+
+
+def test_read_server_events(client: TestClient, session: Session):
+    server1 = create_random_server(session)
+    server2 = create_random_server(session)
+    event_writer.add_line(server1.id, "Notice (all): Alice (Team #1) "
+                          "playing Factorio has joined. Client(0.6.0), [].")
+    event_writer.add_line(server1.id, "Loading multiworld")
+    event_writer.add_line(server1.id, "(Team #1) Alice sent Sword to Bob "
+                          "(Chest)")
+    event_writer.add_line(server2.id, "(Team #1) Bob sent Bow to Alice "
+                          "(Cave)")
+
+    response = client.get(f"/servers/{server1.id}/events")
+    data = response.json()
+    assert response.status_code == 200
+    assert [event["kind"] for event in data] == ["joined", "item_sent"]
+    assert data[0]["game"] == "Factorio"
+
+    response = client.get(f"/servers/{server1.id}/events?kind=item_sent")
+    assert [event["item"] for event in response.json()] == ["Sword"]
+
+    response = client.get("/servers/events?kind=item_sent&player=Bob")
+    data = response.json()
+    assert [(e["server_id"], e["receiver"]) for e in data] == \
+        [(server2.id, "Alice")]
+
+    response = client.get("/servers/events?limit=2")
+    after = response.headers["X-Next-After"]
+    response = client.get(f"/servers/events?after={after}")
+    assert [event["server_id"] for event in response.json()] == \
+        [server2.id]
+
+    client.delete(f"/servers/{server1.id}")
+    response = client.get(f"/servers/events?server_id={server1.id}")
+    assert response.json() == []
+
+
+def test_read_server_logs(client: TestClient, session: Session):
+    server = create_random_server(session)
+    log_store.remove(server.id)
+    for i in range(5):
+        log_store.append(server.id, f"line {i}")
+    log_store.append(server.id, "oops", "stderr")
+
+    response = client.get(f"/servers/{server.id}/logs?tail=2")
+    data = response.json()
+    assert response.status_code == 200
+    assert [(line["stream"], line["line"]) for line in data["lines"]] == \
+        [("stdout", "line 4"), ("stderr", "oops")]
+
+    response = client.get(f"/servers/{server.id}/logs?limit=3")
+    data = response.json()
+    assert [line["line"] for line in data["lines"]] == \
+        ["line 0", "line 1", "line 2"]
+    assert data["truncated"]
+
+    since = data["lines"][2]["at"]
+    response = client.get(f"/servers/{server.id}/logs",
+                          params={"since": since})
+    data = response.json()
+    assert [line["line"] for line in data["lines"]][-1] == "oops"
+    assert not data["truncated"]
+
+    client.delete(f"/servers/{server.id}")
+    assert not log_dir(server.id).exists()
+
+
+def test_search_logs(client: TestClient, session: Session, monkeypatch):
+    monkeypatch.setattr(settings, "SERVER_LOG_SEGMENT_SIZE", 2000)
+    monkeypatch.setattr(settings, "SERVER_LOG_BLOCK_SIZE", 500)
+    server1 = create_random_server(session)
+    server2 = create_random_server(session)
+    for server in [server1, server2]:
+        log_store.remove(server.id)
+    log_store.append(server1.id, "Notice (all): Alice (Team #1) has left "
+                     "the game.")
+    for i in range(100):
+        log_store.append(server1.id, f"(Team #1) Bob sent Item {i} to Carol")
+    log_store.append(server2.id, "Notice (all): Alice (Team #1) has left "
+                     "the game.")
+    log_store.append(server1.id, "Notice (all): Alice (Team #1) has joined.")
+    assert session.exec(select(LogPosting)
+                        .where(LogPosting.server_id == server1.id)).first()
+
+    response = client.get("/servers/logs/search",
+                          params={"q": "alice LEFT"})
+    data = response.json()
+    assert response.status_code == 200
+    assert [hit["server_id"] for hit in data["hits"]] == \
+        [server1.id, server2.id]
+    assert not data["truncated"]
+
+    response = client.get("/servers/logs/search",
+                          params={"q": "Alice", "server_id": server1.id})
+    assert [hit["line"] for hit in response.json()["hits"]] == [
+        "Notice (all): Alice (Team #1) has left the game.",
+        "Notice (all): Alice (Team #1) has joined."
+        ]
+
+    response = client.get("/servers/logs/search",
+                          params={"q": "Bob sent", "limit": 3})
+    data = response.json()
+    assert [hit["line"][-15:] for hit in data["hits"]] == \
+        ["Item 0 to Carol", "Item 1 to Carol", "Item 2 to Carol"]
+    assert data["truncated"]
+
+    response = client.get("/servers/logs/search",
+                          params={"q": "Item 99",
+                                  "since": data["hits"][2]["at"]})
+    assert [hit["line"] for hit in response.json()["hits"]] == \
+        ["(Team #1) Bob sent Item 99 to Carol"]
+
+    response = client.get("/servers/logs/search", params={"q": "..."})
+    assert response.status_code == 422
+
+    client.delete(f"/servers/{server1.id}")
+    response = client.get("/servers/logs/search", params={"q": "alice"})
+    assert [hit["server_id"] for hit in response.json()["hits"]] == \
+        [server2.id]
+    assert not session.exec(select(LogPosting)
+                            .where(LogPosting.server_id == server1.id)
+                            ).first()
+
+
+def test_read_metrics(client: TestClient, session: Session):
+    create_random_server(session)
+    client.get("/servers/")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    lines = response.text.splitlines()
+    assert 'archipelago_servers{state="created"} 1' in lines
+    assert any(line.startswith(
+        'archipelago_db_query_seconds_count{route="/servers/"} ')
+        for line in lines)
+
+
+def test_read_server_resources(client: TestClient, session: Session):
+    server = create_random_server(session)
+    idle = create_random_server(session)
+    state_cache.update(server.id, process_id=os.getpid())
+    resource_sampler.clear()
+    resource_sampler.sample()
+    resource_sampler.sample()
+
+    response = client.get(f"/servers/{server.id}")
+    data = response.json()
+    assert response.status_code == 200
+    assert data["state"] == "created"
+    resources = data["resources"]
+    assert len(resources["history"]) == 2
+    assert resources["history"][0]["cpu_percent"] is None
+    assert resources["current"]["cpu_percent"] >= 0
+    assert resources["current"]["rss_bytes"] > 0
+
+    response = client.get(f"/servers/{idle.id}")
+    assert response.json()["resources"] == {"server_id": idle.id,
+                                            "current": None, "history": []}
+
+    response = client.get("/node/resources")
+    data = response.json()
+    assert response.status_code == 200
+    assert data["servers_sampled"] == 1
+    assert data["rss_bytes"] == resources["current"]["rss_bytes"]
+    assert [s["server_id"] for s in data["servers"]] == [server.id]
+    assert data["memory_total_bytes"] > 0
+
+    state_cache.update(server.id, process_id=None)
+    resource_sampler.sample()
+    assert client.get("/node/resources").json()["servers_sampled"] == 0
+
+
 def test_delete_server(client: TestClient, session: Session):
     server = create_random_server(session)
     response = client.delete(f"/servers/{server.id}")
@@ -51,6 +437,22 @@ def test_delete_server(client: TestClient, session: Session):
     assert db_server is None
 
 
+def test_delete_running_server(client: TestClient, session: Session):
+    server = create_random_server(session)
+    state_cache.update(server.id, state=ServerStateEnum.running)
+    response = client.delete(f"/servers/{server.id}")
+    assert response.status_code == 400
+    assert response.json()["detail"] == \
+        "Server is running, stop it before deleting it"
+    assert client.get(f"/servers/{server.id}").status_code == 200
+
+    state_cache.update(server.id, state=ServerStateEnum.stopped)
+    response = client.delete(f"/servers/{server.id}")
+    assert response.status_code == 200
+    assert server.id not in server_manager.servers
+    assert client.get(f"/servers/{server.id}").status_code == 404
+
+
 def test_delete_server_not_found(client: TestClient, session: Session):
     server = create_random_server(session)
     response = client.delete(f"/servers/{server.id+1}")
@@ -98,6 +500,176 @@ def test_init_server(client: TestClient, session: Session):
     assert data["initialized"] is True
 
 
+def test_init_server_hashes_file(client: TestClient, session: Session):
+    server = create_random_server(session)
+    with open('test_files/test.archipelago', 'rb') as f:
+        expected_hash = hashlib.sha256(f.read()).hexdigest()
+        f.seek(0)
+        file_j = {'archipelago_file': f}
+        response = client.post(f"/servers/{server.id}/init/?overwrite=true",
+                               files=file_j)
+        data = response.json()
+
+    assert response.status_code == 200
+    assert data["archipelago_file_hash"] == expected_hash
+    arch_dir = f"arch_games_dev/{server.id}"
+    assert not any(name.endswith(".part") for name in os.listdir(arch_dir))
+
+
+def test_init_server_file_too_large(client: TestClient, session: Session,
+                                    monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(settings, "ARCHIPELAGO_FILE_MAX_SIZE", 1000)
+    monkeypatch.setattr(settings, "ARCHIPELAGO_FILE_CHUNK_SIZE", 100)
+    server = create_random_server(session)
+    arch_dir = f"arch_games_dev/{server.id}"
+    shutil.rmtree(arch_dir, ignore_errors=True)
+    with open('test_files/test.archipelago', 'rb') as f:
+        file_j = {'archipelago_file': f}
+        response = client.post(f"/servers/{server.id}/init/",
+                               files=file_j)
+        data = response.json()
+
+    assert response.status_code == 413
+    assert data["detail"] == "File too large, max size is 1000 bytes"
+    assert not os.path.exists(arch_dir)
+    assert os.listdir(blob_store.tmp_dir) == []
+    response = client.get(f"/servers/{server.id}")
+    assert response.json()["initialized"] is False
+
+
+def test_init_server_dedupes_by_hash(client: TestClient, session: Session):
+    server1 = create_random_server(session)
+    server2 = create_random_server(session)
+    with open('test_files/test.archipelago', 'rb') as f:
+        file_j = {'archipelago_file': f}
+        response = client.post(f"/servers/{server1.id}/init/?overwrite=true",
+                               files=file_j)
+    file_hash = response.json()["archipelago_file_hash"]
+
+    response = client.post(f"/servers/{server2.id}/init/?overwrite=true"
+                           f"&file_hash={file_hash}")
+    data = response.json()
+
+    assert response.status_code == 200
+    assert data["initialized"] is True
+    assert data["archipelago_file_hash"] == file_hash
+    path1 = f"arch_games_dev/{server1.id}/game.archipelago"
+    path2 = f"arch_games_dev/{server2.id}/game.archipelago"
+    assert os.stat(path1).st_ino == os.stat(path2).st_ino
+
+    client.delete(f"/servers/{server1.id}")
+    assert blob_store.has(file_hash)
+    client.delete(f"/servers/{server2.id}")
+    assert not blob_store.has(file_hash)
+    assert not os.path.exists(path2)
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_init_server_races_release(client_teardown: TestClient,
+                                         session: Session,
+                                         monkeypatch: pytest.MonkeyPatch):
+    server1 = create_random_server(session)
+    server2 = create_random_server(session)
+    with open('test_files/test.archipelago', 'rb') as f:
+        file_j = {'archipelago_file': f}
+        response = client_teardown.post(
+                f"/servers/{server1.id}/init/?overwrite=true", files=file_j
+                )
+    file_hash = response.json()["archipelago_file_hash"]
+
+    link = blob_store.link
+
+    def slow_link(file_hash, destination):
+        time.sleep(0.2)
+        link(file_hash, destination)
+    monkeypatch.setattr(blob_store, "link", slow_link)
+
+    # The last server of the blob goes away while another one is pointed
+    # at it, the blob has to stay for the new one
+    init = asyncio.create_task(
+            local_controller.init_server(server2.id, file_hash)
+            )
+    await asyncio.sleep(0.05)
+    await local_controller.delete_server(server1.id)
+    server = await init
+
+    assert server.archipelago_file_hash == file_hash
+    assert blob_store.has(file_hash)
+    assert not local_controller.game_file_locks
+    await local_controller.delete_server(server2.id)
+    assert not blob_store.has(file_hash)
+
+
+def test_init_server_unknown_hash(client: TestClient, session: Session):
+    server = create_random_server(session)
+    response = client.post(f"/servers/{server.id}/init/?overwrite=true"
+                           f"&file_hash={'0' * 64}")
+    data = response.json()
+
+    assert response.status_code == 404
+    assert data["detail"] == "Unknown file_hash"
+
+
+def test_init_server_hash_mismatch(client: TestClient, session: Session):
+    server = create_random_server(session)
+    with open('test_files/test.archipelago', 'rb') as f:
+        file_j = {'archipelago_file': f}
+        response = client.post(f"/servers/{server.id}/init/?overwrite=true"
+                               f"&file_hash={'0' * 64}",
+                               files=file_j)
+        data = response.json()
+
+    assert response.status_code == 400
+    assert data["detail"] == "Uploaded file does not match file_hash"
+    assert not blob_store.has("0" * 64)
+
+
+def test_init_server_reads_metadata(client: TestClient, session: Session):
+    server = create_random_server(session)
+    with open('test_files/test.archipelago', 'rb') as f:
+        file_j = {'archipelago_file': f}
+        response = client.post(f"/servers/{server.id}/init/?overwrite=true",
+                               files=file_j)
+        data = response.json()
+
+    assert response.status_code == 200
+    metadata = data["archipelago_metadata"]
+    assert metadata["player_count"] == 3
+    assert metadata["seed_name"] == "74697488890569998529"
+    assert metadata["required_server_version"] == "0.5.0"
+    assert "server_password" not in metadata["server_options"]
+    response = client.get(f"/servers/{server.id}")
+    assert response.json()["archipelago_metadata"] == metadata
+
+
+def test_init_server_invalid_file(client: TestClient, session: Session):
+    server = create_random_server(session)
+    response = client.post(f"/servers/{server.id}/init/?overwrite=true",
+                           files={'archipelago_file': b"\x03not multidata"})
+    data = response.json()
+
+    assert response.status_code == 400
+    assert data["detail"] == "Archipelago file is not valid multidata"
+    assert os.listdir(blob_store.tmp_dir) == []
+    response = client.get(f"/servers/{server.id}")
+    assert response.json()["initialized"] is False
+
+
+def test_init_server_unsupported_version(client: TestClient, session: Session,
+                                         monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(settings, "ARCHIPELAGO_VERSION", "0.4.9")
+    server = create_random_server(session)
+    with open('test_files/test.archipelago', 'rb') as f:
+        file_j = {'archipelago_file': f}
+        response = client.post(f"/servers/{server.id}/init/?overwrite=true",
+                               files=file_j)
+        data = response.json()
+
+    assert response.status_code == 400
+    assert data["detail"] == ("Archipelago file requires server version "
+                              "0.5.0, this node runs 0.4.9")
+
+
 def test_init_server_file_already_exists(client: TestClient, session: Session):
     server = create_random_initted_server(session)
     with open('test_files/test.archipelago', 'rb') as f:
@@ -130,6 +702,7 @@ async def test_start_server(client_teardown: TestClient, session: Session,
             "hub_id": 0,
             "game_id": 0,
             }
+    starts = read_start_count(client_teardown)
     response = client_teardown.post(f"/servers/{server.id}/start", json=body)
     data = response.json()
     assert response.status_code == 200
@@ -138,6 +711,11 @@ async def test_start_server(client_teardown: TestClient, session: Session,
 
     started = await server_manager.servers[server.id].wait_for_startup()
     assert started is True
+    notification = await wait_for_notification(session, server.id,
+                                               HubEventEnum.started)
+    assert notification.delivered_at is not None
+    # The hub is told after the start was recorded
+    assert read_start_count(client_teardown) == starts + 1
 
 
 @pytest.mark.asyncio(loop_scope='session')
@@ -146,6 +724,8 @@ async def test_start_server_already_started(client_teardown: TestClient,
     server = create_random_initted_server(session)
 
     _ = await server_manager.servers[server.id].start_wait()
+    state_cache.update(server.id, hub_id=1, game_id=1,
+                       callback_url="http://localhost/running")
 
     body = {
             "callback_url": "http://localhost/test",
@@ -156,6 +736,10 @@ async def test_start_server_already_started(client_teardown: TestClient,
     data = response.json()
     assert response.status_code == 400
     assert data["detail"] == "Not in a startable state, current state: running"
+    # The hub that runs the server keeps getting its notifications
+    cached = state_cache.get(server.id)
+    assert (cached.hub_id, cached.game_id, cached.callback_url) == \
+        (1, 1, "http://localhost/running")
 
 
 def test_start_server_not_found(client_teardown: TestClient,
@@ -192,6 +776,63 @@ async def test_start_server_not_initialized(client_teardown: TestClient,
                               "initialize.")
 
 
+def test_start_server_node_saturated(client_teardown: TestClient,
+                                     session: Session,
+                                     monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(settings, "NODE_MAX_RUNNING_SERVERS", 1)
+    monkeypatch.setattr(settings, "NODE_START_QUEUE_TIMEOUT", 0)
+    running = create_random_server(session)
+    server = create_random_initted_server(session)
+    state_cache.update(running.id, state=ServerStateEnum.running)
+    resource_sampler.clear()
+
+    response = client_teardown.get("/node/capacity")
+    data = response.json()
+    assert response.status_code == 200
+    assert data["active_servers"] == 1
+    assert data["queued_starts"] == 0
+    assert data["sampled_servers"] == 0
+    assert data["server_cpu_percent"] == settings.SERVER_CPU_ESTIMATE
+    assert data["cpu_projected_percent"] == settings.SERVER_CPU_ESTIMATE
+    assert data["memory_projected_bytes"] == settings.SERVER_MEMORY_ESTIMATE
+    assert data["free_slots"] == 0
+    assert data["saturated"] is True
+    assert data["free_ports"] > 0
+
+    body = {
+            "callback_url": "http://localhost/test",
+            "hub_id": 0,
+            "game_id": 0,
+            }
+    response = client_teardown.post(f"/servers/{server.id}/start", json=body)
+    data = response.json()
+    assert response.status_code == 503
+    assert data["detail"] == "The node is at capacity"
+    assert state_cache.get_state(server.id) == ServerStateEnum.created
+
+    state_cache.update(running.id, state=ServerStateEnum.stopped)
+    data = client_teardown.get("/node/capacity").json()
+    assert data["active_servers"] == 0
+    assert data["free_slots"] == 1
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_internal_callbacks_do_not_drop(client_teardown: TestClient,
+                                              session: Session):
+    server = create_random_initted_server(session)
+    sm = server_manager.servers[server.id]
+
+    _ = await sm.start_wait()
+
+    # Output, logs and events must see every line, only prints may drop
+    for dispatcher in [sm.callback_manager.stdout, sm.callback_manager.stderr]:
+        for name, subscriber in dispatcher.subscribers.items():
+            if name not in ["print", "printe"]:
+                assert subscriber.policy == BackpressurePolicyEnum.block
+    response = client_teardown.post(f"/servers/{server.id}/stop")
+    assert response.status_code == 200
+
+
 @pytest.mark.asyncio(loop_scope='session')
 async def test_stop_server(client_teardown: TestClient, session: Session):
     server = create_random_initted_server(session)
@@ -205,6 +846,37 @@ async def test_stop_server(client_teardown: TestClient, session: Session):
     assert data["state"] == ServerStateEnum.stopped
 
 
+@pytest.mark.asyncio(loop_scope='session')
+async def test_stop_server_reaps_process(client_teardown: TestClient,
+                                         session: Session):
+    server = create_random_initted_server(session)
+    sm = server_manager.servers[server.id]
+
+    _ = await sm.start_wait()
+    pid = sm.subprocess.pid
+
+    response = client_teardown.post(f"/servers/{server.id}/stop")
+    assert response.status_code == 200
+    assert sm.subprocess is None
+    assert sm.pidfd is None
+    assert not pid_exists(pid)
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_terminate_server(client_teardown: TestClient,
+                                session: Session):
+    server = create_random_initted_server(session)
+    sm = server_manager.servers[server.id]
+
+    _ = await sm.start_wait()
+    pid = sm.subprocess.pid
+
+    exited = await sm.terminate()
+    assert exited is True
+    assert sm.running is False
+    assert not pid_exists(pid)
+
+
 def test_stop_server_wrong_id(client_teardown: TestClient,
                               session: Session):
     server = create_random_initted_server(session)
@@ -240,6 +912,27 @@ async def test_server_send_cmd(client_teardown: TestClient,
     assert response.status_code == 200
 
 
+@pytest.mark.asyncio(loop_scope='session')
+async def test_server_send_cmd_wait(client_teardown: TestClient,
+                                    session: Session):
+    server = create_random_initted_server(session)
+    _ = await server_manager.servers[server.id].start_wait()
+
+    json = {"cmd": ["/players", "/status"], "wait": True}
+    # The server reads its output on this loop, it must not be blocked
+    response = await asyncio.to_thread(client_teardown.post,
+                                       f"/servers/{server.id}/send_cmd",
+                                       json=json)
+    data = response.json()
+    assert response.status_code == 200
+    assert [result["cmd"] for result in data] == ["/players", "/status"]
+    assert [line["line"] for line in data[0]["lines"]] == \
+        ["0 players of 2 connected"]
+    assert [line["line"] for line in data[1]["lines"]] == \
+        ["Command /status received"]
+    await server_manager.servers[server.id].stop()
+
+
 def test_server_send_cmd_not_started(client_teardown: TestClient,
                                      session: Session):
     server = create_random_initted_server(session)
@@ -263,3 +956,415 @@ def test_server_send_cmd_not_found(client_teardown: TestClient,
     data = response.json()
     assert response.status_code == 404
     assert data["detail"] == "Server not found"
+
+
+def test_init_server_writes_through(client: TestClient, session: Session):
+    server = create_random_server(session)
+    with open('test_files/test.archipelago', 'rb') as f:
+        file_j = {'archipelago_file': f}
+        response = client.post(f"/servers/{server.id}/init/?overwrite=true",
+                               files=file_j)
+
+    assert response.status_code == 200
+    session.expire_all()
+    db_server = session.exec(
+            select(Server).where(Server.id == server.id)
+            ).first()
+    assert db_server.initialized is True
+    assert db_server.archipelago_file_name == "test.archipelago"
+
+
+def test_init_server_not_found(client: TestClient, session: Session):
+    server = create_random_server(session)
+    with open('test_files/test.archipelago', 'rb') as f:
+        file_j = {'archipelago_file': f}
+        response = client.post(f"/servers/{server.id+1}/init/",
+                               files=file_j)
+        data = response.json()
+
+    assert response.status_code == 404
+    assert data["detail"] == "Server not found"
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_read_server_output(client_teardown: TestClient,
+                                  session: Session):
+    server = create_random_initted_server(session)
+
+    _ = await server_manager.servers[server.id].start_wait()
+
+    response = client_teardown.get(f"/servers/{server.id}/output")
+    data = response.json()
+    assert response.status_code == 200
+    assert data["first_seq"] == 0
+    assert data["next_seq"] == len(data["lines"])
+    assert any(line["line"].startswith("server listening")
+               for line in data["lines"])
+
+    response = client_teardown.get(
+            f"/servers/{server.id}/output?since={data['next_seq']}"
+            )
+    data = response.json()
+    assert response.status_code == 200
+    assert data["lines"] == []
+
+
+def test_read_server_output_not_found(client: TestClient, session: Session):
+    server = create_random_server(session)
+    response = client.get(f"/servers/{server.id+1}/output")
+    data = response.json()
+
+    assert response.status_code == 404
+    assert data["detail"] == "Server not found"
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_start_server_exits(client_teardown: TestClient,
+                                  session: Session):
+    server = create_random_initted_server(session)
+    with open(f"arch_games_dev/{server.id}/game.archipelago", "wb") as f:
+        f.write(b"not a multiworld")
+
+    started = await server_manager.servers[server.id].start_wait()
+    assert started is False
+
+    response = client_teardown.get(f"/servers/{server.id}")
+    data = response.json()
+    assert response.status_code == 200
+    assert data["state"] == ServerStateEnum.failed
+    assert data["failure_reason"] == ServerFailureReasonEnum.exited
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_start_server_failure_notifies_hub(client_teardown: TestClient,
+                                                 session: Session,
+                                                 httpx_mock: HTTPXMock):
+    server = create_random_initted_server(session)
+    with open(f"arch_games_dev/{server.id}/game.archipelago", "wb") as f:
+        f.write(b"not a multiworld")
+    # Hubs get the outcome of a start at /started, whether it failed or not
+    httpx_mock.add_response(
+            url="http://localhost/test/hubs/0/games/4/started",
+            json={"ok": True}
+            )
+
+    body = {
+            "callback_url": "http://localhost/test",
+            "hub_id": 0,
+            "game_id": 4,
+            }
+    response = client_teardown.post(f"/servers/{server.id}/start", json=body)
+    assert response.status_code == 200
+
+    notification = await wait_for_notification(session, server.id,
+                                               HubEventEnum.failed)
+    assert notification.delivered_at is not None
+    request_body = json.loads(httpx_mock.get_requests()[-1].content)
+    assert request_body["event"] == HubEventEnum.failed
+    assert request_body["state"] == ServerStateEnum.failed
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_stop_server_notifies_hub(client_teardown: TestClient,
+                                        session: Session,
+                                        httpx_mock: HTTPXMock):
+    server = create_random_initted_server(session)
+    httpx_mock.add_response(
+            url="http://localhost/test/hubs/0/games/1/started",
+            json={"ok": True}
+            )
+    httpx_mock.add_response(
+            url="http://localhost/test/hubs/0/games/1/stopped",
+            json={"ok": True}
+            )
+
+    body = {
+            "callback_url": "http://localhost/test",
+            "hub_id": 0,
+            "game_id": 1,
+            }
+    response = client_teardown.post(f"/servers/{server.id}/start", json=body)
+    assert response.status_code == 200
+    response = client_teardown.post(f"/servers/{server.id}/stop")
+    assert response.status_code == 200
+
+    notification = await wait_for_notification(session, server.id,
+                                               HubEventEnum.stopped)
+    assert notification.delivered_at is not None
+    assert notification.attempts == 0
+    request = httpx_mock.get_requests()[-1]
+    assert request.headers["Idempotency-Key"] == \
+        notification.idempotency_key
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_server_crash_notifies_hub(client_teardown: TestClient,
+                                         session: Session,
+                                         httpx_mock: HTTPXMock):
+    server = create_random_initted_server(session)
+    httpx_mock.add_response(
+            url="http://localhost/test/hubs/0/games/2/started",
+            json={"ok": True}
+            )
+    httpx_mock.add_response(
+            url="http://localhost/test/hubs/0/games/2/crashed",
+            json={"ok": True}
+            )
+
+    body = {
+            "callback_url": "http://localhost/test",
+            "hub_id": 0,
+            "game_id": 2,
+            }
+    response = client_teardown.post(f"/servers/{server.id}/start", json=body)
+    assert response.status_code == 200
+    os.killpg(server_manager.servers[server.id].subprocess.pid,
+              signal.SIGKILL)
+
+    notification = await wait_for_notification(session, server.id,
+                                               HubEventEnum.crashed)
+    assert notification.delivered_at is not None
+    assert notification.failure_reason == ServerFailureReasonEnum.exited
+    response = client_teardown.get(f"/servers/{server.id}")
+    assert response.json()["state"] == ServerStateEnum.failed
+
+    changes = client_teardown.get("/servers/changes?timeout=0").json()
+    assert changes["changes"][-1]["server_id"] == server.id
+    assert changes["changes"][-1]["state"] == ServerStateEnum.failed
+    assert changes["changes"][-1]["failure_reason"] == \
+        ServerFailureReasonEnum.exited
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_start_server_hub_unavailable(client_teardown: TestClient,
+                                            session: Session,
+                                            httpx_mock: HTTPXMock,
+                                            monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(settings, "HUB_CALLBACK_BACKOFF_BASE", 60)
+    server = create_random_initted_server(session)
+    httpx_mock.add_response(
+            url="http://localhost/test/hubs/0/games/3/started",
+            status_code=503
+            )
+
+    body = {
+            "callback_url": "http://localhost/test",
+            "hub_id": 0,
+            "game_id": 3,
+            }
+    response = client_teardown.post(f"/servers/{server.id}/start", json=body)
+    assert response.status_code == 200
+
+    notification = await wait_for_notification(session, server.id,
+                                               HubEventEnum.started,
+                                               delivered=False, attempts=1)
+    assert notification.delivered_at is None
+    assert notification.attempts == 1
+    assert notification.last_error == "HTTP 503"
+    assert notification.gave_up is False
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_notifications_delivered_in_order(
+        client_teardown: TestClient, session: Session, httpx_mock: HTTPXMock,
+        monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(settings, "HUB_CALLBACK_BACKOFF_BASE", 60)
+    server = create_random_initted_server(session)
+    started_url = "http://localhost/test/hubs/0/games/4/started"
+    stopped_url = "http://localhost/test/hubs/0/games/4/stopped"
+    httpx_mock.add_response(url=started_url, status_code=503)
+    httpx_mock.add_response(url=started_url, json={"ok": True})
+    httpx_mock.add_response(url=stopped_url, json={"ok": True})
+
+    body = {
+            "callback_url": "http://localhost/test",
+            "hub_id": 0,
+            "game_id": 4,
+            }
+    response = client_teardown.post(f"/servers/{server.id}/start", json=body)
+    assert response.status_code == 200
+    started = await wait_for_notification(session, server.id,
+                                          HubEventEnum.started,
+                                          delivered=False, attempts=1)
+    assert started.attempts == 1
+    response = client_teardown.post(f"/servers/{server.id}/stop")
+    assert response.status_code == 200
+
+    # The hub could take the stop, but has not heard of the start yet
+    await asyncio.sleep(0.3)
+    stopped = await wait_for_notification(session, server.id,
+                                          HubEventEnum.stopped,
+                                          delivered=False)
+    assert stopped.delivered_at is None
+    assert stopped.attempts == 0
+
+    started.next_attempt_at = datetime.utcnow()
+    session.add(started)
+    session.commit()
+    hub_outbox.kick()
+    stopped = await wait_for_notification(session, server.id,
+                                          HubEventEnum.stopped)
+    assert stopped.delivered_at is not None
+    assert [str(request.url) for request in httpx_mock.get_requests()] == \
+        [started_url, started_url, stopped_url]
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_bulk_start_stop_servers(client_teardown: TestClient,
+                                       session: Session,
+                                       httpx_mock: HTTPXMock):
+    httpx_mock.add_response(json={"ok": True},
+                            is_optional=True, is_reusable=True)
+    server1 = create_random_initted_server(session)
+    server2 = create_random_initted_server(session)
+    server3 = create_random_server(session)
+
+    body = {
+            "callback_url": "http://localhost/test",
+            "hub_id": 0,
+            "servers": [
+                {"server_id": server1.id, "game_id": 10},
+                {"server_id": server2.id, "game_id": 11},
+                {"server_id": server3.id, "game_id": 12},
+                {"server_id": server3.id + 1, "game_id": 13},
+                ]
+            }
+    response = client_teardown.post("/servers/bulk/start", json=body)
+    data = response.json()
+    assert response.status_code == 200
+    assert [result["server_id"] for result in data] == \
+        [server1.id, server2.id, server3.id, server3.id + 1]
+    assert [result["status_code"] for result in data] == [200, 200, 400, 404]
+    assert data[0]["server"]["state"] == ServerStateEnum.running
+    assert data[1]["server"]["state"] == ServerStateEnum.running
+    assert data[3]["detail"] == "Server not found"
+
+    body = {"server_ids": [server1.id, server2.id], "cmd": "/players"}
+    response = client_teardown.post("/servers/bulk/send_cmd", json=body)
+    assert [result["status_code"] for result in response.json()] == \
+        [200, 200]
+
+    body = {"server_ids": [server1.id, server2.id, server3.id]}
+    response = client_teardown.post("/servers/bulk/stop", json=body)
+    data = response.json()
+    assert response.status_code == 200
+    assert [result["status_code"] for result in data] == [200, 200, 400]
+    assert data[0]["server"]["state"] == ServerStateEnum.stopped
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_restarted_node_adopts_running_server(
+        client_teardown: TestClient, session: Session):
+    server = create_random_initted_server(session)
+    sm = server_manager.servers[server.id]
+    _ = await sm.start_wait()
+    pid = sm.subprocess.pid
+    assert state_cache.get(server.id).process_id == pid
+
+    # The node goes away, the server keeps running and writes output
+    await sm.detach()
+    server_manager.servers = {}
+    assert pid_exists(pid)
+    fifo = os.open(stdin_fifo_path(server.id), os.O_WRONLY | os.O_NONBLOCK)
+    os.write(fifo, b"/players\n")
+    os.close(fifo)
+
+    await reinit_server_objects()
+    sm = server_manager.servers[server.id]
+    assert sm.running is True
+    assert sm.subprocess.pid == pid
+
+    # Only what was written while the node was gone is new
+    for _ in range(50):
+        lines = client_teardown.get(f"/servers/{server.id}/output").json()
+        if lines["lines"]:
+            break
+        await asyncio.sleep(0.05)
+    assert [line["line"] for line in lines["lines"]] == \
+        ["0 players of 2 connected"]
+
+    response = client_teardown.post(f"/servers/{server.id}/send_cmd",
+                                    json={"cmd": "/players"})
+    assert response.status_code == 200
+
+    response = client_teardown.post(f"/servers/{server.id}/stop")
+    assert response.json()["state"] == ServerStateEnum.stopped
+    assert not pid_exists(pid)
+    assert state_cache.get(server.id).process_id is None
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_restarted_node_restarts_dead_server(
+        client_teardown: TestClient, session: Session):
+    server = create_random_initted_server(session)
+    # Whatever has this pid now is not the server
+    state_cache.update(server.id, state=ServerStateEnum.running,
+                       process_id=os.getpid())
+    server_manager.servers = {}
+
+    await reinit_server_objects()
+    sm = server_manager.servers[server.id]
+    assert sm.running is True
+    assert sm.subprocess.pid != os.getpid()
+    assert state_cache.get(server.id).process_id == sm.subprocess.pid
+    await sm.stop()
+
+
+def test_remote_controller(client_teardown: TestClient, session: Session,
+                           tmp_path):
+    # The supervisor gets its own loop in a thread, the API talks to it over
+    # the socket like a separate worker would
+    path = str(tmp_path / "supervisor.sock")
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    rpc_server = create_rpc_server(local_controller, path)
+    asyncio.run_coroutine_threadsafe(rpc_server.start(), loop).result()
+    remote = RemoteController(path)
+    app.dependency_overrides[get_controller] = lambda: remote
+    try:
+        response = client_teardown.post("/servers/")
+        assert response.status_code == 200
+        server_id = response.json()["id"]
+
+        with open('test_files/test.archipelago', 'rb') as f:
+            file_j = {'archipelago_file': f}
+            response = client_teardown.post(
+                    f"/servers/{server_id}/init/?overwrite=true",
+                    files=file_j)
+        assert response.status_code == 200
+        assert response.json()["archipelago_metadata"]["player_count"] == 3
+
+        body = {
+                "callback_url": "http://localhost/test",
+                "hub_id": 0,
+                "game_id": 0,
+                }
+        response = client_teardown.post(f"/servers/{server_id}/start",
+                                        json=body)
+        assert response.status_code == 200
+        for _ in range(50):
+            response = client_teardown.get(f"/servers/{server_id}")
+            if response.json()["state"] != ServerStateEnum.starting:
+                break
+            time.sleep(0.05)
+        assert response.json()["state"] == ServerStateEnum.running
+
+        response = client_teardown.get(f"/servers/{server_id}/output")
+        assert response.json()["lines"][-1]["line"].startswith(
+                "server listening")
+        response = client_teardown.post(f"/servers/{server_id}/stop")
+        assert response.json()["state"] == ServerStateEnum.stopped
+
+        response = client_teardown.get(f"/servers/{server_id + 1}")
+        assert response.status_code == 404
+        assert response.json()["detail"] == "Server not found"
+    finally:
+        app.dependency_overrides.clear()
+        asyncio.run_coroutine_threadsafe(rpc_server.stop(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    response = client_teardown.get(f"/servers/{server_id}")
+    assert response.status_code == 200
@@ -0,0 +1,24 @@
+from app.core.config import settings
+from app.utils.asyncserver import AsyncServer
+from app.utils.dispatch import LineDispatcher, BackpressurePolicyEnum
+
+
+class FakeStream():
+    def __init__(self, chunks: list[bytes]):
+        self.chunks = chunks
+
+    async def read(self, size: int) -> bytes:
+        return self.chunks.pop(0) if self.chunks else b""
+
+
+async def test_read_lines_cuts_off_long_lines(monkeypatch):
+    monkeypatch.setattr(settings, "SERVER_READ_MAX_LINE_LENGTH", 10)
+    received = []
+    dispatcher = LineDispatcher(BackpressurePolicyEnum.block, 100)
+    dispatcher.subscribe("lines", received.append)
+    dispatcher.start()
+    stream = FakeStream([b"short\n" + b"x" * 25, b"yy\n"])
+
+    await AsyncServer(1, 0).read_lines(stream, dispatcher, "stdout")
+
+    assert received == ["short", "x" * 10, "x" * 10, "xxxxxyy"]
@@ -0,0 +1,24 @@
+import os
+import time
+from app.utils.blob_store import BlobStore
+
+
+def test_collect_garbage_keeps_recent_uploads(tmp_path):
+    store = BlobStore(tmp_path)
+    referenced = store.blob_path("ab" * 32)
+    unreferenced = store.blob_path("cd" * 32)
+    for blob in [referenced, unreferenced]:
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        blob.write_bytes(b"game")
+    uploading = store.tmp_dir / "upload.part"
+    uploading.write_bytes(b"ga")
+    abandoned = store.tmp_dir / "abandoned.part"
+    abandoned.write_bytes(b"ga")
+    hour_ago = time.time() - 3600
+    os.utime(abandoned, (hour_ago, hour_ago))
+
+    assert store.collect_garbage({"ab" * 32}, 60) == 2
+    assert referenced.exists()
+    assert uploading.exists()
+    assert not unreferenced.exists()
+    assert not abandoned.exists()
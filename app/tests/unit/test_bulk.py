@@ -0,0 +1,20 @@
+import asyncio
+from app.utils.bulk import ConcurrencyLimiter
+
+
+async def test_concurrency_limiter_caps_parallelism():
+    limiter = ConcurrencyLimiter(2)
+    running = 0
+    max_running = 0
+
+    async def work(item: int) -> int:
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return item * 2
+
+    results = await limiter.map(work, range(6))
+    assert results == [0, 2, 4, 6, 8, 10]
+    assert max_running == 2
@@ -0,0 +1,71 @@
+import asyncio
+import pytest
+from app.core.config import settings
+from app.models.servers import ServerStateEnum
+from app.utils import capacity
+from app.utils.change_feed import ServerChangeFeed
+
+
+class FakeCapacity():
+    """
+    Hands out every free slot once, like a start that was let through
+    takes its slot
+    """
+    def __init__(self):
+        self.slots = 0
+
+    def __call__(self):
+        return self
+
+    @property
+    def free_slots(self) -> int:
+        free = self.slots
+        self.slots = max(0, self.slots - 1)
+        return free
+
+
+async def test_admission_queues_in_order(monkeypatch):
+    feed = ServerChangeFeed(10)
+    free = FakeCapacity()
+    monkeypatch.setattr(capacity, "change_feed", feed)
+    monkeypatch.setattr(capacity, "capacity", free)
+    monkeypatch.setattr(settings, "NODE_START_QUEUE_TIMEOUT", 5)
+    admission = capacity.AdmissionController()
+
+    first = asyncio.create_task(admission.admit())
+    await asyncio.sleep(0.01)
+    second = asyncio.create_task(admission.admit())
+    await asyncio.sleep(0.01)
+    assert len(admission.queue) == 2
+
+    # A server stopping frees a slot, which goes to the first in line
+    free.slots = 1
+    feed.publish(1, ServerStateEnum.stopped)
+    await asyncio.wait_for(first, 1)
+    assert not second.done()
+    assert len(admission.queue) == 1
+
+    free.slots = 1
+    feed.publish(2, ServerStateEnum.stopped)
+    await asyncio.wait_for(second, 1)
+    assert not admission.queue
+
+
+async def test_admission_rejects(monkeypatch):
+    free = FakeCapacity()
+    monkeypatch.setattr(capacity, "change_feed", ServerChangeFeed(10))
+    monkeypatch.setattr(capacity, "capacity", free)
+    admission = capacity.AdmissionController()
+
+    monkeypatch.setattr(settings, "NODE_START_QUEUE_TIMEOUT", 0)
+    with pytest.raises(capacity.NodeSaturatedException):
+        await admission.admit()
+
+    monkeypatch.setattr(settings, "NODE_START_QUEUE_TIMEOUT", 0.05)
+    with pytest.raises(capacity.NodeSaturatedException):
+        await admission.admit()
+    assert not admission.queue
+
+    monkeypatch.setattr(settings, "NODE_START_QUEUE_SIZE", 0)
+    free.slots = 1
+    await admission.admit()
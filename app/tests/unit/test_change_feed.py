@@ -0,0 +1,35 @@
+import asyncio
+from app.models.servers import ServerStateEnum
+from app.utils.change_feed import ServerChangeFeed
+
+
+async def test_change_feed_since():
+    feed = ServerChangeFeed(3)
+    for server_id in range(1, 5):
+        feed.publish(server_id, ServerStateEnum.running)
+
+    changes = feed.since(2)
+    assert changes.version == 4
+    assert not changes.reset
+    assert [c.server_id for c in changes.changes] == [3, 4]
+    # Change 1 was pushed out, so changes after version 0 are incomplete
+    assert not feed.since(1).reset
+    assert feed.since(0).reset
+    assert feed.since(4).changes == []
+    assert feed.since(5).reset
+    assert feed.since(2, "other epoch").reset
+    assert not feed.since(2, feed.epoch).reset
+
+
+async def test_change_feed_wait():
+    feed = ServerChangeFeed(10)
+    waiter = asyncio.create_task(feed.wait(0, timeout=5))
+    await asyncio.sleep(0.01)
+    assert not waiter.done()
+    feed.publish(1, ServerStateEnum.starting)
+    changes = await asyncio.wait_for(waiter, 1)
+    assert [c.state for c in changes.changes] == [ServerStateEnum.starting]
+
+    changes = await feed.wait(changes.version, timeout=0.01)
+    assert changes.changes == []
+    assert changes.version == 1
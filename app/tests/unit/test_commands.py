@@ -0,0 +1,55 @@
+import asyncio
+from app.utils.commands import CommandQueue
+from app.utils.output_buffer import OutputRingBuffer
+
+
+class EchoServer():
+    """
+    Answers every command with one line per word, a little later
+    """
+    def __init__(self):
+        self.output = OutputRingBuffer(100, 100)
+        self.writes = []
+
+    async def write(self, cmds: list[str]):
+        self.writes.append(cmds)
+        asyncio.get_running_loop().call_later(0.01, self.answer, cmds)
+
+    def answer(self, cmds: list[str]):
+        for cmd in cmds:
+            for word in cmd.split():
+                self.output.append(word)
+
+
+async def test_command_queue_collects_responses():
+    server = EchoServer()
+    queue = CommandQueue(server.write, server.output)
+    results = await queue.send(["a b", "c"], wait=True, quiet_period=0.05)
+    assert [[line.line for line in r.lines] for r in results] == \
+        [["a", "b"], ["c"]]
+    assert not any(r.timed_out for r in results)
+    # One write per command, the next only after the response
+    assert server.writes == [["a b"], ["c"]]
+
+
+async def test_command_queue_batches_unawaited_commands():
+    server = EchoServer()
+    queue = CommandQueue(server.write, server.output)
+    assert await queue.send(["a", "b", "c"]) is None
+    assert server.writes == [["a", "b", "c"]]
+
+
+async def test_command_queue_timeout():
+    server = EchoServer()
+    queue = CommandQueue(server.write, server.output)
+
+    async def chatty():
+        for i in range(20):
+            server.output.append(f"line {i}")
+            await asyncio.sleep(0.01)
+    task = asyncio.create_task(chatty())
+    results = await queue.send(["x"], wait=True, quiet_period=0.05,
+                               timeout=0.1)
+    await task
+    assert results[0].timed_out
+    assert 0 < len(results[0].lines) < 20
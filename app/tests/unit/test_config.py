@@ -0,0 +1,18 @@
+from app.core.config import Settings, PostgresSettings
+
+
+def test_database_uris_postgres():
+    settings = Settings(DB_BACKEND="postgres",
+                        POSTGRES=PostgresSettings(SERVER="db", USER="node",
+                                                  PASSWORD="pw", DB="ap"))
+    assert str(settings.SQLALCHEMY_DATABASE_URI) == \
+        "postgresql+psycopg://node:pw@db:5432/ap"
+    assert str(settings.SQLALCHEMY_ASYNC_DATABASE_URI) == \
+        "postgresql+asyncpg://node:pw@db:5432/ap"
+
+
+def test_database_uris_sqlite():
+    settings = Settings(DB_BACKEND="sqlite", SQLITE_FILE_NAME="node.db")
+    assert str(settings.SQLALCHEMY_DATABASE_URI) == "sqlite:///node.db"
+    assert str(settings.SQLALCHEMY_ASYNC_DATABASE_URI) == \
+        "sqlite+aiosqlite:///node.db"
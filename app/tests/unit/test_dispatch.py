@@ -0,0 +1,96 @@
+import asyncio
+from app.utils.dispatch import LineDispatcher, BackpressurePolicyEnum
+
+
+async def test_dispatch_in_order():
+    received = []
+    dispatcher = LineDispatcher(BackpressurePolicyEnum.block, 2)
+    dispatcher.subscribe("sync", received.append)
+    dispatcher.start()
+    for i in range(10):
+        await dispatcher.publish(str(i))
+    await dispatcher.close(timeout=1)
+
+    assert received == [str(i) for i in range(10)]
+
+
+async def test_dispatch_slow_subscriber_drops_oldest():
+    received = []
+    fast = []
+    release = asyncio.Event()
+
+    async def slow(line):
+        await release.wait()
+        received.append(line)
+
+    dispatcher = LineDispatcher(BackpressurePolicyEnum.drop_oldest, 3)
+    dispatcher.subscribe("slow", slow)
+    dispatcher.subscribe("fast", fast.append, BackpressurePolicyEnum.block)
+    dispatcher.start()
+    await dispatcher.publish("0")
+    await asyncio.sleep(0)  # Let slow pick up the first line
+    for i in range(1, 10):
+        await dispatcher.publish(str(i))
+    await asyncio.sleep(0)
+    release.set()
+    await dispatcher.close(timeout=1)
+
+    assert received == ["0", "7", "8", "9"]
+    assert dispatcher.subscribers["slow"].dropped == 6
+    assert fast == [str(i) for i in range(10)]
+
+
+async def test_dispatch_coalesce_keeps_newest():
+    received = []
+    release = asyncio.Event()
+
+    async def slow(line):
+        await release.wait()
+        received.append(line)
+
+    dispatcher = LineDispatcher(BackpressurePolicyEnum.coalesce, 2)
+    dispatcher.subscribe("slow", slow)
+    dispatcher.start()
+    await dispatcher.publish("0")
+    await asyncio.sleep(0)
+    for i in range(1, 10):
+        await dispatcher.publish(str(i))
+    release.set()
+    await dispatcher.close(timeout=1)
+
+    assert received == ["0", "9"]
+
+
+async def test_dispatch_callback_errors_are_contained():
+    received = []
+
+    def broken(line):
+        raise ValueError(line)
+
+    dispatcher = LineDispatcher(BackpressurePolicyEnum.block, 10)
+    dispatcher.subscribe("broken", broken)
+    dispatcher.subscribe("ok", received.append)
+    dispatcher.start()
+    await dispatcher.publish("a")
+    await dispatcher.publish("b")
+    await dispatcher.close(timeout=1)
+
+    assert received == ["a", "b"]
+
+
+async def test_dispatch_measures_queue_wait():
+    async def slow(line):
+        await asyncio.sleep(0.05)
+
+    dispatcher = LineDispatcher(BackpressurePolicyEnum.block, 10)
+    dispatcher.subscribe("slow_wait", slow)
+    dispatcher.start()
+    for i in range(3):
+        await dispatcher.publish(str(i))
+    await dispatcher.close(timeout=1)
+
+    # The lines behind a slow callback wait for it, the first one does not
+    subscriber = dispatcher.subscribers["slow_wait"]
+    assert sum(subscriber.wait_seconds.counts) == 3
+    assert subscriber.wait_seconds.sum >= 0.1
+    assert subscriber.seconds.sum >= 0.1
@@ -0,0 +1,41 @@
+from app.models.events import ServerEventKindEnum
+from app.utils.events import classify_line
+
+
+def test_classify_line():
+    assert classify_line(
+            "Notice (all): Alice (Team #1) playing A Link to the Past has "
+            "joined. Client(0.6.0), ['AP']."
+            ) == (ServerEventKindEnum.joined,
+                  {"player": "Alice", "game": "A Link to the Past"})
+    assert classify_line(
+            "Notice (all): Alice (Team #1) has left the game. "
+            "Client(0.6.0), ['AP']."
+            ) == (ServerEventKindEnum.left, {"player": "Alice"})
+    assert classify_line(
+            "Notice (all): Bob (Team #1) has completed their goal."
+            ) == (ServerEventKindEnum.goal, {"player": "Bob"})
+    assert classify_line(
+            "(Team #1) Alice sent Progressive Sword to Bob (Link's House)"
+            ) == (ServerEventKindEnum.item_sent,
+                  {"player": "Alice", "receiver": "Bob",
+                   "item": "Progressive Sword", "location": "Link's House"})
+    assert classify_line(
+            "Notice (Team #1): [Hint]: Alice's Hookshot is at Chest in "
+            "Bob's World. (found)"
+            ) == (ServerEventKindEnum.hint,
+                  {"player": "Bob", "receiver": "Alice", "item": "Hookshot",
+                   "location": "Chest"})
+    assert classify_line("Notice (all): Alice: gg") == \
+        (ServerEventKindEnum.chat, {"player": "Alice"})
+    assert classify_line("Traceback (most recent call last):") == \
+        (ServerEventKindEnum.error, {})
+    assert classify_line("anything", "stderr") == \
+        (ServerEventKindEnum.error, {})
+
+
+def test_classify_line_ignores_other_lines():
+    assert classify_line("server listening on 0.0.0.0:38281") is None
+    assert classify_line("Loading multiworld") is None
+    assert classify_line("Notice (all): [Server]: restarting soon") is None
+    assert classify_line("(Team #1) something else") is None
@@ -0,0 +1,90 @@
+import time
+from app.core.config import settings
+from app.utils.log_store import (
+        LogRecord,
+        ServerLog,
+        block_tokens,
+        tokenize
+        )
+
+
+def fill(log: ServerLog, count: int, start: float) -> list[LogRecord]:
+    records = [LogRecord(start + i, "stderr" if i % 10 == 0 else "stdout",
+                         f"line {i}")
+               for i in range(count)]
+    for record in records:
+        log.append(record)
+        log.flush()
+    return records
+
+
+def test_server_log_rotates_and_reads_ranges(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "SERVER_LOG_SEGMENT_SIZE", 1000)
+    monkeypatch.setattr(settings, "SERVER_LOG_BLOCK_SIZE", 200)
+    monkeypatch.setattr(settings, "SERVER_LOG_INDEX_INTERVAL", 100)
+    log = ServerLog(tmp_path / "logs")
+    start = time.time()
+    records = fill(log, 200, start)
+    log.append(LogRecord(start + 200, "stdout", "not written yet"))
+    records.append(log.pending[-1])
+
+    assert len(log.segments) > 1
+    assert all(len(segment.blocks) > 1 for segment in log.segments)
+    assert log.read(None, None, 1000) == records
+    assert log.read(start + 50, start + 60, 1000) == records[50:60]
+    assert log.read(start + 190, None, 5) == records[190:195]
+    assert log.read(start + 195, None, 1000) == records[195:]
+    assert log.tail(1) == records[-1:]
+    assert log.tail(150) == records[-150:]
+    assert log.tail(1000) == records
+
+    # A new instance finds everything that was written
+    log.flush()
+    reloaded = ServerLog(tmp_path / "logs")
+    assert reloaded.read(None, None, 1000) == records
+    assert reloaded.tail(30) == records[-30:]
+
+
+def test_server_log_retention(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "SERVER_LOG_SEGMENT_SIZE", 1000)
+    log = ServerLog(tmp_path / "logs")
+    fill(log, 100, time.time() - 3600)
+    segments = len(log.segments)
+    assert segments > 1
+
+    monkeypatch.setattr(settings, "SERVER_LOG_MAX_BYTES",
+                        log.segments[-1].size)
+    log.enforce_retention()
+    assert len(log.segments) == 1
+
+    monkeypatch.setattr(settings, "SERVER_LOG_RETENTION", 60)
+    log.enforce_retention()
+    assert log.segments == []
+    assert list((tmp_path / "logs").glob("*.seg")) == []
+
+
+def test_block_tokens():
+    assert tokenize("Notice (all): Alice (Team #1) has left the game.") == \
+        {"notice", "all", "alice", "team", "1", "has", "left", "the", "game"}
+    blocks = [[LogRecord(0, "stdout", "Alice sent Sword to Bob")],
+              [LogRecord(1, "stdout", "Bob sent Bow to Alice")]]
+    postings = block_tokens(blocks)
+    assert postings["alice"] == [0, 1]
+    assert postings["sword"] == [0]
+    assert postings["bow"] == [1]
+
+
+def test_server_log_indexes_active_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "SERVER_LOG_INDEX_INTERVAL", 50)
+    log = ServerLog(tmp_path / "logs")
+    for line in ["Alice joined", "Bob joined", "Alice left", "Bob left"]:
+        log.append(LogRecord(time.time(), "stdout", line))
+        log.flush()
+    chunks = [chunk for _, chunk in log.active_chunks({"alice"})]
+    assert [record.line for chunk in chunks
+            for record in log.read_active_chunk(chunk)
+            if "Alice" in record.line] == ["Alice joined", "Alice left"]
+    assert len(log.active_index) > 1
+    assert log.active_chunks({"carol"}) == []
+    assert ServerLog(tmp_path / "logs").active_chunks({"alice"}) == \
+        log.active_chunks({"alice"})
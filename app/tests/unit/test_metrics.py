@@ -0,0 +1,59 @@
+from app.utils.metrics import (
+        Counter,
+        Gauge,
+        Histogram,
+        Registry,
+        merge_families,
+        render
+        )
+
+
+def test_render_metrics():
+    registry = Registry()
+    lines = registry.register(Counter("lines_total", "Lines", ("stream",)))
+    servers = registry.register(Gauge("servers", "Servers", ("state",),
+                                      lambda: {("running",): 2}))
+    seconds = registry.register(Histogram("seconds", "Seconds", (),
+                                          (0.1, 1.0)))
+    stdout = lines.labels("stdout")
+    stdout.inc(3)
+    stdout.inc()
+    lines.labels('a"b').inc()
+    seconds.observe(0.05)
+    seconds.observe(0.5)
+    seconds.observe(5)
+
+    assert servers.collect().samples[0].value == 2
+    assert render(registry.collect()).splitlines() == [
+        "# HELP lines_total Lines",
+        "# TYPE lines_total counter",
+        'lines_total{stream="stdout"} 4',
+        'lines_total{stream="a\\"b"} 1',
+        "# HELP servers Servers",
+        "# TYPE servers gauge",
+        'servers{state="running"} 2',
+        "# HELP seconds Seconds",
+        "# TYPE seconds histogram",
+        'seconds_bucket{le="0.1"} 1',
+        'seconds_bucket{le="1"} 2',
+        'seconds_bucket{le="+Inf"} 3',
+        "seconds_sum 5.55",
+        "seconds_count 3",
+        ]
+
+
+def test_merge_families():
+    worker = Registry()
+    supervisor = Registry()
+    for registry, route in [(worker, "/servers"), (supervisor, "rpc:x")]:
+        queries = registry.register(Counter("queries_total", "Queries",
+                                            ("route",)))
+        queries.labels(route).inc()
+        queries.labels("background").inc(2)
+
+    merged = merge_families(worker.collect(), supervisor.collect())
+    assert [(sample.labels["route"], sample.value)
+            for sample in merged[0].samples] == \
+        [("/servers", 1), ("background", 4), ("rpc:x", 1)]
+    # The families merged from are left as they were
+    assert worker.collect()[0].samples[1].value == 2
@@ -0,0 +1,34 @@
+import os
+import pickle
+import zlib
+import pytest
+from pathlib import Path
+from app.utils.multidata import read_metadata, InvalidArchipelagoFileException
+
+
+def test_read_metadata():
+    metadata = read_metadata(Path("test_files/test.archipelago"))
+
+    assert metadata.format_version == 3
+    assert metadata.player_count == 3
+    assert metadata.games == ["Dark Souls III", "Noita", "Ratchet & Clank 2"]
+    assert metadata.required_server_version == "0.5.0"
+    assert "server_password" not in metadata.server_options
+
+
+def test_read_metadata_rejects_newer_format(tmp_path: Path):
+    path = tmp_path / "game.archipelago"
+    path.write_bytes(bytes([4]) + zlib.compress(pickle.dumps({})))
+
+    with pytest.raises(InvalidArchipelagoFileException,
+                       match="Unsupported multidata format version 4"):
+        read_metadata(path)
+
+
+def test_read_metadata_rejects_unknown_globals(tmp_path: Path):
+    path = tmp_path / "game.archipelago"
+    path.write_bytes(bytes([3]) + zlib.compress(pickle.dumps(os.getcwd)))
+
+    with pytest.raises(InvalidArchipelagoFileException,
+                       match="is not allowed"):
+        read_metadata(path)
@@ -0,0 +1,15 @@
+from app.utils.output_buffer import OutputRingBuffer
+
+
+def test_output_ring_buffer_overwrites_oldest():
+    output = OutputRingBuffer(capacity=3, max_line_length=4)
+    for i in range(5):
+        output.append(f"line{i}")
+
+    data = output.since(0)
+    assert data.first_seq == 2
+    assert data.next_seq == 5
+    assert [line.seq for line in data.lines] == [2, 3, 4]
+    assert [line.line for line in data.lines] == ["line", "line", "line"]
+    assert [line.seq for line in output.tail(2).lines] == [3, 4]
+    assert [line.seq for line in output.since(3, limit=1).lines] == [3]
@@ -0,0 +1,53 @@
+import asyncio
+import pytest
+from sqlmodel import Session
+from app.utils.controller import local_controller
+from app.utils.output_stream import OutputViewer, SlowViewerException
+from app.utils.server_utils import server_manager
+from app.tests.utils.creators import create_random_server
+
+
+async def test_output_viewer_replays_and_follows(session: Session):
+    server = create_random_server(session)
+    output = server_manager.servers[server.id].output
+    output.append("line0")
+    output.append("line1")
+    viewer = OutputViewer(local_controller)
+    await viewer.subscribe(server.id, since=1)
+    try:
+        batch = await asyncio.wait_for(viewer.get(), 1)
+        assert [line.line for line in batch.lines] == ["line1"]
+        assert batch.skipped == 0
+
+        output.append("line2", "stderr")
+        batch = await asyncio.wait_for(viewer.get(), 1)
+        assert batch.server_id == server.id
+        assert [(line.seq, line.stream) for line in batch.lines] == \
+            [(2, "stderr")]
+    finally:
+        viewer.close()
+
+
+async def test_output_viewer_disconnects_slow_viewer(session: Session):
+    server = create_random_server(session)
+    output = server_manager.servers[server.id].output
+    viewer = OutputViewer(local_controller, queue_size=2, batch_lines=1)
+    await viewer.subscribe(server.id)
+    for i in range(3):
+        output.append(f"line{i}")
+        await asyncio.sleep(0.01)
+    with pytest.raises(SlowViewerException):
+        await asyncio.wait_for(viewer.get(), 1)
+    assert viewer.tasks == {}
+
+
+async def test_output_viewer_server_sent_events(session: Session):
+    server = create_random_server(session)
+    output = server_manager.servers[server.id].output
+    output.append("hello")
+    viewer = OutputViewer(local_controller)
+    await viewer.subscribe(server.id, since=0)
+    events = viewer.stream_events()
+    assert await anext(events) == "id: 0\nevent: stdout\ndata: hello\n\n"
+    await events.aclose()
+    assert viewer.tasks == {}
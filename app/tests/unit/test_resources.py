@@ -0,0 +1,15 @@
+import os
+from app.utils.resources import read_memory, read_process
+
+
+def test_read_process():
+    stat = read_process(os.getpid())
+    assert stat.rss_bytes > 0
+    assert stat.open_fds > 0
+    assert read_process(os.getpid()).start_ticks == stat.start_ticks
+    assert read_process(2 ** 22 + 1) is None
+
+
+def test_read_memory():
+    total, available = read_memory()
+    assert total >= available > 0
@@ -0,0 +1,74 @@
+import asyncio
+import os
+import stat
+from pathlib import Path
+import pytest
+from app.utils.rpc import (
+        RpcServer,
+        RpcClient,
+        RpcException,
+        RpcConnectionException
+        )
+
+
+async def test_rpc_calls_are_multiplexed(tmp_path: Path):
+    path = str(tmp_path / "rpc.sock")
+    release = asyncio.Event()
+
+    async def slow(value: int) -> int:
+        await release.wait()
+        return value
+
+    def fast(value: int) -> dict:
+        return {"value": value}
+
+    server = RpcServer(path, {"slow": slow, "fast": fast})
+    await server.start()
+    client = RpcClient(path)
+    try:
+        slow_call = asyncio.create_task(client.call("slow", value=1))
+        assert await client.call("fast", value=2) == {"value": 2}
+        assert not slow_call.done()
+        release.set()
+        assert await slow_call == 1
+    finally:
+        await client.close()
+        await server.stop()
+
+
+async def test_rpc_errors(tmp_path: Path):
+    path = str(tmp_path / "rpc.sock")
+
+    def fail():
+        raise RpcException(409, "Conflict")
+
+    server = RpcServer(path, {"fail": fail})
+    await server.start()
+    client = RpcClient(path)
+    try:
+        with pytest.raises(RpcException) as e:
+            await client.call("fail")
+        assert e.value.status_code == 409
+        assert e.value.detail == "Conflict"
+        with pytest.raises(RpcException) as e:
+            await client.call("missing")
+        assert e.value.status_code == 404
+    finally:
+        await client.close()
+        await server.stop()
+
+    with pytest.raises(RpcConnectionException):
+        await client.call("fail")
+
+
+async def test_rpc_socket_is_owner_only(tmp_path: Path):
+    path = tmp_path / "rpc.sock"
+    server = RpcServer(str(path), {})
+    umask = os.umask(0o022)
+    try:
+        await server.start()
+        assert stat.S_IMODE(path.stat().st_mode) == 0o600
+        assert os.umask(0o022) == 0o022
+    finally:
+        os.umask(umask)
+        await server.stop()
@@ -0,0 +1,58 @@
+import asyncio
+import os
+from app.core.config import settings
+from app.utils.server_process import LogTailer, load_offset, offset_path
+
+
+async def test_log_tailer_wakes_up_on_writes(tmp_path, monkeypatch):
+    # Only inotify can wake the tailer up in time
+    monkeypatch.setattr(settings, "SERVER_LOG_POLL_INTERVAL", 60)
+    path = tmp_path / "stdout.log"
+    path.write_bytes(b"")
+    exited = False
+    tailer = LogTailer(path, lambda: exited)
+
+    read = asyncio.create_task(tailer.read(100))
+    await asyncio.sleep(0.01)
+    assert not read.done()
+    with open(path, "ab") as f:
+        f.write(b"server listening\n")
+    assert await asyncio.wait_for(read, 1) == b"server listening\n"
+
+    read = asyncio.create_task(tailer.read(100))
+    await asyncio.sleep(0.01)
+    exited = True
+    # The process closing the file is what a tailer sees of an exit
+    with open(path, "ab"):
+        pass
+    assert await asyncio.wait_for(read, 1) == b""
+    assert tailer.fd is None
+    # Nothing writes anymore, everything was read
+    assert path.stat().st_size == 0
+    assert not offset_path(path).exists()
+
+
+async def test_log_tailer_frees_and_resumes(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "SERVER_LOG_RECLAIM_SIZE", 8192)
+    path = tmp_path / "stdout.log"
+    line = b"x" * 1023 + b"\n"
+    path.write_bytes(line * 64 + b"partial")
+    tailer = LogTailer(path, lambda: False)
+
+    read = 0
+    while read < 64 * 1024:
+        read += len(await tailer.read(4096))
+    # Asking for more consumes what was read, up to the last full line
+    task = asyncio.create_task(tailer.read(4096))
+    assert await asyncio.wait_for(task, 1) == b"partial"
+    assert load_offset(path) == 64 * 1024
+    assert os.stat(path).st_blocks * 512 < 64 * 1024
+    assert path.stat().st_size == 64 * 1024 + len(b"partial")
+
+    # A node that stops reading saves where, the next one resumes there
+    tailer.close()
+    with open(path, "ab") as f:
+        f.write(b" line\n")
+    tailer = LogTailer(path, lambda: False, load_offset(path))
+    assert await tailer.read(4096) == b"partial line\n"
+    tailer.close()
@@ -0,0 +1,86 @@
+import asyncio
+from sqlalchemy import event, text
+from sqlmodel import Session, select
+from app.db import session_handler
+from app.models.notifications import HubNotification, HubEventEnum
+from app.models.servers import Server, ServerCreateInternal, ServerStateEnum
+from app.utils.outbox import hub_outbox
+from app.utils.state_cache import state_cache
+from app.tests.utils.creators import create_random_server
+
+
+def count_commits(engine) -> list:
+    commits = []
+    event.listen(engine, "commit", lambda conn: commits.append(conn))
+    return commits
+
+
+def test_sqlite_pragmas(session: Session):
+    connection = session.connection()
+    journal_mode = connection.execute(text("PRAGMA journal_mode")).scalar()
+    synchronous = connection.execute(text("PRAGMA synchronous")).scalar()
+    assert journal_mode == "wal"
+    assert synchronous == 1  # NORMAL
+
+
+async def test_writer_coalesces_writes(session: Session):
+    server = create_random_server(session)
+    commits = count_commits(session_handler.engine)
+    writer = asyncio.create_task(state_cache.run_writer(0.05, 5))
+    try:
+        await asyncio.sleep(0)
+        for state in [ServerStateEnum.starting, ServerStateEnum.running,
+                      ServerStateEnum.stopped]:
+            state_cache.update(server.id, state=state)
+        assert len(commits) == 0
+        await asyncio.sleep(0.2)
+    finally:
+        writer.cancel()
+        await asyncio.gather(writer, return_exceptions=True)
+
+    assert len(commits) == 1
+    session.expire_all()
+    assert session.get(Server, server.id).state == ServerStateEnum.stopped
+
+
+async def test_notification_written_with_state(session: Session):
+    server = create_random_server(session)
+    state_cache.update(server.id, hub_id=1, game_id=2,
+                       callback_url="http://localhost/test")
+    writer = asyncio.create_task(state_cache.run_writer(0.05, 10))
+    try:
+        await asyncio.sleep(0)
+        commits = count_commits(session_handler.engine)
+        state_cache.update(server.id, state=ServerStateEnum.running)
+        notification = hub_outbox.enqueue(server.id, HubEventEnum.started)
+        # Written behind with the state, not right away
+        assert len(commits) == 0
+        await asyncio.sleep(0.2)
+    finally:
+        writer.cancel()
+        await asyncio.gather(writer, return_exceptions=True)
+
+    assert len(commits) == 1
+    assert notification.id is not None
+    session.expire_all()
+    assert session.get(Server, server.id).state == ServerStateEnum.running
+    assert session.exec(select(HubNotification)).one().server_id == server.id
+
+
+async def test_fetch_finds_rows_created_elsewhere(session: Session):
+    server = Server.model_validate(ServerCreateInternal(address="localhost",
+                                                        port=38000))
+    session.add(server)
+    session.commit()
+    session.refresh(server)
+
+    # Reads on the loop never go to the DB
+    assert state_cache.get(server.id) is None
+    try:
+        fetched = await state_cache.fetch(server.id)
+        assert fetched.port == 38000
+        assert state_cache.get(server.id) is fetched
+        assert await state_cache.fetch(server.id + 1) is None
+    finally:
+        # Its connections belong to this loop
+        await session_handler.dispose()
@@ -3,6 +3,7 @@ from sqlmodel import Session
 from app.models.servers import Server, ServerCreateInternal
 from app.utils.server_utils import port_handler, server_manager
 from app.utils.asyncserver import AsyncServer
+from app.utils.state_cache import state_cache
 
 
 def create_random_server(session: Session) -> Server:
@@ -14,6 +15,7 @@ def create_random_server(session: Session) -> Server:
     session.add(db_server)
     session.commit()
     session.refresh(db_server)
+    state_cache.add(db_server)
     sm = AsyncServer(db_server.id, db_server.port)
     server_manager.servers[db_server.id] = sm
     return db_server
@@ -32,4 +34,5 @@ def create_random_initted_server(session: Session) -> Server:
     session.add(db_server)
     session.commit()
     session.refresh(db_server)
+    state_cache.add(db_server)
     return db_server
@@ -1,15 +1,56 @@
 import asyncio
+import codecs
 import logging
-from typing import Callable
-from pathlib import Path
+import os
+import signal
+import time
 from pydantic import BaseModel, ConfigDict
+from app.models.notifications import HubEventEnum, HubNotification
 from app.models.servers import (
-        Server,
+        CommandResult,
         ServerStateEnum,
+        ServerFailureReasonEnum,
         ServerWrongStateException,
         ServerNotInitializedException
         )
-from app.db import session_handler
+from app.core.config import settings
+from app.utils.commands import CommandQueue
+from app.utils.events import event_writer
+from app.utils.log_store import log_store
+from app.utils.dispatch import (
+        LineDispatcher,
+        LineCallback,
+        BackpressurePolicyEnum
+        )
+from app.utils.files import (
+        game_file_path,
+        stdout_log_path,
+        stderr_log_path,
+        stdin_fifo_path
+        )
+from app.utils.metrics import (
+        server_start_seconds,
+        server_stop_seconds,
+        server_output_lines,
+        server_output_bytes
+        )
+from app.utils.output_buffer import OutputRingBuffer
+from app.utils.outbox import hub_outbox
+from app.utils.process import (
+        open_pidfd,
+        has_exited,
+        read_cmdline,
+        wait_for_exit,
+        poll_for_exit,
+        signal_process_group
+        )
+from app.utils.server_process import (
+        LogTailer,
+        ServerProcess,
+        attach_server_process,
+        spawn_server_process
+        )
+from app.utils.state_cache import state_cache
 
 
 logging.basicConfig(level=logging.INFO)
@@ -22,10 +63,8 @@ class ProcessNotRunningException(Exception):
 
 class CallbackManager(BaseModel):
     model_config = ConfigDict(arbitrary_types_allowed=True)
-    callbacks: dict[str, Callable[[str], None]] = {}
-    async_callbacks: dict[str, Callable[[str], None]] = {}
-    callbacks_err: dict[str, Callable[[str], None]] = {}
-    async_callbacks_err: dict[str, Callable[[str], None]] = {}
+    stdout: LineDispatcher
+    stderr: LineDispatcher
 
 
 class AsyncServer():
@@ -33,68 +72,81 @@ class AsyncServer():
         self.server_id = server_id
         self.port = port
         self.subprocess = None
-        self.output_lines = []
+        self.pidfd = None
+        self.loop = None
+        self.output = OutputRingBuffer(
+                settings.SERVER_OUTPUT_BUFFER_LINES,
+                settings.SERVER_OUTPUT_MAX_LINE_LENGTH
+                )
+        self.commands = CommandQueue(self.write_cmds, self.output)
         self.read_task = None
         self.err_task = None
 
         self.starting = False
         self.running = False
-
-        self.callback_manager = CallbackManager()
+        self.stopping = False
+        self.startup_event = None
+        self.startup_failure_reason = None
+        # When the process was spawned, for the start latency
+        self.spawned_at = None
+
+        self.callback_manager = CallbackManager(
+                stdout=LineDispatcher(settings.SERVER_CALLBACK_POLICY,
+                                      settings.SERVER_CALLBACK_QUEUE_SIZE),
+                stderr=LineDispatcher(settings.SERVER_CALLBACK_POLICY,
+                                      settings.SERVER_CALLBACK_QUEUE_SIZE)
+                )
 
     def __str__(self):
         return (f"{self.server_id}:{self.port} - starting: "
                 "{self.starting}; running: {self.running}")
 
     def get_is_initilized(self) -> bool:
-        session = next(session_handler.get_session())
-        db_server = session.get(Server, self.server_id)
-        session.close()
-        return db_server.initialized
+        return state_cache.get(self.server_id).initialized
 
     def get_state(self) -> ServerStateEnum:
-        session = next(session_handler.get_session())
-        db_server = session.get(Server, self.server_id)
-        session.close()
-        return db_server.state
+        return state_cache.get_state(self.server_id)
+
+    def set_state(self, state: ServerStateEnum,
+                  failure_reason: ServerFailureReasonEnum | None = None
+                  ) -> None:
+        state_cache.update(self.server_id, state=state,
+                           failure_reason=failure_reason)
 
-    def set_state(self, state: ServerStateEnum) -> None:
-        session = next(session_handler.get_session())
-        db_server = session.get(Server, self.server_id)
-        db_server.state = state
-        session.add(db_server)
-        session.commit()
-        session.close()
+    def notify_hub(self, event: HubEventEnum) -> HubNotification | None:
+        failure_reason = None
+        if event in [HubEventEnum.failed, HubEventEnum.crashed]:
+            failure_reason = state_cache.get(self.server_id).failure_reason
+        return hub_outbox.enqueue(self.server_id, event, failure_reason)
 
-    def add_stdin_callback(self, name: str, func: callable):
-        self.callback_manager.callbacks[name] = func
+    def add_stdin_callback(self, name: str, func: LineCallback,
+                           policy: BackpressurePolicyEnum | None = None):
+        self.callback_manager.stdout.subscribe(name, func, policy)
 
-    def add_stderr_callback(self, name: str, func: callable):
-        self.callback_manager.callbacks_err[name] = func
+    def add_stderr_callback(self, name: str, func: LineCallback,
+                            policy: BackpressurePolicyEnum | None = None):
+        self.callback_manager.stderr.subscribe(name, func, policy)
 
-    def add_async_stdin_callback(self, name: str, func: callable):
-        self.callback_manager.async_callbacks[name] = func
+    def add_async_stdin_callback(self, name: str, func: LineCallback,
+                                 policy: BackpressurePolicyEnum | None = None):
+        self.add_stdin_callback(name, func, policy)
+
+    def add_async_stderr_callback(self, name: str, func: LineCallback,
+                                  policy: BackpressurePolicyEnum | None = None
+                                  ):
+        self.add_stderr_callback(name, func, policy)
 
     def remove_stdin_callback(self, name: str):
-        try:
-            self.callback_manager.callbacks.pop(name)
-            return True
-        except KeyError:
-            return False
+        return self.callback_manager.stdout.unsubscribe(name)
 
     def remove_async_stdin_callback(self, name: str):
-        try:
-            self.callback_manager.async_callbacks.pop(name)
-            return True
-        except KeyError:
-            return False
+        return self.remove_stdin_callback(name)
 
     def remove_stderr_callback(self, name: str):
-        try:
-            self.callback_manager.callbacks_err.pop(name)
-            return True
-        except KeyError:
-            return False
+        return self.callback_manager.stderr.unsubscribe(name)
+
+    def remove_async_stderr_callback(self, name: str):
+        return self.remove_stderr_callback(name)
 
     def has_started_cb(self, x: str):
         """
@@ -104,58 +156,278 @@ class AsyncServer():
         if x.startswith("server listening"):
             self.running = True
             self.starting = False
+            self.startup_event.set()
+
+    async def read_lines(self, stream: LogTailer,
+                         dispatcher: LineDispatcher, stream_name: str):
+        """
+        Reads stream in chunks and publishes every complete line to the
+        dispatcher, returns at EOF
+        """
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        pending = ""
+        # Counted once per chunk, not per line
+        line_count = server_output_lines.labels(self.server_id, stream_name)
+        byte_count = server_output_bytes.labels(self.server_id, stream_name)
+        try:
+            while True:
+                chunk = await stream.read(settings.SERVER_READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                byte_count.inc(len(chunk))
+                pending += decoder.decode(chunk)
+                *lines, pending = pending.split("\n")
+                # A line without a newline is published in pieces of the
+                # max length, the rest waits for more output
+                max_length = settings.SERVER_READ_MAX_LINE_LENGTH
+                while len(pending) > max_length:
+                    lines.append(pending[:max_length])
+                    pending = pending[max_length:]
+                line_count.inc(len(lines))
+                for line in lines:
+                    await dispatcher.publish(line.strip())
+            pending += decoder.decode(b"", final=True)
+            if pending:
+                await dispatcher.publish(pending.strip())
+            await dispatcher.close(settings.SERVER_CALLBACK_DRAIN_TIMEOUT)
+        finally:
+            dispatcher.cancel()
 
     async def consume_lines(self):
-        stdout = self.subprocess.stdout
-        async for line in stdout:
-            sanitized_line = line.decode("utf-8").strip()
+        process = self.subprocess
+        await self.read_lines(process.stdout, self.callback_manager.stdout,
+                              "stdout")
+        # When outout stops, the server has stopped
+        if self.starting:
+            self.startup_failure_reason = ServerFailureReasonEnum.exited
+        crashed = self.running and not self.stopping
+        self.running = False
+        self.starting = False
+        self.subprocess = None
+        self.startup_event.set()
+        if not self.stopping:
+            process.close()
+            self.close_pidfd()
+            state_cache.update(self.server_id, process_id=None)
+        if crashed:
+            logger.warning(f"A-Server with id {self.server_id} crashed")
+            self.set_state(ServerStateEnum.failed,
+                           ServerFailureReasonEnum.exited)
+            self.notify_hub(HubEventEnum.crashed)
 
-            # Sync callbacks
-            for _, func in self.callback_manager.callbacks.items():
-                func(sanitized_line)
+    async def consume_errors(self):
+        await self.read_lines(self.subprocess.stderr,
+                              self.callback_manager.stderr, "stderr")
 
-            # Async callbacks
-            if len(self.callback_manager.async_callbacks) > 0:
-                coros = [func(sanitized_line) for _, func in
-                         self.callback_manager.async_callbacks.items()]
-                asyncio.gather(*coros)
+    async def wait_for_startup(self, timeout: float | None = None) -> bool:
+        """
+        Waits until the server is listening, has exited or the timeout
+        (SERVER_STARTUP_TIMEOUT by default) has passed. Returns whether
+        the server is running, on failure the reason is stored in
+        self.startup_failure_reason
+        """
+        if timeout is None:
+            timeout = settings.SERVER_STARTUP_TIMEOUT
+        if self.starting and not self.startup_event.is_set():
+            try:
+                await asyncio.wait_for(self.startup_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                self.startup_failure_reason = \
+                        ServerFailureReasonEnum.timed_out
+                await self.terminate()
+        self.remove_stdin_callback("start_cb")
+        if not self.running and self.startup_failure_reason:
+            logger.warning(f"A-Server with id {self.server_id} failed to "
+                           f"start: {self.startup_failure_reason.value}")
+        return self.running
 
+    def call_in_loop(self, func, *args):
+        """
+        Runs func in the loop the process was started in, the pipes and
+        reader tasks belong to that loop
+        """
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self.loop:
+            func(*args)
         else:
-            # When outout stops, the server has stopped
-            self.running = False
-            self.starting = False
+            self.loop.call_soon_threadsafe(func, *args)
+
+    async def terminate(self) -> bool:
+        """
+        Sends SIGTERM to the process group and escalates to SIGKILL if the
+        process has not exited after SERVER_STOP_TERM_TIMEOUT. Returns
+        whether the process exited without needing SIGKILL
+        """
+        process = self.subprocess
+        if process is None:
+            return True
+        self.stopping = True
+        logger.warning(f"A-Server with id {self.server_id} sending SIGTERM")
+        signal_process_group(process.pid, signal.SIGTERM)
+        exited = await wait_for_exit(process.pid, self.pidfd,
+                                     settings.SERVER_STOP_TERM_TIMEOUT)
+        if not exited:
+            logger.warning(f"A-Server with id {self.server_id} did not "
+                           "exit after SIGTERM, sending SIGKILL")
+            signal_process_group(process.pid, signal.SIGKILL)
+            await wait_for_exit(process.pid, self.pidfd, None)
+        await self.cleanup_process(process)
+        return exited
+
+    async def cleanup_process(self, process: ServerProcess):
+        """
+        Reaps the exited process, stops the reader tasks and closes the
+        pipes
+        """
+        self.running = False
+        self.starting = False
+        if self.subprocess is process:
             self.subprocess = None
+        tasks = [task for task in [self.read_task, self.err_task] if task]
+        if asyncio.get_running_loop() is self.loop:
+            await process.wait()
+            # The readers stop by themselves once the pipes hit EOF
+            pending = set()
+            if tasks:
+                _, pending = await asyncio.wait(
+                        tasks,
+                        timeout=settings.SERVER_CALLBACK_DRAIN_TIMEOUT + 1
+                        )
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        else:
+            # The child watcher reaps the process, the reader tasks can
+            # only be cancelled from their own loop
+            await poll_for_exit(process.pid, 1)
+            for task in tasks:
+                self.call_in_loop(task.cancel)
+        self.call_in_loop(process.close)
+        self.close_pidfd()
+        state_cache.update(self.server_id, process_id=None)
+        self.stopping = False
+
+    async def detach(self):
+        """
+        Lets go of the process without stopping it, it keeps running and
+        is adopted again when the node starts back up
+        """
+        process = self.subprocess
+        if process is None:
+            return
+        print(f"A-Server with id {self.server_id} detaching")
+        self.subprocess = None
+        self.running = False
+        self.starting = False
+        for task in [self.read_task, self.err_task]:
+            if task:
+                self.call_in_loop(task.cancel)
+        self.call_in_loop(process.close)
+        self.close_pidfd()
+
+    def close_pidfd(self):
+        if self.pidfd is not None:
+            pidfd, self.pidfd = self.pidfd, None
+            os.close(pidfd)
+
+    def process_exited(self) -> bool:
+        process = self.subprocess
+        return process is None or has_exited(process.pid, self.pidfd)
+
+    def is_own_process(self, pid: int) -> bool:
+        """
+        Checks that pid is the ArchipelagoServer of this server and not
+        some other process that got the pid after it exited
+        """
+        cmdline = read_cmdline(pid)
+        if not cmdline:
+            return False
+        is_archipelago = any(os.path.basename(arg) == "ArchipelagoServer"
+                             for arg in cmdline)
+        port_args = [cmdline[i + 1] for i, arg in enumerate(cmdline[:-1])
+                     if arg == "--port"]
+        game_file = str(game_file_path(self.server_id).absolute())
+        return is_archipelago and port_args == [str(self.port)] and \
+            game_file in cmdline
+
+    def attach(self, pid: int,
+               child: asyncio.subprocess.Process | None = None):
+        """
+        Connects to the stdio files of the process and starts reading its
+        output where the last reader stopped
+        """
+        self.loop = asyncio.get_running_loop()
+        self.pidfd = open_pidfd(pid)
+        try:
+            self.subprocess = attach_server_process(
+                    pid,
+                    stdin_fifo_path(self.server_id),
+                    stdout_log_path(self.server_id),
+                    stderr_log_path(self.server_id),
+                    self.process_exited,
+                    self.pidfd,
+                    child
+                    )
+        except OSError:
+            self.close_pidfd()
+            raise
 
-    async def consume_errors(self):
-        stderr = self.subprocess.stderr
-        async for line in stderr:
-            sanitized_line = line.decode("utf-8").strip()
-
-            # Sync callbacks
-            for _, func in self.callback_manager.callbacks_err.items():
-                func(sanitized_line)
-
-            # Async callbacks
-            if len(self.callback_manager.async_callbacks_err) > 0:
-                coros = [func(sanitized_line) for _, func in
-                         self.callback_manager.async_callbacks_err.items()]
-                asyncio.gather(*coros)
-
-    async def wait_for_startup(self):
-        for _ in range(10):  # 0.5 * 10 = 5s
-            await asyncio.sleep(0.5)
-            if self.running:
-                self.remove_stdin_callback("start_cb")
-                return True
-        self.remove_stdin_callback("start_cb")
-        return False
+        self.add_stdin_callback("print", print)
+        self.add_stderr_callback("printe", lambda e: print(f"stderr: {e}"))
+        # Internal callbacks are cheap and must not miss lines
+        self.add_stdin_callback("output", self.output.append,
+                                BackpressurePolicyEnum.block)
+        self.add_stderr_callback("output_err",
+                                 lambda x: self.output.append(x, "stderr"),
+                                 BackpressurePolicyEnum.block)
+        self.add_stdin_callback("log",
+                                lambda x: log_store.append(self.server_id, x),
+                                BackpressurePolicyEnum.block)
+        self.add_stderr_callback("log_err",
+                                 lambda x: log_store.append(self.server_id, x,
+                                                            "stderr"),
+                                 BackpressurePolicyEnum.block)
+        self.add_stdin_callback("events",
+                                lambda x: event_writer.add_line(
+                                    self.server_id, x),
+                                BackpressurePolicyEnum.block)
+        self.add_stderr_callback("events_err",
+                                 lambda x: event_writer.add_line(
+                                     self.server_id, x, "stderr"),
+                                 BackpressurePolicyEnum.block)
+        if self.starting:
+            self.add_stdin_callback("start_cb", self.has_started_cb,
+                                    BackpressurePolicyEnum.block)
+        self.callback_manager.stdout.start()
+        self.callback_manager.stderr.start()
+        self.read_task = asyncio.create_task(self.consume_lines())
+        self.err_task = asyncio.create_task(self.consume_errors())
 
-    async def wait_for_shutdown(self):
-        for _ in range(20):  # 0.5 * 20 = 10s
-            await asyncio.sleep(0.5)
-            if not self.running and not self.starting:
-                return True
-        return False
+    async def adopt(self, pid: int | None) -> bool:
+        """
+        Takes over a server process that outlived a previous run of the
+        node, returns False if it is not running anymore
+        """
+        if pid is None or not self.is_own_process(pid):
+            return False
+        self.starting = self.get_state() == ServerStateEnum.starting
+        self.running = not self.starting
+        self.startup_event = asyncio.Event()
+        self.startup_failure_reason = None
+        try:
+            # Output written while no node was reading is read now
+            self.attach(pid)
+        except OSError as e:
+            logger.warning(f"A-Server with id {self.server_id} could not "
+                           f"be adopted: {e}")
+            self.starting = False
+            self.running = False
+            return False
+        print(f"A-Server with id {self.server_id} adopted (pid {pid})")
+        return True
 
     async def start(self, is_restart=False):
         db_state = self.get_state()
@@ -174,29 +446,45 @@ class AsyncServer():
                         )
         self.set_state(ServerStateEnum.starting)
         self.starting = True
-        folder_str = f"arch_games_dev/{self.server_id}/"
-        arch_file_path = Path(folder_str) / "game.archipelago"
-        self.subprocess = await asyncio.subprocess.create_subprocess_exec(
-                "ArchipelagoServer",
-                "--port", str(self.port),
-                arch_file_path.absolute(),
-                stdin=asyncio.subprocess.PIPE,
-                stdout=asyncio.subprocess.PIPE,
+        self.startup_event = asyncio.Event()
+        self.startup_failure_reason = None
+        arch_file_path = game_file_path(self.server_id)
+        self.spawned_at = time.monotonic()
+        child = await spawn_server_process(
+                ["ArchipelagoServer",
+                 "--port", str(self.port),
+                 str(arch_file_path.absolute())],
+                stdin_fifo_path(self.server_id),
+                stdout_log_path(self.server_id),
+                stderr_log_path(self.server_id)
                 )
-        self.read_task = asyncio.create_task(self.consume_lines())
-        self.err_task = asyncio.create_task(self.consume_errors())
+        state_cache.update(self.server_id, process_id=child.pid)
+        self.attach(child.pid, child=child)
 
-        self.add_stdin_callback("print", print)
-        self.add_stderr_callback("printe", lambda e: print(f"stderr: {e}"))
-        self.add_stdin_callback("output",
-                                lambda x: self.output_lines.append(x))
-        self.add_stdin_callback("start_cb", self.has_started_cb)
+    async def finish_startup(self) -> bool:
+        """
+        Waits for a starting server and records whether it came up
+        """
+        is_started = await self.wait_for_startup()
+        if self.spawned_at is not None:
+            # Adopted servers were spawned by an earlier run of the node
+            server_start_seconds.labels(
+                    "started" if is_started else "failed"
+                    ).observe(time.monotonic() - self.spawned_at)
+            self.spawned_at = None
+        if is_started:
+            self.set_state(ServerStateEnum.running)
+            self.notify_hub(HubEventEnum.started)
+        else:
+            self.set_state(ServerStateEnum.failed,
+                           self.startup_failure_reason)
+            self.notify_hub(HubEventEnum.failed)
+        return is_started
 
     async def start_wait(self, is_restart=False):
         try:
             await self.start(is_restart)
-            is_started = await self.wait_for_startup()
-            self.set_state(ServerStateEnum.running)
+            is_started = await self.finish_startup()
         except ServerNotInitializedException as e:
             is_started = False
             self.set_state(ServerStateEnum.failed)
@@ -214,25 +502,58 @@ class AsyncServer():
                 f"current state: {db_state}"
                 ))
         print(f"A-Server with id {self.server_id} shutting down")
-        self.subprocess.stdin.write(str.encode("/exit\n"))
-        await self.subprocess.stdin.drain()
+        stop_started = time.monotonic()
+        process = self.subprocess
+        self.stopping = True
         self.remove_stdin_callback("print")
         self.remove_stdin_callback("output")
         self.remove_stderr_callback("printe")
-        is_shut_down = await self.wait_for_shutdown()
-        self.read_task.cancel()
-        self.err_task.cancel()
-
-        # TODO: throw errors?
+        self.remove_stderr_callback("output_err")
+        try:
+            process.stdin.write(str.encode("/exit\n"))
+            await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        is_shut_down = await wait_for_exit(process.pid, self.pidfd,
+                                           settings.SERVER_STOP_TIMEOUT)
         if is_shut_down:
+            await self.cleanup_process(process)
             print(f"A-Server with id {self.server_id} shut down")
         else:
-            print(f"A-Server with id {self.server_id} hung shutting down")
+            logger.warning(f"A-Server with id {self.server_id} hung "
+                           "shutting down")
+            await self.terminate()
+        server_stop_seconds.labels(
+                "exited" if is_shut_down else "terminated"
+                ).observe(time.monotonic() - stop_started)
         return is_shut_down
 
-    async def send_cmd(self, cmd: str):
+    async def write_cmds(self, cmds: list[str]):
         if not self.subprocess:
             raise ProcessNotRunningException("The process is not running, "
                                              "cannot send cmd")
-        self.subprocess.stdin.write(str.encode(cmd+"\n"))
+        self.subprocess.stdin.write(
+                "".join(cmd + "\n" for cmd in cmds).encode()
+                )
         await self.subprocess.stdin.drain()
+
+    async def send_cmd(self, cmd: str):
+        await self.commands.send([cmd])
+
+    async def send_cmds(self, cmds: list[str], wait: bool = False,
+                        quiet_period: float | None = None,
+                        timeout: float | None = None
+                        ) -> list[CommandResult] | None:
+        """
+        Sends the commands in order, behind commands that are already
+        queued. With wait, returns the output each command was answered
+        with.
+        """
+        if not self.subprocess:
+            raise ProcessNotRunningException("The process is not running, "
+                                             "cannot send cmd")
+        return await self.commands.send(
+                cmds, wait,
+                quiet_period or settings.SERVER_CMD_QUIET_PERIOD,
+                timeout or settings.SERVER_CMD_TIMEOUT
+                )
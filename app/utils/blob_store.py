@@ -0,0 +1,118 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from app.utils.files import BLOB_DIR, remove_file
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class BlobStore():
+    """
+    Content addressed store for game files, keyed by sha256.
+
+    Servers get a hardlink to the blob (a copy if the server directory is
+    on another filesystem), so servers started from the same seed share
+    one file on disk. A blob is referenced by every server whose
+    archipelago_file_hash matches it and removed once no server does.
+    """
+    def __init__(self, root: Path):
+        self.root = root
+
+    @property
+    def tmp_dir(self) -> Path:
+        path = self.root / "tmp"
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def blob_path(self, file_hash: str) -> Path:
+        return self.root / file_hash[:2] / file_hash
+
+    def has(self, file_hash: str) -> bool:
+        return self.blob_path(file_hash).is_file()
+
+    def add(self, tmp_path: Path, file_hash: str) -> Path:
+        """
+        Moves a fully written temp file into the store, if the blob already
+        exists the temp file is dropped instead
+        """
+        blob_path = self.blob_path(file_hash)
+        if blob_path.is_file():
+            remove_file(tmp_path)
+            return blob_path
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        os.chmod(tmp_path, 0o444)
+        os.replace(tmp_path, blob_path)
+        return blob_path
+
+    def link(self, file_hash: str, destination: Path) -> None:
+        """
+        Atomically points destination at the blob
+        """
+        blob_path = self.blob_path(file_hash)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        if destination.is_file() and os.path.samefile(blob_path,
+                                                      destination):
+            # Renaming onto a hardlink of the same file is a no-op
+            return
+        fd, tmp_name = tempfile.mkstemp(dir=destination.parent,
+                                        suffix=".part")
+        os.close(fd)
+        os.unlink(tmp_name)
+        try:
+            try:
+                os.link(blob_path, tmp_name)
+            except OSError:
+                shutil.copyfile(blob_path, tmp_name)
+            os.replace(tmp_name, destination)
+        except BaseException:
+            remove_file(Path(tmp_name))
+            raise
+
+    def release(self, file_hash: str | None,
+                referenced_hashes: set[str]) -> bool:
+        """
+        Removes the blob if no server references it anymore, returns
+        whether it was removed
+        """
+        if file_hash is None or file_hash in referenced_hashes:
+            return False
+        if not self.has(file_hash):
+            return False
+        remove_file(self.blob_path(file_hash))
+        logger.info(f"Removed unreferenced game file {file_hash}")
+        return True
+
+    def collect_garbage(self, referenced_hashes: set[str],
+                        tmp_max_age: float) -> int:
+        """
+        Removes every blob that is not referenced, and temp files that were
+        not written to in tmp_max_age seconds
+        """
+        removed = 0
+        if not self.root.is_dir():
+            return removed
+        stale = time.time() - tmp_max_age
+        for prefix_dir in self.root.iterdir():
+            if not prefix_dir.is_dir():
+                continue
+            for blob in prefix_dir.iterdir():
+                if prefix_dir.name == "tmp":
+                    try:
+                        if blob.stat().st_mtime > stale:
+                            continue
+                    except FileNotFoundError:
+                        # The upload finished meanwhile
+                        continue
+                elif blob.name in referenced_hashes:
+                    continue
+                remove_file(blob)
+                removed += 1
+        return removed
+
+
+blob_store = BlobStore(BLOB_DIR)
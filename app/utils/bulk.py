@@ -0,0 +1,38 @@
+import asyncio
+from typing import Awaitable, Callable, Iterable, TypeVar
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class ConcurrencyLimiter():
+    """
+    Caps how many bulk operations run at once across all requests, so a
+    burst of starts does not spawn every server at the same time
+    """
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._semaphore: asyncio.Semaphore | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.limit)
+            self._loop = loop
+        return self._semaphore
+
+    async def run(self, func: Callable[[T], Awaitable[R]], item: T) -> R:
+        async with self.semaphore:
+            return await func(item)
+
+    async def map(self, func: Callable[[T], Awaitable[R]],
+                  items: Iterable[T]) -> list[R]:
+        """
+        Runs func for every item, at most limit at a time, and returns the
+        results in the order of items
+        """
+        return await asyncio.gather(*[self.run(func, item)
+                                      for item in items])
@@ -0,0 +1,130 @@
+import asyncio
+import math
+import os
+from collections import deque
+from app.core.config import settings
+from app.models.servers import NodeCapacity, ServerStateEnum
+from app.utils.change_feed import change_feed
+from app.utils.metrics import Counter, Gauge, registry
+from app.utils.resources import read_memory, resource_sampler
+from app.utils.server_utils import port_handler
+from app.utils.state_cache import state_cache
+
+
+ACTIVE_STATES = [ServerStateEnum.starting, ServerStateEnum.running]
+
+start_admissions = registry.register(Counter(
+        "archipelago_start_admissions_total",
+        "Server starts by whether they were admitted right away, after "
+        "waiting in the queue, or rejected",
+        ("outcome",)
+        ))
+
+
+class NodeSaturatedException(Exception):
+    pass
+
+
+def capacity() -> NodeCapacity:
+    """
+    Projects what the active servers use from their samples, cheap enough
+    to compute on every start and every read
+    """
+    active = [server for server in state_cache.all()
+              if server.state in ACTIVE_STATES]
+    peaks = resource_sampler.peaks()
+    if peaks:
+        server_cpu = sum(cpu for cpu, _ in peaks.values()) / len(peaks)
+        server_rss = sum(rss for _, rss in peaks.values()) // len(peaks)
+    else:
+        server_cpu = settings.SERVER_CPU_ESTIMATE
+        server_rss = settings.SERVER_MEMORY_ESTIMATE
+    cpu_projected = sum(peaks.get(server.id, (server_cpu, None))[0]
+                        for server in active)
+    memory_projected = sum(peaks.get(server.id, (None, server_rss))[1]
+                           for server in active)
+
+    memory_total, memory_available = read_memory()
+    cpu_budget = (os.cpu_count() or 1) * 100 * settings.NODE_CPU_BUDGET
+    memory_budget = int(memory_total * settings.NODE_MEMORY_BUDGET)
+    # Memory other processes took counts against the budget too
+    memory_headroom = min(memory_budget - memory_projected, memory_available)
+    cpu_headroom = cpu_budget - cpu_projected
+    # Idle servers can sample at 0, a slot needs at least a little
+    slots = min(cpu_headroom / max(server_cpu, 0.1),
+                memory_headroom / max(server_rss, 1024 * 1024))
+    free_slots = max(0, math.floor(slots))
+    if settings.NODE_MAX_RUNNING_SERVERS is not None:
+        free_slots = min(free_slots,
+                         max(0, settings.NODE_MAX_RUNNING_SERVERS
+                             - len(active)))
+    return NodeCapacity(
+            active_servers=len(active),
+            queued_starts=len(admission.queue),
+            server_cpu_percent=server_cpu,
+            server_rss_bytes=server_rss,
+            sampled_servers=len(peaks),
+            cpu_budget_percent=cpu_budget,
+            cpu_projected_percent=cpu_projected,
+            memory_budget_bytes=memory_budget,
+            memory_projected_bytes=memory_projected,
+            memory_available_bytes=memory_available,
+            free_slots=free_slots,
+            free_ports=port_handler.free_count(),
+            saturated=free_slots == 0
+            )
+
+
+class AdmissionController():
+    """
+    Lets server starts through while the node has a free slot. Starts that
+    do not fit wait in line for one, woken up by state changes, which is
+    when servers stop, and every sample interval, which is when usage can
+    drop.
+    """
+    def __init__(self):
+        self.queue: deque[object] = deque()
+
+    async def admit(self):
+        """
+        Returns once the caller may start a server, it has to set the
+        server to starting before its next await so the slot counts as
+        taken. Raises NodeSaturatedException if there is no slot in time.
+        """
+        if not self.queue and capacity().free_slots > 0:
+            start_admissions.labels("admitted").inc()
+            return
+        if settings.NODE_START_QUEUE_TIMEOUT <= 0 or \
+                len(self.queue) >= settings.NODE_START_QUEUE_SIZE:
+            start_admissions.labels("rejected").inc()
+            raise NodeSaturatedException("The node is at capacity")
+        ticket = object()
+        self.queue.append(ticket)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.NODE_START_QUEUE_TIMEOUT
+        try:
+            while True:
+                version = change_feed.version
+                if self.queue[0] is ticket and capacity().free_slots > 0:
+                    start_admissions.labels("queued").inc()
+                    return
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    start_admissions.labels("rejected").inc()
+                    raise NodeSaturatedException(
+                            "The node is at capacity, no slot freed up in "
+                            f"{settings.NODE_START_QUEUE_TIMEOUT} seconds"
+                            )
+                await change_feed.wait(
+                        version, None,
+                        min(remaining, settings.SERVER_SAMPLE_INTERVAL)
+                        )
+        finally:
+            self.queue.remove(ticket)
+
+
+admission = AdmissionController()
+
+registry.register(Gauge("archipelago_node_free_slots",
+                        "Servers the node can start before it is saturated",
+                        (), lambda: {(): capacity().free_slots}))
@@ -0,0 +1,95 @@
+import asyncio
+import threading
+import uuid
+from collections import deque
+from datetime import datetime
+from app.core.config import settings
+from app.models.servers import (
+        ServerChange,
+        ServerChanges,
+        ServerStateEnum,
+        ServerFailureReasonEnum
+        )
+
+
+class ServerChangeFeed():
+    """
+    Keeps the last state transitions of the servers in memory, numbered by
+    a version that grows with every transition, and wakes up everyone
+    waiting for the next one
+    """
+    def __init__(self, capacity: int):
+        self._lock = threading.Lock()
+        self._changes: deque[ServerChange] = deque(maxlen=capacity)
+        self._waiters: set[asyncio.Future] = set()
+        self.epoch = uuid.uuid4().hex
+        self.version = 0
+
+    def publish(self, server_id: int, state: ServerStateEnum | None,
+                failure_reason: ServerFailureReasonEnum | None = None
+                ) -> ServerChange:
+        with self._lock:
+            self.version += 1
+            change = ServerChange(version=self.version,
+                                  server_id=server_id,
+                                  state=state,
+                                  failure_reason=failure_reason,
+                                  at=datetime.utcnow())
+            self._changes.append(change)
+            waiters, self._waiters = self._waiters, set()
+        for waiter in waiters:
+            # Waiters can be on another loop than the publisher
+            waiter.get_loop().call_soon_threadsafe(self._wake, waiter)
+        return change
+
+    @staticmethod
+    def _wake(waiter: asyncio.Future):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    def since(self, version: int, epoch: str | None = None) -> ServerChanges:
+        """
+        Returns the changes after version. The result is reset when the
+        version is from another epoch or older than the kept changes.
+        """
+        with self._lock:
+            oldest = self._changes[0].version if self._changes \
+                else self.version + 1
+            reset = (epoch is not None and epoch != self.epoch) \
+                or version > self.version \
+                or version < oldest - 1
+            changes = [] if reset else [change for change in self._changes
+                                        if change.version > version]
+            return ServerChanges(epoch=self.epoch, version=self.version,
+                                 reset=reset, changes=changes)
+
+    async def wait(self, version: int, epoch: str | None = None,
+                   timeout: float = 30) -> ServerChanges:
+        """
+        Like since, but waits up to timeout seconds for a change if there
+        is none yet
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        with self._lock:
+            self._waiters.add(waiter)
+        try:
+            result = self.since(version, epoch)
+            if result.changes or result.reset:
+                return result
+            try:
+                await asyncio.wait_for(waiter, timeout)
+            except asyncio.TimeoutError:
+                pass
+            return self.since(version, epoch)
+        finally:
+            with self._lock:
+                self._waiters.discard(waiter)
+
+    def reset(self):
+        with self._lock:
+            self._changes.clear()
+            self.epoch = uuid.uuid4().hex
+            self.version = 0
+
+
+change_feed = ServerChangeFeed(settings.SERVER_CHANGES_HISTORY)
@@ -0,0 +1,110 @@
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable
+from app.models.servers import CommandResult, ServerOutputLine
+from app.utils.output_buffer import OutputRingBuffer
+
+
+class PendingCommand():
+    def __init__(self, cmd: str, wait: bool, quiet_period: float,
+                 timeout: float):
+        self.cmd = cmd
+        self.wait = wait
+        self.quiet_period = quiet_period
+        self.timeout = timeout
+        self.future = asyncio.get_running_loop().create_future()
+
+    def resolve(self, result: CommandResult | None = None,
+                error: BaseException | None = None):
+        # The sender can be on another loop than the queue worker
+        self.future.get_loop().call_soon_threadsafe(self._resolve, result,
+                                                    error)
+
+    def _resolve(self, result: CommandResult | None,
+                 error: BaseException | None):
+        if self.future.done():
+            return
+        if error is not None:
+            self.future.set_exception(error)
+        else:
+            self.future.set_result(result)
+
+
+class CommandQueue():
+    """
+    Sends the commands of one server one after the other.
+
+    Commands nobody waits for are written as soon as they are queued,
+    consecutive ones in a single write. After a command whose response is
+    waited for, the output is collected until the server was quiet for
+    quiet_period seconds, or timeout seconds passed, and only then the next
+    command is written, so responses do not mix.
+    """
+    def __init__(self, write: Callable[[list[str]], Awaitable[None]],
+                 output: OutputRingBuffer):
+        self.write = write
+        self.output = output
+        self.pending: deque[PendingCommand] = deque()
+        self.task: asyncio.Task | None = None
+
+    async def send(self, cmds: list[str], wait: bool = False,
+                   quiet_period: float = 0.2, timeout: float = 5.0
+                   ) -> list[CommandResult] | None:
+        """
+        Queues cmds back to back and returns once all of them were written,
+        with their responses if wait is set
+        """
+        commands = [PendingCommand(cmd, wait, quiet_period, timeout)
+                    for cmd in cmds]
+        self.pending.extend(commands)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        results = await asyncio.gather(*[command.future
+                                         for command in commands])
+        return results if wait else None
+
+    async def run(self):
+        while self.pending:
+            batch = []
+            while self.pending and not self.pending[0].wait:
+                batch.append(self.pending.popleft())
+            if not batch:
+                batch.append(self.pending.popleft())
+            start_seq = self.output.next_seq
+            try:
+                await self.write([command.cmd for command in batch])
+            except Exception as e:
+                for command in batch:
+                    command.resolve(error=e)
+                continue
+            if not batch[0].wait:
+                for command in batch:
+                    command.resolve()
+                continue
+            command = batch[0]
+            lines, timed_out = await self.collect(start_seq,
+                                                  command.quiet_period,
+                                                  command.timeout)
+            command.resolve(CommandResult(cmd=command.cmd, lines=lines,
+                                          timed_out=timed_out))
+
+    async def collect(self, seq: int, quiet_period: float, timeout: float
+                      ) -> tuple[list[ServerOutputLine], bool]:
+        """
+        Returns the lines from seq on until no line came for quiet_period
+        seconds, and whether timeout cut that short
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        lines = []
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return lines, True
+            window = min(quiet_period, remaining)
+            output = await self.output.wait(seq, timeout=window)
+            if not output.lines:
+                # Quiet only counts if it lasted the whole quiet period
+                return lines, window < quiet_period
+            lines += output.lines
+            seq = output.lines[-1].seq + 1
@@ -0,0 +1,604 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Awaitable, Callable, List
+from fastapi import HTTPException
+from sqlmodel import delete
+from app.core.config import settings
+from app.db import session_handler
+from app.models.servers import (
+        Server,
+        ServerCreateInternal,
+        ServerStateEnum,
+        ServerOutput,
+        ServerChanges,
+        ServerLogs,
+        ServerResources,
+        NodeResources,
+        NodeCapacity,
+        CommandResult,
+        ArchipelagoMetadata,
+        BulkStartServer,
+        BulkServerResult,
+        ServerPublic,
+        ServerWrongStateException,
+        ServerNotInitializedException
+        )
+from app.models.notifications import HubEventEnum
+from app.models.events import ServerEvent
+from app.models.logs import LogPosting, LogSearchResult
+from app.models.metrics import MetricFamily
+from app.utils.asyncserver import AsyncServer, ProcessNotRunningException
+from app.utils.blob_store import blob_store
+from app.utils.bulk import ConcurrencyLimiter
+from app.utils.capacity import NodeSaturatedException, admission, capacity
+from app.utils.change_feed import change_feed
+from app.utils.events import event_writer
+from app.utils.files import game_file_path, remove_file
+from app.utils.log_search import search_logs
+from app.utils.log_store import log_store, to_server_logs
+from app.utils.metrics import (
+        registry,
+        server_output_lines,
+        server_output_bytes
+        )
+from app.utils.multidata import (
+        parse_archipelago_file,
+        check_server_version,
+        InvalidArchipelagoFileException
+        )
+from app.utils.resources import resource_sampler
+from app.utils.rpc import RpcClient, RpcException, RpcConnectionException
+from app.utils.server_utils import (
+        server_manager,
+        port_handler,
+        PortsExhaustedException
+        )
+from app.utils.state_cache import state_cache
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class LocalController():
+    """
+    Manages the game servers in this process. Used by the API directly in
+    embedded mode, and by the supervisor in remote mode.
+
+    Every operation raises HTTPException on errors, the RPC layer hands
+    those on to the API as they are.
+    """
+    def __init__(self):
+        self.bulk_limiter = ConcurrencyLimiter(
+                settings.SERVER_BULK_PARALLELISM
+                )
+        # A lock and how many hold or wait for it, per game file hash
+        self.game_file_locks: dict[str, tuple[asyncio.Lock, int]] = {}
+
+    async def get_cached_server(self, server_id: int) -> Server:
+        server = await state_cache.fetch(server_id)
+        if not server:
+            raise HTTPException(status_code=404, detail="Server not found")
+        return server
+
+    async def get_server(self, server_id: int) -> Server:
+        return await self.get_cached_server(server_id)
+
+    async def create_servers(self, count: int) -> List[Server]:
+        await port_handler.ensure_seeded()
+        try:
+            ports = port_handler.reserve(count)
+        except PortsExhaustedException as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        async with session_handler.async_session() as session:
+            try:
+                db_servers = [
+                        Server.model_validate(ServerCreateInternal(
+                            address="localhost",
+                            port=port
+                            ))
+                        for port in ports
+                        ]
+                session.add_all(db_servers)
+                await session.commit()
+            except Exception:
+                for port in ports:
+                    port_handler.release(port)
+                raise
+            for db_server in db_servers:
+                await session.refresh(db_server)
+        for db_server in db_servers:
+            state_cache.add(db_server)
+            sm = AsyncServer(db_server.id, db_server.port)
+            server_manager.servers[db_server.id] = sm
+        return db_servers
+
+    async def delete_server(self, server_id: int) -> None:
+        server = await self.get_cached_server(server_id)
+        sm = server_manager.servers.get(server_id)
+        if server.state in [ServerStateEnum.starting,
+                            ServerStateEnum.running] or \
+                (sm is not None and sm.subprocess is not None):
+            raise HTTPException(status_code=400,
+                                detail=(f"Server is {server.state.value}, "
+                                        "stop it before deleting it"))
+        # Gone before the first await, so nothing can start it meanwhile
+        state_cache.evict(server_id)
+        server_manager.servers.pop(server_id, None)
+        try:
+            async with session_handler.async_session() as session:
+                # Events still waiting to be written would outlive the
+                # server
+                await asyncio.to_thread(event_writer.flush)
+                await session.exec(delete(ServerEvent)
+                                   .where(ServerEvent.server_id == server_id))
+                await session.exec(delete(LogPosting)
+                                   .where(LogPosting.server_id == server_id))
+                await session.exec(delete(Server)
+                                   .where(Server.id == server_id))
+                await session.commit()
+        except Exception:
+            state_cache.add(server)
+            if sm is not None:
+                server_manager.servers[server_id] = sm
+            raise
+        port_handler.release(server.port)
+        remove_file(game_file_path(server_id))
+        await asyncio.to_thread(log_store.remove, server_id)
+        for stream in ["stdout", "stderr"]:
+            server_output_lines.remove(server_id, stream)
+            server_output_bytes.remove(server_id, stream)
+        await self.release_game_file(server.archipelago_file_hash)
+
+    async def read_output(self, server_id: int, since: int | None,
+                          last: int, limit: int) -> ServerOutput:
+        await self.get_cached_server(server_id)
+        output = server_manager.servers[server_id].output
+        if since is not None:
+            return output.since(since, limit)
+        return output.tail(last)
+
+    async def read_logs(self, server_id: int, since: float | None,
+                        until: float | None, tail: int | None, limit: int
+                        ) -> ServerLogs:
+        """
+        Returns the last tail stored lines, or else the first limit lines
+        from since until until, as unix times
+        """
+        await self.get_cached_server(server_id)
+        if tail is not None:
+            records = await asyncio.to_thread(log_store.tail, server_id, tail)
+            return to_server_logs(records)
+        records = await asyncio.to_thread(log_store.read, server_id, since,
+                                          until, limit + 1)
+        return to_server_logs(records[:limit], len(records) > limit)
+
+    async def search_logs(self, query: str, server_ids: List[int] | None,
+                          since: float | None, until: float | None,
+                          limit: int) -> LogSearchResult:
+        return await asyncio.to_thread(search_logs, query, server_ids, since,
+                                       until, limit)
+
+    async def read_metrics(self) -> List[MetricFamily]:
+        return registry.collect()
+
+    async def read_resources(self, server_id: int) -> ServerResources:
+        await self.get_cached_server(server_id)
+        return resource_sampler.resources(server_id)
+
+    async def read_node_resources(self) -> NodeResources:
+        return resource_sampler.node_resources()
+
+    async def read_capacity(self) -> NodeCapacity:
+        await port_handler.ensure_seeded()
+        return capacity()
+
+    async def wait_for_changes(self, since: int, epoch: str | None,
+                               timeout: float) -> ServerChanges:
+        return await change_feed.wait(since, epoch, timeout)
+
+    async def wait_for_output(self, server_id: int, since: int, limit: int,
+                              timeout: float) -> ServerOutput:
+        await self.get_cached_server(server_id)
+        output = server_manager.servers[server_id].output
+        return await output.wait(since, limit, timeout)
+
+    @asynccontextmanager
+    async def game_file_lock(self, file_hash: str):
+        """
+        Serializes pointing servers at the blob of file_hash with releasing
+        it, so the blob can not be removed before the server references it
+        """
+        lock, users = self.game_file_locks.get(file_hash,
+                                               (asyncio.Lock(), 0))
+        self.game_file_locks[file_hash] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self.game_file_locks[file_hash]
+            if users == 1:
+                del self.game_file_locks[file_hash]
+            else:
+                self.game_file_locks[file_hash] = (lock, users - 1)
+
+    async def release_game_file(self, file_hash: str | None):
+        if file_hash is None:
+            return
+        async with self.game_file_lock(file_hash):
+            referenced_hashes = {s.archipelago_file_hash
+                                 for s in state_cache.all()}
+            await asyncio.to_thread(blob_store.release, file_hash,
+                                    referenced_hashes)
+
+    async def read_game_file_metadata(self, path: Path,
+                                      file_hash: str) -> dict:
+        """
+        Parses the game file, unless a server with the same file was
+        already initialized and has the metadata cached
+        """
+        cached = [server.archipelago_metadata
+                  for server in state_cache.all()
+                  if server.archipelago_file_hash == file_hash
+                  and server.archipelago_metadata is not None]
+        try:
+            if cached:
+                metadata = ArchipelagoMetadata.model_validate(cached[0])
+            else:
+                metadata = await parse_archipelago_file(path)
+            check_server_version(metadata)
+        except InvalidArchipelagoFileException as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return metadata.model_dump(mode="json")
+
+    async def init_server(self, server_id: int, file_hash: str,
+                          upload_path: str | None = None,
+                          file_name: str | None = None) -> Server:
+        """
+        Points the server at the game file with file_hash. upload_path is
+        a freshly uploaded file in the blob store temp dir with that hash,
+        without it the file has to be in the blob store already
+        """
+        server = await self.get_cached_server(server_id)
+        if upload_path is not None:
+            path = Path(upload_path)
+            if path.parent.resolve() != blob_store.tmp_dir.resolve():
+                raise HTTPException(status_code=400,
+                                    detail="Upload is not in the blob store")
+            try:
+                metadata = await self.read_game_file_metadata(path,
+                                                              file_hash)
+            except HTTPException:
+                remove_file(path)
+                raise
+        async with self.game_file_lock(file_hash):
+            if upload_path is not None:
+                await asyncio.to_thread(blob_store.add, path, file_hash)
+            elif not await asyncio.to_thread(blob_store.has, file_hash):
+                raise HTTPException(status_code=404,
+                                    detail="Unknown file_hash")
+            else:
+                metadata = await self.read_game_file_metadata(
+                        blob_store.blob_path(file_hash), file_hash
+                        )
+            # Copies the whole file if the blob store is on another
+            # filesystem
+            await asyncio.to_thread(blob_store.link, file_hash,
+                                    game_file_path(server.id))
+            old_hash = server.archipelago_file_hash
+            server = state_cache.update(
+                    server_id,
+                    archipelago_file_name=file_name or
+                    server.archipelago_file_name,
+                    archipelago_file_hash=file_hash,
+                    archipelago_metadata=metadata,
+                    initialized=True
+                    )
+        if old_hash != file_hash:
+            await self.release_game_file(old_hash)
+        return server
+
+    async def start_server(self, server_id: int, hub_id: int, game_id: int,
+                           callback_url: str) -> Server:
+        server = await self.get_cached_server(server_id)
+        sm = server_manager.servers[server_id]
+        # Starts that fail right away do not need a slot
+        if sm.get_is_initilized() and sm.get_state() in [
+                ServerStateEnum.created,
+                ServerStateEnum.stopped,
+                ServerStateEnum.failed
+                ]:
+            try:
+                await admission.admit()
+            except NodeSaturatedException as e:
+                raise HTTPException(status_code=503, detail=str(e))
+        try:
+            await sm.start()
+        except ServerWrongStateException as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except ServerNotInitializedException:
+            sm.set_state(ServerStateEnum.failed)
+            raise HTTPException(status_code=400,
+                                detail=("Server is not initialized, "
+                                        "call /server/{server_id}/init to "
+                                        "initialize."
+                                        )
+                                )
+        # Only a start that was accepted takes over the callbacks, a
+        # rejected one must not redirect those of a running server. Nothing
+        # is notified before the next await.
+        state_cache.update(server_id,
+                           hub_id=hub_id,
+                           game_id=game_id,
+                           callback_url=callback_url)
+        return server
+
+    async def finish_start(self, server_id: int) -> None:
+        """
+        Waits for a started server to come up and tells the hub
+        """
+        await server_manager.servers[server_id].finish_startup()
+
+    async def stop_server(self, server_id: int) -> Server:
+        server = await self.get_cached_server(server_id)
+        sm = server_manager.servers[server.id]
+        try:
+            await sm.stop()
+        except ServerWrongStateException as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        sm.set_state(ServerStateEnum.stopped)
+        sm.notify_hub(HubEventEnum.stopped)
+        return server
+
+    async def send_cmd(self, server_id: int, cmd: str) -> Server:
+        server = await self.get_cached_server(server_id)
+        sm = server_manager.servers[server.id]
+        try:
+            await sm.send_cmd(cmd)
+        except ProcessNotRunningException as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return server
+
+    async def send_cmds(self, server_id: int, cmds: List[str], wait: bool,
+                        quiet_period: float | None = None,
+                        timeout: float | None = None
+                        ) -> List[CommandResult] | None:
+        server = await self.get_cached_server(server_id)
+        sm = server_manager.servers[server.id]
+        try:
+            return await sm.send_cmds(cmds, wait, quiet_period, timeout)
+        except ProcessNotRunningException as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    async def run_bulk(self, server_ids: List[int],
+                       operation: Callable[[int], Awaitable[Server]]
+                       ) -> List[BulkServerResult]:
+        """
+        Runs operation for every server through the bulk limiter, an error
+        for one server does not stop the others
+        """
+        async def run_one(server_id: int) -> BulkServerResult:
+            try:
+                server = await operation(server_id)
+            except HTTPException as e:
+                return BulkServerResult(server_id=server_id,
+                                        status_code=e.status_code,
+                                        detail=e.detail)
+            except Exception as e:
+                logger.exception(f"Bulk operation on server {server_id} "
+                                 "failed")
+                return BulkServerResult(server_id=server_id,
+                                        status_code=500,
+                                        detail=str(e))
+            return BulkServerResult(
+                    server_id=server_id, status_code=200,
+                    server=ServerPublic.model_validate(server)
+                    )
+        return await self.bulk_limiter.map(run_one,
+                                           list(dict.fromkeys(server_ids)))
+
+    async def bulk_start(self, hub_id: int, callback_url: str,
+                         servers: List[BulkStartServer]
+                         ) -> List[BulkServerResult]:
+        game_ids = {s.server_id: s.game_id for s in servers}
+
+        async def start_wait(server_id: int) -> Server:
+            await self.start_server(server_id, hub_id, game_ids[server_id],
+                                    callback_url)
+            await self.finish_start(server_id)
+            return state_cache.get(server_id)
+        return await self.run_bulk(list(game_ids), start_wait)
+
+    async def bulk_stop(self, server_ids: List[int]
+                        ) -> List[BulkServerResult]:
+        return await self.run_bulk(server_ids, self.stop_server)
+
+    async def bulk_send_cmd(self, server_ids: List[int], cmd: str
+                            ) -> List[BulkServerResult]:
+        async def send_cmd(server_id: int) -> Server:
+            return await self.send_cmd(server_id, cmd)
+        return await self.run_bulk(server_ids, send_cmd)
+
+
+# Operations the supervisor serves to remote controllers
+RPC_METHODS = [
+        "get_server",
+        "create_servers",
+        "delete_server",
+        "read_output",
+        "read_logs",
+        "search_logs",
+        "read_metrics",
+        "read_resources",
+        "read_node_resources",
+        "read_capacity",
+        "wait_for_changes",
+        "wait_for_output",
+        "init_server",
+        "start_server",
+        "stop_server",
+        "send_cmd",
+        "send_cmds",
+        "bulk_start",
+        "bulk_stop",
+        "bulk_send_cmd",
+        ]
+
+
+class RemoteController():
+    """
+    Forwards every operation to the supervisor process that owns the game
+    servers, so the API can run in several worker processes
+    """
+    def __init__(self, path: str):
+        self.client = RpcClient(path)
+
+    async def call(self, method: str, **params):
+        try:
+            return await self.client.call(method, **params)
+        except RpcException as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+        except RpcConnectionException as e:
+            logger.error(f"Supervisor unavailable: {e}")
+            raise HTTPException(status_code=503,
+                                detail="Supervisor unavailable")
+
+    async def get_server(self, server_id: int) -> Server:
+        return Server.model_validate(
+                await self.call("get_server", server_id=server_id)
+                )
+
+    async def create_servers(self, count: int) -> List[Server]:
+        servers = await self.call("create_servers", count=count)
+        return [Server.model_validate(server) for server in servers]
+
+    async def delete_server(self, server_id: int) -> None:
+        await self.call("delete_server", server_id=server_id)
+
+    async def read_output(self, server_id: int, since: int | None,
+                          last: int, limit: int) -> ServerOutput:
+        return ServerOutput.model_validate(await self.call(
+            "read_output", server_id=server_id, since=since, last=last,
+            limit=limit
+            ))
+
+    async def read_logs(self, server_id: int, since: float | None,
+                        until: float | None, tail: int | None, limit: int
+                        ) -> ServerLogs:
+        return ServerLogs.model_validate(await self.call(
+            "read_logs", server_id=server_id, since=since, until=until,
+            tail=tail, limit=limit
+            ))
+
+    async def search_logs(self, query: str, server_ids: List[int] | None,
+                          since: float | None, until: float | None,
+                          limit: int) -> LogSearchResult:
+        return LogSearchResult.model_validate(await self.call(
+            "search_logs", query=query, server_ids=server_ids, since=since,
+            until=until, limit=limit
+            ))
+
+    async def read_metrics(self) -> List[MetricFamily]:
+        families = await self.call("read_metrics")
+        return [MetricFamily.model_validate(family) for family in families]
+
+    async def read_resources(self, server_id: int) -> ServerResources:
+        return ServerResources.model_validate(
+                await self.call("read_resources", server_id=server_id)
+                )
+
+    async def read_node_resources(self) -> NodeResources:
+        return NodeResources.model_validate(
+                await self.call("read_node_resources")
+                )
+
+    async def read_capacity(self) -> NodeCapacity:
+        return NodeCapacity.model_validate(await self.call("read_capacity"))
+
+    async def wait_for_changes(self, since: int, epoch: str | None,
+                               timeout: float) -> ServerChanges:
+        return ServerChanges.model_validate(await self.call(
+            "wait_for_changes", since=since, epoch=epoch, timeout=timeout
+            ))
+
+    async def wait_for_output(self, server_id: int, since: int, limit: int,
+                              timeout: float) -> ServerOutput:
+        return ServerOutput.model_validate(await self.call(
+            "wait_for_output", server_id=server_id, since=since,
+            limit=limit, timeout=timeout
+            ))
+
+    async def init_server(self, server_id: int, file_hash: str,
+                          upload_path: str | None = None,
+                          file_name: str | None = None) -> Server:
+        return Server.model_validate(await self.call(
+            "init_server", server_id=server_id, file_hash=file_hash,
+            upload_path=upload_path, file_name=file_name
+            ))
+
+    async def start_server(self, server_id: int, hub_id: int, game_id: int,
+                           callback_url: str) -> Server:
+        return Server.model_validate(await self.call(
+            "start_server", server_id=server_id, hub_id=hub_id,
+            game_id=game_id, callback_url=callback_url
+            ))
+
+    async def finish_start(self, server_id: int) -> None:
+        # The supervisor waits for the startup itself
+        pass
+
+    async def stop_server(self, server_id: int) -> Server:
+        return Server.model_validate(
+                await self.call("stop_server", server_id=server_id)
+                )
+
+    async def send_cmd(self, server_id: int, cmd: str) -> Server:
+        return Server.model_validate(
+                await self.call("send_cmd", server_id=server_id, cmd=cmd)
+                )
+
+    async def send_cmds(self, server_id: int, cmds: List[str], wait: bool,
+                        quiet_period: float | None = None,
+                        timeout: float | None = None
+                        ) -> List[CommandResult] | None:
+        results = await self.call("send_cmds", server_id=server_id,
+                                  cmds=cmds, wait=wait,
+                                  quiet_period=quiet_period,
+                                  timeout=timeout)
+        if results is None:
+            return None
+        return [CommandResult.model_validate(r) for r in results]
+
+    async def bulk_start(self, hub_id: int, callback_url: str,
+                         servers: List[BulkStartServer]
+                         ) -> List[BulkServerResult]:
+        results = await self.call("bulk_start", hub_id=hub_id,
+                                  callback_url=callback_url,
+                                  servers=servers)
+        return [BulkServerResult.model_validate(r) for r in results]
+
+    async def bulk_stop(self, server_ids: List[int]
+                        ) -> List[BulkServerResult]:
+        results = await self.call("bulk_stop", server_ids=server_ids)
+        return [BulkServerResult.model_validate(r) for r in results]
+
+    async def bulk_send_cmd(self, server_ids: List[int], cmd: str
+                            ) -> List[BulkServerResult]:
+        results = await self.call("bulk_send_cmd", server_ids=server_ids,
+                                  cmd=cmd)
+        return [BulkServerResult.model_validate(r) for r in results]
+
+    async def close(self):
+        await self.client.close()
+
+
+local_controller = LocalController()
+remote_controller = RemoteController(settings.SUPERVISOR_SOCKET)
+
+
+def get_controller() -> LocalController | RemoteController:
+    if settings.SUPERVISOR_MODE == "remote":
+        return remote_controller
+    return local_controller
@@ -0,0 +1,175 @@
+import asyncio
+import inspect
+import logging
+import time
+from collections import deque
+from enum import Enum
+from typing import Awaitable, Callable
+from app.utils.metrics import callback_seconds, dispatch_seconds
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class BackpressurePolicyEnum(str, Enum):
+    # Wait for the subscriber to catch up, stalls the reader
+    block = "block"
+    # Drop the oldest queued line to make room for the new one
+    drop_oldest = "drop_oldest"
+    # Drop the whole backlog, the subscriber only gets the newest line
+    coalesce = "coalesce"
+
+
+LineCallback = Callable[[str], None | Awaitable[None]]
+
+_CLOSE = object()
+
+
+class Subscriber():
+    """
+    A callback with its own bounded queue, consumed by a dedicated task so
+    a slow callback only ever delays itself
+    """
+    def __init__(self, name: str, func: LineCallback,
+                 policy: BackpressurePolicyEnum, maxsize: int):
+        self.name = name
+        self.func = func
+        self.policy = policy
+        self.maxsize = maxsize
+        # Lines with the time they were queued at
+        self.queue: deque = deque()
+        self.dropped = 0
+        self.seconds = callback_seconds.labels(name)
+        self.wait_seconds = dispatch_seconds.labels(name)
+        self.task: asyncio.Task | None = None
+        self._ready: asyncio.Event | None = None
+        self._space: asyncio.Event | None = None
+
+    def start(self):
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self.queue.clear()
+        self.task = asyncio.create_task(self.run())
+
+    async def put(self, line: str):
+        if len(self.queue) >= self.maxsize:
+            if self.policy == BackpressurePolicyEnum.block:
+                while (len(self.queue) >= self.maxsize
+                       and not self.task.done()):
+                    self._space.clear()
+                    await self._space.wait()
+            elif self.policy == BackpressurePolicyEnum.drop_oldest:
+                self.queue.popleft()
+                self.dropped += 1
+            else:
+                self.dropped += len(self.queue)
+                self.queue.clear()
+        self.queue.append((line, time.perf_counter()))
+        self._ready.set()
+
+    def put_close(self):
+        self.queue.append(_CLOSE)
+        self._ready.set()
+
+    async def run(self):
+        try:
+            while True:
+                while not self.queue:
+                    self._ready.clear()
+                    await self._ready.wait()
+                item = self.queue.popleft()
+                self._space.set()
+                if item is _CLOSE:
+                    return
+                line, queued = item
+                started = time.perf_counter()
+                self.wait_seconds.observe(started - queued)
+                try:
+                    result = self.func(line)
+                    if inspect.isawaitable(result):
+                        await result
+                except Exception:
+                    logger.exception(f"Callback {self.name} failed")
+                self.seconds.observe(time.perf_counter() - started)
+        finally:
+            # Unblocks a reader waiting for space in a cancelled subscriber
+            self._space.set()
+
+
+class LineDispatcher():
+    """
+    Fans lines out to subscribers. Consumer tasks only run while the
+    dispatcher is started, which is for the lifetime of one process.
+    """
+    def __init__(self, policy: BackpressurePolicyEnum, maxsize: int):
+        self.policy = policy
+        self.maxsize = maxsize
+        self.subscribers: dict[str, Subscriber] = {}
+        self.loop: asyncio.AbstractEventLoop | None = None
+
+    @property
+    def running(self) -> bool:
+        return self.loop is not None
+
+    def subscribe(self, name: str, func: LineCallback,
+                  policy: BackpressurePolicyEnum | None = None,
+                  maxsize: int | None = None):
+        self.unsubscribe(name)
+        subscriber = Subscriber(name, func,
+                                policy or self.policy,
+                                maxsize or self.maxsize)
+        self.subscribers[name] = subscriber
+        if self.running:
+            self.call_in_loop(subscriber.start)
+
+    def unsubscribe(self, name: str) -> bool:
+        subscriber = self.subscribers.pop(name, None)
+        if subscriber is None:
+            return False
+        if subscriber.task is not None:
+            self.call_in_loop(subscriber.task.cancel)
+        return True
+
+    def call_in_loop(self, func, *args):
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self.loop:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        for subscriber in self.subscribers.values():
+            subscriber.start()
+
+    async def publish(self, line: str):
+        for subscriber in list(self.subscribers.values()):
+            if subscriber.task is not None:
+                await subscriber.put(line)
+
+    async def close(self, timeout: float):
+        """
+        Lets the subscribers work through their queues, subscribers that
+        are not done after timeout are cancelled
+        """
+        tasks = []
+        for subscriber in self.subscribers.values():
+            if subscriber.task is not None and not subscriber.task.done():
+                subscriber.put_close()
+                tasks.append(subscriber.task)
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+        self.cancel()
+
+    def cancel(self):
+        for subscriber in self.subscribers.values():
+            if subscriber.task is not None:
+                subscriber.task.cancel()
+                subscriber.task = None
+        self.loop = None
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import re
+import threading
+from datetime import datetime
+from app.db import session_handler
+from app.models.events import ServerEvent, ServerEventKindEnum
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# The server logs broadcasts as "Notice (all): ...", team messages as
+# "Notice (Team #1): ..." and item sends as "(Team #1) ...". Each first
+# word gets one regex with an alternative per message, the group of the
+# alternative that matched names the event kind.
+_TEAM = r" \(Team #\d+\)"
+_NOTICE = re.compile(
+    r"Notice \([^)]*\): (?:"
+    rf"(?P<joined>(?P<joined_player>.+?){_TEAM} playing "
+    r"(?P<joined_game>.+?) has joined\..*)"
+    rf"|(?P<left>(?P<left_player>.+?){_TEAM} has left the game\..*)"
+    rf"|(?P<goal>(?P<goal_player>.+?){_TEAM} has completed their goal\.)"
+    rf"|(?P<released>(?P<released_player>.+?){_TEAM} has released all "
+    r"remaining items from their world\.)"
+    r"|(?P<hint>\[Hint\]: (?P<hint_receiver>.+?)'s (?P<hint_item>.+?) is "
+    r"at (?P<hint_location>.+?) in (?P<hint_player>.+?)'s World.*)"
+    r"|(?P<chat>(?P<chat_player>[^:\[]+): .*)"
+    r")$"
+    )
+_ITEM = re.compile(
+    r"\(Team #\d+\) (?:"
+    r"(?P<item_sent>(?P<item_sent_player>.+?) sent (?P<item_sent_item>.+?)"
+    r" to (?P<item_sent_receiver>.+?) \((?P<item_sent_location>.*)\))"
+    r")$"
+    )
+_ERROR = re.compile(r"(?P<error>.*)$")
+
+_FIRST_WORDS = {
+        "Notice": _NOTICE,
+        "(Team": _ITEM,
+        "Traceback": _ERROR,
+        "ERROR": _ERROR,
+        "Exception:": _ERROR,
+        }
+_FIELDS = ["player", "receiver", "item", "location", "game"]
+
+
+def classify_line(line: str, stream: str = "stdout"
+                  ) -> tuple[ServerEventKindEnum, dict] | None:
+    """
+    Returns the kind of event the line is, and what it says about whom,
+    or None for lines that are no event. Everything on stderr is an error.
+    """
+    if stream == "stderr":
+        return ServerEventKindEnum.error, {}
+    pattern = _FIRST_WORDS.get(line.split(" ", 1)[0])
+    if pattern is None:
+        return None
+    match = pattern.match(line)
+    if match is None:
+        return None
+    groups = match.groupdict()
+    kind = next(kind for kind in ServerEventKindEnum
+                if groups.get(kind.value) is not None)
+    fields = {field: groups.get(f"{kind.value}_{field}")
+              for field in _FIELDS}
+    return kind, {field: value for field, value in fields.items()
+                  if value is not None}
+
+
+class ServerEventWriter():
+    """
+    Collects the events read from server output and inserts them in
+    batches. While the writer task runs, events are written every interval
+    seconds off the event loop, without it every event is written at once.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: list[ServerEvent] = []
+        self._running = False
+
+    def add_line(self, server_id: int, line: str, stream: str = "stdout"):
+        classified = classify_line(line, stream)
+        if classified is None:
+            return
+        kind, fields = classified
+        event = ServerEvent(server_id=server_id, at=datetime.utcnow(),
+                            kind=kind, message=line, **fields)
+        with self._lock:
+            self._pending.append(event)
+        if not self._running:
+            self.flush()
+
+    def flush(self) -> bool:
+        with self._lock:
+            events, self._pending = self._pending, []
+        if not events:
+            return True
+        try:
+            session = next(session_handler.get_session())
+            try:
+                session.add_all(events)
+                session.commit()
+            finally:
+                session.close()
+        except Exception:
+            logger.exception("Writing server events failed, will retry")
+            with self._lock:
+                self._pending = events + self._pending
+            return False
+        return True
+
+    async def run(self, interval: float):
+        self._running = True
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                await asyncio.to_thread(self.flush)
+        finally:
+            self._running = False
+
+
+event_writer = ServerEventWriter()
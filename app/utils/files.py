@@ -0,0 +1,103 @@
+import ctypes
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+
+
+GAMES_DIR = Path("arch_games_dev/")
+BLOB_DIR = GAMES_DIR / "blobs"
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+try:
+    _fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                           ctypes.c_int64]
+except (OSError, AttributeError):
+    _fallocate = None
+
+
+class FileTooLargeException(Exception):
+    pass
+
+
+def server_dir(server_id: int) -> Path:
+    return GAMES_DIR / str(server_id)
+
+
+def game_file_path(server_id: int) -> Path:
+    return server_dir(server_id) / "game.archipelago"
+
+
+def stdout_log_path(server_id: int) -> Path:
+    return server_dir(server_id) / "stdout.log"
+
+
+def stderr_log_path(server_id: int) -> Path:
+    return server_dir(server_id) / "stderr.log"
+
+
+def log_dir(server_id: int) -> Path:
+    return server_dir(server_id) / "logs"
+
+
+def stdin_fifo_path(server_id: int) -> Path:
+    return server_dir(server_id) / "stdin.fifo"
+
+
+def remove_file(path: Path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def punch_hole(fd: int, length: int) -> bool:
+    """
+    Frees the disk space of the first length bytes of the file, which read
+    as zeros after. The size and the offsets of everything after stay the
+    same. Returns False if the platform or file system does not support it.
+    """
+    if _fallocate is None or length <= 0:
+        return False
+    return _fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                      0, length) == 0
+
+
+async def stream_upload_to_temp(upload: UploadFile, directory: Path,
+                                max_size: int,
+                                chunk_size: int) -> tuple[Path, str, int]:
+    """
+    Copies upload in chunks to a new temp file in directory while hashing
+    it. Disk IO and hashing happen in the threadpool. Returns the path of
+    the fully written temp file, the sha256 and the size.
+    """
+    fd, tmp_name = await run_in_threadpool(
+            tempfile.mkstemp, dir=directory, suffix=".part"
+            )
+    sha256 = hashlib.sha256()
+    size = 0
+
+    def write_chunk(f, chunk: bytes):
+        sha256.update(chunk)
+        f.write(chunk)
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while chunk := await upload.read(chunk_size):
+                size += len(chunk)
+                if size > max_size:
+                    raise FileTooLargeException(
+                            f"File too large, max size is {max_size} bytes"
+                            )
+                await run_in_threadpool(write_chunk, f, chunk)
+            await run_in_threadpool(f.flush)
+            await run_in_threadpool(os.fsync, f.fileno())
+    except BaseException:
+        await run_in_threadpool(remove_file, Path(tmp_name))
+        raise
+    return Path(tmp_name), sha256.hexdigest(), size
@@ -0,0 +1,133 @@
+import asyncio
+import ctypes
+import os
+import struct
+from pathlib import Path
+
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+# struct inotify_event without the name that follows it
+EVENT = struct.Struct("iIII")
+# The wd of the event that tells events were lost
+OVERFLOW_WD = -1
+
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _libc.inotify_init1
+except (OSError, AttributeError):
+    _libc = None
+
+
+def _check(result: int) -> int:
+    if result < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return result
+
+
+class FileWatcher():
+    """
+    Wakes up waiters when a watched file is written to or closed after
+    writing. There is one inotify instance per event loop for all files,
+    a user only gets a few of them.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.fd = _check(_libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC))
+        # How many users every watch has, and who waits for it
+        self.watches: dict[int, int] = {}
+        self.waiters: dict[int, set[asyncio.Future]] = {}
+        loop.add_reader(self.fd, self.on_readable)
+
+    def add(self, path: Path) -> int:
+        wd = _check(_libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                            IN_MODIFY | IN_CLOSE_WRITE))
+        self.watches[wd] = self.watches.get(wd, 0) + 1
+        return wd
+
+    def remove(self, wd: int):
+        self.watches[wd] -= 1
+        if self.watches[wd] == 0:
+            del self.watches[wd]
+            # Fails if the file is gone, which removed the watch already
+            _libc.inotify_rm_watch(self.fd, wd)
+        if not self.watches:
+            self.close()
+
+    async def wait(self, wd: int, timeout: float, fd: int | None = None):
+        """
+        Returns after the next event of the watch, once fd is readable, or
+        after timeout seconds
+        """
+        waiter = self.loop.create_future()
+        self.waiters.setdefault(wd, set()).add(waiter)
+        if fd is not None:
+            self.loop.add_reader(fd, self.wake, waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if fd is not None:
+                self.loop.remove_reader(fd)
+            waiters = self.waiters.get(wd)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self.waiters[wd]
+
+    def on_readable(self):
+        woken = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, _, _, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size + length
+                if wd == OVERFLOW_WD:
+                    woken.update(self.waiters)
+                else:
+                    woken.add(wd)
+        for wd in woken:
+            for waiter in self.waiters.pop(wd, ()):
+                self.wake(waiter)
+
+    @staticmethod
+    def wake(waiter: asyncio.Future):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    def close(self):
+        _watchers.pop(self.loop, None)
+        self.loop.remove_reader(self.fd)
+        os.close(self.fd)
+        for waiters in self.waiters.values():
+            for waiter in waiters:
+                self.wake(waiter)
+        self.waiters = {}
+
+
+_watchers: dict[asyncio.AbstractEventLoop, FileWatcher] = {}
+
+
+def add_watch(path: Path) -> tuple[FileWatcher, int] | None:
+    """
+    Watches path from the running loop, returns None if the platform has
+    no inotify or the watch could not be added
+    """
+    if _libc is None:
+        return None
+    loop = asyncio.get_running_loop()
+    watcher = _watchers.get(loop)
+    try:
+        if watcher is None:
+            watcher = _watchers[loop] = FileWatcher(loop)
+        return watcher, watcher.add(path)
+    except OSError:
+        if watcher is not None and not watcher.watches:
+            watcher.close()
+        return None
@@ -0,0 +1,113 @@
+from typing import Callable
+from fastapi import HTTPException
+from sqlmodel import select
+from app.db import session_handler
+from app.models.logs import LogPosting, LogSearchHit, LogSearchResult
+from app.utils.log_store import LogRecord, log_store, tokenize, utc_datetime
+
+
+# The first time a candidate can have lines of, the server and how to read
+# its lines
+Candidate = tuple[float, int, Callable[[], list[LogRecord]]]
+
+
+def segment_candidates(tokens: set[str], server_ids: list[int] | None,
+                       since: float | None, until: float | None
+                       ) -> list[Candidate]:
+    """
+    The blocks of rotated segments the posting table has every token in
+    """
+    statement = select(LogPosting.server_id, LogPosting.segment,
+                       LogPosting.blocks).where(LogPosting.token.in_(tokens))
+    if server_ids:
+        statement = statement.where(LogPosting.server_id.in_(server_ids))
+    if since is not None:
+        statement = statement.where(LogPosting.last_at >= since)
+    if until is not None:
+        statement = statement.where(LogPosting.first_at < until)
+    session = next(session_handler.get_session())
+    try:
+        rows = session.exec(statement).all()
+    finally:
+        session.close()
+
+    found: dict[tuple[int, int], list[set[int]]] = {}
+    for server_id, segment, blocks in rows:
+        found.setdefault((server_id, segment), []).append(set(blocks))
+    candidates = []
+    for (server_id, segment), block_sets in found.items():
+        if len(block_sets) < len(tokens):
+            continue
+        log = log_store.get(server_id)
+        index = log.segment_blocks(segment)
+        for block in sorted(set.intersection(*block_sets)):
+            if block >= len(index) or \
+                    (since is not None and index[block].last_at < since) or \
+                    (until is not None and index[block].first_at >= until):
+                continue
+            candidates.append((
+                index[block].first_at, server_id,
+                lambda log=log, segment=segment, block=block:
+                    log.read_segment_block(segment, block)
+                ))
+    return candidates
+
+
+def active_candidates(tokens: set[str], server_ids: list[int] | None,
+                      until: float | None) -> list[Candidate]:
+    """
+    The chunks of active files with every token, and the lines not written
+    yet
+    """
+    candidates = []
+    for server_id in server_ids or log_store.server_ids():
+        log = log_store.get(server_id)
+        for first_at, chunk in log.active_chunks(tokens):
+            if until is None or first_at < until:
+                candidates.append((
+                    first_at, server_id,
+                    lambda log=log, chunk=chunk: log.read_active_chunk(chunk)
+                    ))
+        pending = log.read_pending()
+        if pending:
+            candidates.append((pending[0].at, server_id, lambda p=pending: p))
+    return candidates
+
+
+def search_logs(query: str, server_ids: list[int] | None,
+                since: float | None, until: float | None, limit: int
+                ) -> LogSearchResult:
+    """
+    Returns the first limit stored lines of the servers with every word of
+    query, from since until until as unix times.
+
+    Only the blocks the inverted index has every word in are read, in the
+    order of their first line. Reading stops once the next block starts
+    after the last line that made it into the result.
+    """
+    tokens = tokenize(query)
+    if not tokens:
+        raise HTTPException(status_code=422,
+                            detail="The query has no words to search for")
+    candidates = segment_candidates(tokens, server_ids, since, until) + \
+        active_candidates(tokens, server_ids, until)
+    candidates.sort(key=lambda candidate: candidate[0])
+
+    # One more than the limit shows whether the result is truncated
+    hits: list[tuple[float, int, LogRecord]] = []
+    for first_at, server_id, read in candidates:
+        if len(hits) > limit and first_at > hits[limit][0]:
+            break
+        for record in read():
+            if (since is not None and record.at < since) or \
+                    (until is not None and record.at >= until):
+                continue
+            if tokens <= tokenize(record.line):
+                hits.append((record.at, server_id, record))
+        hits.sort(key=lambda hit: hit[:2])
+        del hits[limit + 1:]
+    return LogSearchResult(hits=[
+        LogSearchHit(server_id=server_id, at=utc_datetime(at),
+                     stream=record.stream, line=record.line)
+        for at, server_id, record in hits[:limit]
+        ], truncated=len(hits) > limit)
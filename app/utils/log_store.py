@@ -0,0 +1,638 @@
+import asyncio
+import bisect
+import logging
+import mmap
+import os
+import re
+import shutil
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator, NamedTuple
+from sqlmodel import delete, select
+from app.core.config import settings
+from app.db import session_handler
+from app.models.logs import LogPosting
+from app.models.servers import ServerLogLine, ServerLogs
+from app.utils.files import GAMES_DIR, log_dir, remove_file
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# A record is the unix time it was read at, the stream and the length of
+# the UTF-8 line that follows
+RECORD = struct.Struct(">dBI")
+# A segment is a series of independently compressed blocks, its index has
+# the first and last time, offset and length of every block
+INDEX_ENTRY = struct.Struct(">ddQI")
+STREAMS = ["stdout", "stderr"]
+
+# Searches match whole words, tokens longer than this are not indexed
+TOKEN = re.compile(r"\w+")
+MAX_TOKEN_LENGTH = 64
+
+ACTIVE_NAME = "active.log"
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+
+
+class LogRecord(NamedTuple):
+    at: float
+    stream: str
+    line: str
+
+
+class BlockIndex(NamedTuple):
+    first_at: float
+    last_at: float
+    offset: int
+    length: int
+
+
+def unix_time(at: datetime | None) -> float | None:
+    """
+    Times without a timezone are UTC, like every time the API returns
+    """
+    if at is None:
+        return None
+    if at.tzinfo is None:
+        at = at.replace(tzinfo=timezone.utc)
+    return at.timestamp()
+
+
+def utc_datetime(at: float) -> datetime:
+    return datetime.fromtimestamp(at, timezone.utc).replace(tzinfo=None)
+
+
+def to_server_logs(records: list[LogRecord], truncated: bool = False
+                   ) -> ServerLogs:
+    return ServerLogs(lines=[
+        ServerLogLine(at=utc_datetime(record.at), stream=record.stream,
+                      line=record.line)
+        for record in records
+        ], truncated=truncated)
+
+
+def tokenize(text: str) -> set[str]:
+    return {token for token in TOKEN.findall(text.lower())
+            if len(token) <= MAX_TOKEN_LENGTH}
+
+
+def block_tokens(blocks: list[list[LogRecord]]) -> dict[str, list[int]]:
+    """
+    Returns the numbers of the blocks every token appears in
+    """
+    postings: dict[str, list[int]] = {}
+    for number, records in enumerate(blocks):
+        tokens = set()
+        for record in records:
+            tokens |= tokenize(record.line)
+        for token in tokens:
+            postings.setdefault(token, []).append(number)
+    return postings
+
+
+def encode_records(records: list[LogRecord]) -> bytes:
+    parts = []
+    for record in records:
+        data = record.line.encode("utf-8", errors="replace")
+        parts.append(RECORD.pack(record.at, STREAMS.index(record.stream),
+                                 len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def decode_records(data: bytes | memoryview) -> Iterator[LogRecord]:
+    """
+    Yields the records in data, a record that was only partly written is
+    skipped
+    """
+    offset = 0
+    while offset + RECORD.size <= len(data):
+        at, stream, length = RECORD.unpack_from(data, offset)
+        start = offset + RECORD.size
+        if start + length > len(data):
+            return
+        line = bytes(data[start:start + length]).decode("utf-8",
+                                                        errors="replace")
+        yield LogRecord(at, STREAMS[stream], line)
+        offset = start + length
+
+
+class Segment():
+    """
+    A rotated, compressed part of the log of a server. Blocks are read
+    through a memory map, only the blocks a read needs are decompressed.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self.index_path = path.with_suffix(INDEX_SUFFIX)
+        with open(self.index_path, "rb") as f:
+            data = f.read()
+        self.blocks = [BlockIndex(*INDEX_ENTRY.unpack_from(data, offset))
+                       for offset in range(0, len(data), INDEX_ENTRY.size)]
+        self._last_ats = [block.last_at for block in self.blocks]
+
+    @property
+    def number(self) -> int:
+        return int(self.path.stem)
+
+    @property
+    def first_at(self) -> float:
+        return self.blocks[0].first_at if self.blocks else 0
+
+    @property
+    def last_at(self) -> float:
+        return self.blocks[-1].last_at if self.blocks else 0
+
+    @property
+    def size(self) -> int:
+        return self.path.stat().st_size + self.index_path.stat().st_size
+
+    def read_blocks(self, numbers: list[int]) -> Iterator[list[LogRecord]]:
+        if not numbers:
+            return
+        with open(self.path, "rb") as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for number in numbers:
+                block = self.blocks[number]
+                data = zlib.decompress(
+                        mapped[block.offset:block.offset + block.length]
+                        )
+                yield list(decode_records(data))
+
+    def read(self, since: float | None, until: float | None
+             ) -> Iterator[LogRecord]:
+        start = 0 if since is None else bisect.bisect_left(self._last_ats,
+                                                           since)
+        numbers = [number for number in range(start, len(self.blocks))
+                   if until is None or self.blocks[number].first_at < until]
+        for records in self.read_blocks(numbers):
+            for record in records:
+                if (since is None or record.at >= since) and \
+                        (until is None or record.at < until):
+                    yield record
+
+    def remove(self):
+        remove_file(self.index_path)
+        remove_file(self.path)
+
+
+def split_blocks(records: list[LogRecord], block_size: int
+                 ) -> list[list[LogRecord]]:
+    """
+    Splits records into blocks of about block_size bytes each
+    """
+    blocks = []
+    start = 0
+    while start < len(records):
+        end, size = start, 0
+        while end < len(records) and (size < block_size or end == start):
+            size += RECORD.size + len(records[end].line)
+            end += 1
+        blocks.append(records[start:end])
+        start = end
+    return blocks
+
+
+def write_segment(path: Path, record_blocks: list[list[LogRecord]]
+                  ) -> list[BlockIndex]:
+    """
+    Compresses every block on its own, the index is renamed into place
+    before the segment so readers never see a segment without one
+    """
+    blocks = []
+    tmp_path = path.with_suffix(SEGMENT_SUFFIX + ".part")
+    with open(tmp_path, "wb") as f:
+        for records in record_blocks:
+            data = zlib.compress(encode_records(records))
+            blocks.append(BlockIndex(records[0].at, records[-1].at,
+                                     f.tell(), len(data)))
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    index_tmp_path = path.with_suffix(INDEX_SUFFIX + ".part")
+    with open(index_tmp_path, "wb") as f:
+        f.write(b"".join(INDEX_ENTRY.pack(*block) for block in blocks))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(index_tmp_path, path.with_suffix(INDEX_SUFFIX))
+    os.replace(tmp_path, path)
+    return blocks
+
+
+def segment_postings(segment: Segment, blocks: list[list[LogRecord]]
+                     ) -> list[LogPosting]:
+    """
+    The postings of a segment, without the server id the store sets
+    """
+    return [LogPosting(token=token, server_id=0, segment=segment.number,
+                       blocks=numbers, first_at=segment.first_at,
+                       last_at=segment.last_at)
+            for token, numbers in block_tokens(blocks).items()]
+
+
+class ServerLog():
+    """
+    The stored output of one server.
+
+    Lines are appended to an active file, with a sparse index of the time
+    every index_interval bytes. Once the active file is large or old
+    enough it is rotated into a compressed segment.
+
+    The tokens of the active file are indexed in memory by chunk, the
+    chunk of an index entry ending at the next one. The tokens of rotated
+    segments are queued in unindexed for the posting table.
+    """
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.active_path = directory / ACTIVE_NAME
+        self.lock = threading.Lock()
+        self.pending: list[LogRecord] = []
+        self.segments: list[Segment] | None = None
+        # (offset, time) of a record every index_interval bytes
+        self.active_index: list[tuple[int, float]] = []
+        self.active_size = 0
+        self.active_tokens: dict[str, set[int]] = {}
+        # Postings of rotated segments, and numbers of removed segments,
+        # not written to the posting table yet
+        self.unindexed: list[list[LogPosting]] = []
+        self.removed: list[int] = []
+        # Compare the segments with the posting table after loading
+        self.check_index = False
+
+    def load(self):
+        """
+        Reads the segment indexes and indexes the active file, once
+        """
+        if self.segments is not None:
+            return
+        self.segments = [Segment(path) for path in
+                         sorted(self.directory.glob("*" + SEGMENT_SUFFIX))]
+        self.check_index = True
+        self.active_index = []
+        self.active_size = 0
+        self.active_tokens = {}
+        if self.active_path.exists():
+            with open(self.active_path, "rb") as f:
+                data = f.read()
+            offset = 0
+            for record in decode_records(data):
+                self.index_active(offset, record)
+                offset += RECORD.size + len(record.line.encode())
+            # A record cut off by a crash is overwritten by the next write
+            self.active_size = offset
+
+    def index_active(self, offset: int, record: LogRecord):
+        if not self.active_index or offset - self.active_index[-1][0] >= \
+                settings.SERVER_LOG_INDEX_INTERVAL:
+            self.active_index.append((offset, record.at))
+        chunk = len(self.active_index) - 1
+        for token in tokenize(record.line):
+            self.active_tokens.setdefault(token, set()).add(chunk)
+
+    def append(self, record: LogRecord):
+        self.pending.append(record)
+
+    def flush(self):
+        with self.lock:
+            self.load()
+            records, self.pending = self.pending, []
+            if records:
+                self.write_active(records)
+            if self.should_rotate():
+                self.rotate()
+
+    def write_active(self, records: list[LogRecord]):
+        data = []
+        offset = self.active_size
+        index = list(self.active_index)
+        for record in records:
+            encoded = encode_records([record])
+            # Tokens of a failed write only cost a wasted search read
+            self.index_active(offset, record)
+            offset += len(encoded)
+            data.append(encoded)
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            with open(self.active_path, "r+b" if self.active_path.exists()
+                      else "wb") as f:
+                f.seek(self.active_size)
+                f.write(b"".join(data))
+                f.truncate()
+        except OSError:
+            # Written with the next flush
+            self.active_index = index
+            self.pending = records + self.pending
+            raise
+        self.active_size = offset
+
+    def should_rotate(self) -> bool:
+        if not self.active_index:
+            return False
+        age = time.time() - self.active_index[0][1]
+        return self.active_size >= settings.SERVER_LOG_SEGMENT_SIZE or \
+            age >= settings.SERVER_LOG_SEGMENT_AGE
+
+    def rotate(self):
+        with open(self.active_path, "rb") as f:
+            records = list(decode_records(f.read()))
+        if records:
+            number = self.segments[-1].number + 1 if self.segments else 0
+            path = self.directory / f"{number:010d}{SEGMENT_SUFFIX}"
+            blocks = split_blocks(records, settings.SERVER_LOG_BLOCK_SIZE)
+            write_segment(path, blocks)
+            segment = Segment(path)
+            self.segments.append(segment)
+            self.unindexed.append(segment_postings(segment, blocks))
+        remove_file(self.active_path)
+        self.active_index = []
+        self.active_size = 0
+        self.active_tokens = {}
+        self.enforce_retention()
+
+    def enforce_retention(self):
+        """
+        Drops the oldest segments while they are older than the retention
+        time, or the log is larger than the max size
+        """
+        oldest_kept = time.time() - settings.SERVER_LOG_RETENTION
+        total = sum(segment.size for segment in self.segments)
+        while self.segments and (self.segments[0].last_at < oldest_kept
+                                 or total > settings.SERVER_LOG_MAX_BYTES):
+            segment = self.segments.pop(0)
+            total -= segment.size
+            segment.remove()
+            self.removed.append(segment.number)
+
+    def segment(self, number: int) -> Segment | None:
+        for segment in self.segments:
+            if segment.number == number:
+                return segment
+        return None
+
+    def segment_blocks(self, number: int) -> list[BlockIndex]:
+        with self.lock:
+            self.load()
+            segment = self.segment(number)
+            return segment.blocks if segment is not None else []
+
+    def read_segment_block(self, number: int, block: int
+                           ) -> list[LogRecord]:
+        with self.lock:
+            self.load()
+            segment = self.segment(number)
+            if segment is None or block >= len(segment.blocks):
+                # Removed by the retention since the postings were read
+                return []
+            return next(segment.read_blocks([block]))
+
+    def active_chunks(self, tokens: set[str]) -> list[tuple[float, int]]:
+        """
+        Returns the first time and number of every chunk of the active file
+        that has all tokens
+        """
+        with self.lock:
+            self.load()
+            chunks = None
+            for token in tokens:
+                found = self.active_tokens.get(token, set())
+                chunks = found if chunks is None else chunks & found
+            return [(self.active_index[chunk][1], chunk)
+                    for chunk in sorted(chunks or [])
+                    if chunk < len(self.active_index)]
+
+    def read_active_chunk(self, chunk: int) -> list[LogRecord]:
+        with self.lock:
+            if chunk >= len(self.active_index):
+                # Rotated since the chunk was looked up, a rare miss
+                return []
+            end = self.active_index[chunk + 1][0] \
+                if chunk + 1 < len(self.active_index) else None
+            return self.read_active(self.active_index[chunk][0], end)
+
+    def read_pending(self) -> list[LogRecord]:
+        with self.lock:
+            return list(self.pending)
+
+    def read_active(self, start: int = 0, end: int | None = None
+                    ) -> list[LogRecord]:
+        end = self.active_size if end is None else end
+        if end <= start:
+            return []
+        with open(self.active_path, "rb") as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return list(decode_records(mapped[start:end]))
+
+    def read(self, since: float | None, until: float | None, limit: int
+             ) -> list[LogRecord]:
+        """
+        Returns the first limit lines read at or after since and before
+        until, oldest first
+        """
+        with self.lock:
+            self.load()
+            records = []
+            for segment in self.segments:
+                if since is not None and segment.last_at < since:
+                    continue
+                if until is not None and segment.first_at >= until:
+                    break
+                for record in segment.read(since, until):
+                    records.append(record)
+                    if len(records) >= limit:
+                        return records
+            start_offset = 0
+            if since is not None:
+                # The last indexed record before since
+                times = [at for _, at in self.active_index]
+                position = bisect.bisect_left(times, since) - 1
+                if position >= 0:
+                    start_offset = self.active_index[position][0]
+            for record in self.read_active(start_offset) + self.pending:
+                if (since is None or record.at >= since) and \
+                        (until is None or record.at < until):
+                    records.append(record)
+                    if len(records) >= limit:
+                        break
+            return records
+
+    def tail(self, count: int) -> list[LogRecord]:
+        """
+        Returns the last count lines, reading back one index interval or
+        block at a time only as far as needed
+        """
+        with self.lock:
+            self.load()
+            records = list(self.pending)
+            end = self.active_size
+            for start, _ in reversed(self.active_index):
+                if len(records) >= count:
+                    return records[-count:]
+                records = self.read_active(start, end) + records
+                end = start
+            for segment in reversed(self.segments):
+                for number in reversed(range(len(segment.blocks))):
+                    if len(records) >= count:
+                        return records[-count:]
+                    records = next(segment.read_blocks([number])) + records
+            return records[-count:]
+
+    def remove(self):
+        with self.lock:
+            self.pending = []
+            self.segments = None
+            self.unindexed = []
+            self.removed = []
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class LogStore():
+    """
+    Stores the output of every server. While the writer task runs, lines
+    are written every interval seconds off the event loop, without it every
+    line is written at once.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.logs: dict[int, ServerLog] = {}
+        self._running = False
+
+    def get(self, server_id: int) -> ServerLog:
+        with self._lock:
+            log = self.logs.get(server_id)
+            if log is None:
+                log = self.logs[server_id] = ServerLog(log_dir(server_id))
+            return log
+
+    def append(self, server_id: int, line: str, stream: str = "stdout"):
+        log = self.get(server_id)
+        log.append(LogRecord(time.time(), stream, line))
+        if not self._running:
+            self.flush_log(server_id, log)
+
+    def flush(self):
+        for server_id, log in list(self.logs.items()):
+            self.flush_log(server_id, log)
+
+    def flush_log(self, server_id: int, log: ServerLog):
+        try:
+            log.flush()
+        except Exception:
+            logger.exception(f"Writing the log in {log.directory} failed")
+        try:
+            self.write_postings(server_id, log)
+        except Exception:
+            logger.exception(f"Indexing the log in {log.directory} failed, "
+                             "will retry")
+
+    def write_postings(self, server_id: int, log: ServerLog):
+        """
+        Writes the postings of new segments and drops those of removed
+        ones, after a load also of segments a crash left out
+        """
+        with log.lock:
+            if log.segments is None:
+                return
+            if log.check_index:
+                self.queue_unindexed(server_id, log)
+                log.check_index = False
+            unindexed, log.unindexed = log.unindexed, []
+            removed, log.removed = log.removed, []
+        if not unindexed and not removed:
+            return
+        try:
+            session = next(session_handler.get_session())
+            try:
+                for number in removed:
+                    session.exec(delete(LogPosting).where(
+                        LogPosting.server_id == server_id,
+                        LogPosting.segment == number
+                        ))
+                for postings in unindexed:
+                    for posting in postings:
+                        posting.server_id = server_id
+                    session.add_all(postings)
+                session.commit()
+            finally:
+                session.close()
+        except Exception:
+            with log.lock:
+                log.unindexed = unindexed + log.unindexed
+                log.removed = removed + log.removed
+            raise
+
+    def queue_unindexed(self, server_id: int, log: ServerLog):
+        session = next(session_handler.get_session())
+        try:
+            indexed = set(session.exec(
+                select(LogPosting.segment).distinct()
+                .where(LogPosting.server_id == server_id)
+                ).all())
+        finally:
+            session.close()
+        numbers = {segment.number for segment in log.segments}
+        log.removed += sorted(indexed - numbers)
+        for segment in log.segments:
+            if segment.number not in indexed:
+                blocks = list(segment.read_blocks(
+                    list(range(len(segment.blocks)))))
+                log.unindexed.append(segment_postings(segment, blocks))
+
+    async def run(self, interval: float):
+        self._running = True
+        # Logs of servers that stopped writing are never rotated, so the
+        # retention is also applied every segment age
+        loop = asyncio.get_running_loop()
+        retention_at = loop.time() + settings.SERVER_LOG_SEGMENT_AGE
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                await asyncio.to_thread(self.flush)
+                if loop.time() >= retention_at:
+                    retention_at = loop.time() + \
+                        settings.SERVER_LOG_SEGMENT_AGE
+                    await asyncio.to_thread(self.enforce_retention)
+        finally:
+            self._running = False
+
+    def read(self, server_id: int, since: float | None, until: float | None,
+             limit: int) -> list[LogRecord]:
+        return self.get(server_id).read(since, until, limit)
+
+    def tail(self, server_id: int, count: int) -> list[LogRecord]:
+        return self.get(server_id).tail(count)
+
+    def remove(self, server_id: int):
+        """
+        Removes the stored output, the postings go with the server
+        """
+        with self._lock:
+            log = self.logs.pop(server_id, None)
+        (log or ServerLog(log_dir(server_id))).remove()
+
+    def server_ids(self) -> list[int]:
+        """
+        Every server with stored output
+        """
+        return sorted(int(directory.parent.name)
+                      for directory in GAMES_DIR.glob("*/logs")
+                      if directory.parent.name.isdigit())
+
+    def enforce_retention(self):
+        """
+        Applies the retention to the logs of every server, also of servers
+        that do not run anymore
+        """
+        for server_id in self.server_ids():
+            log = self.get(server_id)
+            with log.lock:
+                log.load()
+                log.enforce_retention()
+
+
+log_store = LogStore()
@@ -0,0 +1,341 @@
+import abc
+import bisect
+import contextvars
+import math
+import threading
+import time
+from typing import Callable, Iterable
+from app.models.metrics import MetricFamily, MetricSample
+
+
+# Seconds, for operations that take milliseconds to seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+# Seconds, for server starts and stops
+PROCESS_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0,
+                   120.0)
+# Seconds, for callbacks that run for every output line
+CALLBACK_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01,
+                    0.05, 0.1, 0.5, 1.0)
+
+
+class CounterChild():
+    """
+    The value of one label combination. Metrics are updated from the
+    event loop, an update is a plain attribute add without any locking.
+    """
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+
+class GaugeChild(CounterChild):
+    __slots__ = ()
+
+    def set(self, value: float):
+        self.value = value
+
+
+class HistogramChild():
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        # The last count is for the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metric(abc.ABC):
+    type = ""
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.children: dict[tuple[str, ...], object] = {}
+
+    @abc.abstractmethod
+    def new_child(self) -> object:
+        """
+        Returns a child for a new label combination
+        """
+
+    def labels(self, *values) -> object:
+        """
+        Returns the child of the label values, hot paths look it up once
+        and keep it
+        """
+        key = tuple(str(value) for value in values)
+        child = self.children.get(key)
+        if child is None:
+            child = self.children.setdefault(key, self.new_child())
+        return child
+
+    def remove(self, *values):
+        self.children.pop(tuple(str(value) for value in values), None)
+
+    def clear(self):
+        self.children = {}
+
+    def samples(self) -> Iterable[MetricSample]:
+        for key, child in list(self.children.items()):
+            yield MetricSample(name=self.name,
+                               labels=dict(zip(self.labelnames, key)),
+                               value=child.value)
+
+    def collect(self) -> MetricFamily:
+        return MetricFamily(name=self.name, type=self.type,
+                            help=self.documentation,
+                            samples=list(self.samples()))
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def new_child(self) -> CounterChild:
+        return CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    """
+    Without children, a gauge with a function reports what the function
+    returns for every label combination at collection time
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: tuple[str, ...] = (),
+                 function: Callable[[], dict[tuple[str, ...], float]]
+                 | None = None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def new_child(self) -> GaugeChild:
+        return GaugeChild()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def samples(self) -> Iterable[MetricSample]:
+        if self.function is None:
+            yield from super().samples()
+            return
+        for key, value in self.function().items():
+            yield MetricSample(name=self.name,
+                               labels=dict(zip(self.labelnames, key)),
+                               value=value)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+
+    def new_child(self) -> HistogramChild:
+        return HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def samples(self) -> Iterable[MetricSample]:
+        for key, child in list(self.children.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,),
+                                    list(child.counts)):
+                cumulative += count
+                yield MetricSample(name=f"{self.name}_bucket",
+                                   labels=labels | {"le": format_value(bound)},
+                                   value=cumulative)
+            yield MetricSample(name=f"{self.name}_sum", labels=labels,
+                               value=child.sum)
+            yield MetricSample(name=f"{self.name}_count", labels=labels,
+                               value=cumulative)
+
+
+class Registry():
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def collect(self) -> list[MetricFamily]:
+        return [metric.collect() for metric in self.metrics.values()]
+
+    def reset(self):
+        for metric in self.metrics.values():
+            metric.clear()
+
+
+def merge_families(*family_lists: list[MetricFamily]) -> list[MetricFamily]:
+    """
+    Merges the metrics of several processes, samples both have are added
+    up
+    """
+    merged: dict[str, MetricFamily] = {}
+    for families in family_lists:
+        for family in families:
+            existing = merged.get(family.name)
+            if existing is None:
+                merged[family.name] = family.model_copy(
+                        update={"samples": list(family.samples)}
+                        )
+                continue
+            index = {(sample.name, tuple(sorted(sample.labels.items()))):
+                     sample for sample in existing.samples}
+            for sample in family.samples:
+                key = (sample.name, tuple(sorted(sample.labels.items())))
+                if key in index:
+                    index[key].value += sample.value
+                else:
+                    existing.samples.append(sample)
+    return list(merged.values())
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n") \
+        .replace('"', '\\"')
+
+
+def render(families: list[MetricFamily]) -> str:
+    """
+    Formats metrics in the Prometheus text exposition format
+    """
+    lines = []
+    for family in families:
+        lines.append(f"# HELP {family.name} {family.help}")
+        lines.append(f"# TYPE {family.name} {family.type}")
+        for sample in family.samples:
+            labels = ""
+            if sample.labels:
+                labels = "{" + ",".join(
+                    f'{name}="{escape_label(value)}"'
+                    for name, value in sample.labels.items()
+                    ) + "}"
+            lines.append(f"{sample.name}{labels} "
+                         f"{format_value(sample.value)}")
+    return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+server_start_seconds = registry.register(Histogram(
+        "archipelago_server_start_seconds",
+        "Seconds from spawning a server until it listens, or fails",
+        ("outcome",), PROCESS_BUCKETS
+        ))
+server_stop_seconds = registry.register(Histogram(
+        "archipelago_server_stop_seconds",
+        "Seconds from asking a server to exit until it is gone",
+        ("outcome",), PROCESS_BUCKETS
+        ))
+server_output_lines = registry.register(Counter(
+        "archipelago_server_output_lines_total",
+        "Lines read from the output of a server",
+        ("server_id", "stream")
+        ))
+server_output_bytes = registry.register(Counter(
+        "archipelago_server_output_bytes_total",
+        "Bytes read from the output of a server",
+        ("server_id", "stream")
+        ))
+callback_seconds = registry.register(Histogram(
+        "archipelago_callback_seconds",
+        "Seconds an output callback took for one line",
+        ("callback",), CALLBACK_BUCKETS
+        ))
+dispatch_seconds = registry.register(Histogram(
+        "archipelago_dispatch_seconds",
+        "Seconds a line waited in the queue of an output callback",
+        ("callback",), CALLBACK_BUCKETS
+        ))
+hub_callback_seconds = registry.register(Histogram(
+        "archipelago_hub_callback_seconds",
+        "Seconds a delivery of notifications to a hub took",
+        ("kind",)
+        ))
+hub_callback_failures = registry.register(Counter(
+        "archipelago_hub_callback_failures_total",
+        "Notifications a hub did not accept, one per attempt",
+        ("kind",)
+        ))
+db_query_seconds = registry.register(Histogram(
+        "archipelago_db_query_seconds",
+        "Seconds DB queries took, by the route or RPC method they ran for",
+        ("route",)
+        ))
+
+# What DB queries run for, the ASGI scope of a request or an RPC method
+current_route: contextvars.ContextVar[dict | str | None] = \
+    contextvars.ContextVar("current_route", default=None)
+# Queries run in worker threads too
+_db_lock = threading.Lock()
+
+
+def route_label() -> str:
+    route = current_route.get()
+    if route is None:
+        return "background"
+    if isinstance(route, str):
+        return route
+    # Routing fills in the route after the middleware set the scope
+    matched = route.get("route")
+    return getattr(matched, "path", "unmatched")
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    child = db_query_seconds.labels(route_label())
+    with _db_lock:
+        child.observe(elapsed)
+
+
+class RouteMetricsMiddleware():
+    """
+    Makes the route of a request known to the DB query timings
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = current_route.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_route.reset(token)
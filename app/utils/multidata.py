@@ -0,0 +1,171 @@
+import asyncio
+import io
+import multiprocessing
+import pickle
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from enum import IntFlag
+from pathlib import Path
+from typing import NamedTuple
+from app.core.config import settings
+from app.models.servers import ArchipelagoMetadata, ArchipelagoSlot
+
+
+# Newest multidata format ArchipelagoServer can load
+MAX_FORMAT_VERSION = 3
+# Decompressed multidata larger than this is rejected instead of parsed
+MAX_MULTIDATA_SIZE = 1024 * 1024 * 1024
+# Server options that are secret, or that the node sets itself
+HIDDEN_SERVER_OPTIONS = {"password", "server_password", "host", "port",
+                         "multidata", "savefile"}
+
+
+class InvalidArchipelagoFileException(Exception):
+    pass
+
+
+# Stand-ins for the NetUtils classes the multidata is pickled with
+class SlotType(IntFlag):
+    spectator = 0b00
+    player = 0b01
+    group = 0b10
+
+
+class NetworkSlot(NamedTuple):
+    name: str
+    game: str
+    type: SlotType
+    group_members: tuple = ()
+
+
+class RestrictedUnpickler(pickle.Unpickler):
+    """
+    Only allows the globals a multidata file needs, so a crafted upload
+    can not run code on the node
+    """
+    allowed = {
+        ("NetUtils", "NetworkSlot"): NetworkSlot,
+        ("NetUtils", "SlotType"): SlotType,
+        ("builtins", "set"): set,
+        ("builtins", "frozenset"): frozenset,
+    }
+
+    def find_class(self, module: str, name: str):
+        try:
+            return self.allowed[(module, name)]
+        except KeyError:
+            raise pickle.UnpicklingError(f"Global {module}.{name} is "
+                                         "not allowed")
+
+
+def format_version(version) -> str:
+    return ".".join(str(part) for part in version)
+
+
+def parse_version(version: str) -> tuple[int, ...]:
+    return tuple(int(part) for part in version.split("."))
+
+
+def read_multidata(path: Path) -> tuple[int, dict]:
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data:
+        raise InvalidArchipelagoFileException("Archipelago file is empty")
+    if data[0] > MAX_FORMAT_VERSION:
+        raise InvalidArchipelagoFileException(
+                f"Unsupported multidata format version {data[0]}, "
+                f"newest supported is {MAX_FORMAT_VERSION}"
+                )
+    decompressor = zlib.decompressobj()
+    try:
+        raw = decompressor.decompress(data[1:], MAX_MULTIDATA_SIZE)
+    except zlib.error:
+        raise InvalidArchipelagoFileException(
+                "Archipelago file is not valid multidata")
+    if decompressor.unconsumed_tail:
+        raise InvalidArchipelagoFileException(
+                "Archipelago file decompresses to more than "
+                f"{MAX_MULTIDATA_SIZE} bytes")
+    try:
+        multidata = RestrictedUnpickler(io.BytesIO(raw)).load()
+    except Exception as e:
+        raise InvalidArchipelagoFileException(
+                f"Archipelago file is not valid multidata: {e}")
+    if not isinstance(multidata, dict):
+        raise InvalidArchipelagoFileException(
+                "Archipelago file is not valid multidata")
+    return data[0], multidata
+
+
+def read_metadata(path: Path) -> ArchipelagoMetadata:
+    """
+    Reads the metadata of a .archipelago file, runs in the parse pool
+    """
+    version, multidata = read_multidata(path)
+    try:
+        slots = [ArchipelagoSlot(slot=slot, name=info.name, game=info.game)
+                 for slot, info in sorted(multidata["slot_info"].items())
+                 if info.type == SlotType.player]
+        server_options = multidata.get("server_options") or {}
+        return ArchipelagoMetadata(
+                format_version=version,
+                generator_version=format_version(multidata["version"]),
+                required_server_version=format_version(
+                    multidata["minimum_versions"]["server"]
+                    ),
+                seed_name=multidata.get("seed_name"),
+                player_count=len(slots),
+                games=sorted({slot.game for slot in slots}),
+                slots=slots,
+                race_mode=bool(multidata.get("race_mode", False)),
+                has_password=bool(server_options.get("password")),
+                server_options={
+                    key: value for key, value in server_options.items()
+                    if key not in HIDDEN_SERVER_OPTIONS
+                    }
+                )
+    except (KeyError, TypeError, AttributeError, ValueError) as e:
+        raise InvalidArchipelagoFileException(
+                f"Archipelago file is missing multidata fields: {e}")
+
+
+_pool: ProcessPoolExecutor | None = None
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # Spawned rather than forked, the node runs threads
+        _pool = ProcessPoolExecutor(
+                max_workers=settings.ARCHIPELAGO_PARSE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+                )
+    return _pool
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
+
+
+def check_server_version(metadata: ArchipelagoMetadata):
+    """
+    Raises if the Archipelago version of this node can not host the file
+    """
+    required = parse_version(metadata.required_server_version)
+    if required > parse_version(settings.ARCHIPELAGO_VERSION):
+        raise InvalidArchipelagoFileException(
+                "Archipelago file requires server version "
+                f"{metadata.required_server_version}, this node runs "
+                f"{settings.ARCHIPELAGO_VERSION}"
+                )
+
+
+async def parse_archipelago_file(path: Path) -> ArchipelagoMetadata:
+    """
+    Parses the file off the event loop
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_pool(), read_metadata, path)
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+from app.db import create_db_and_tables, session_handler
+from app.core.config import settings
+from app.models.servers import ServerStateEnum
+from app.utils.asyncserver import AsyncServer
+from app.utils.server_utils import server_manager, port_handler
+from app.utils.state_cache import state_cache
+from app.utils.files import GAMES_DIR
+from app.utils.blob_store import blob_store
+from app.utils.multidata import shutdown_pool
+from app.utils.outbox import hub_outbox
+from app.utils.events import event_writer
+from app.utils.log_store import log_store
+from app.utils.resources import resource_sampler
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def reinit_server_objects():
+    session = next(session_handler.get_session())
+    servers = state_cache.load_all(session)
+    port_handler.seed(server.port for server in servers)
+
+    restart_coros = []
+    for server in servers:
+        as_obj = AsyncServer(server.id, server.port)
+        server_manager.servers[server.id] = as_obj
+        if server.state in [ServerStateEnum.running, ServerStateEnum.starting]:
+            # Only servers that died with the node are restarted
+            if await as_obj.adopt(server.process_id):
+                if as_obj.starting:
+                    restart_coros.append(as_obj.finish_startup())
+            else:
+                restart_coros.append(as_obj.start_wait(is_restart=True))
+
+    if len(restart_coros) > 0:
+        print("Restarting servers")
+        await asyncio.gather(*restart_coros)
+    print(server_manager.servers)
+
+    session.close()
+
+
+async def stop_running_servers():
+    stop_coros = []
+    for server_id, asyncserver in server_manager.servers.items():
+        if asyncserver.running:
+            stop_coros.append(asyncserver.stop())
+    if len(stop_coros) > 0:
+        await asyncio.gather(*stop_coros)
+
+
+async def detach_running_servers():
+    for server_id, asyncserver in server_manager.servers.items():
+        await asyncserver.detach()
+
+
+class NodeRuntime():
+    """
+    Everything the process that manages the game servers runs next to
+    them: the API in embedded mode, the supervisor in remote mode
+    """
+    def __init__(self):
+        self.flush_task: asyncio.Task | None = None
+        self.event_task: asyncio.Task | None = None
+        self.log_task: asyncio.Task | None = None
+        self.sample_task: asyncio.Task | None = None
+
+    async def start(self):
+        create_db_and_tables()
+        GAMES_DIR.mkdir(parents=True, exist_ok=True)
+        await asyncio.to_thread(log_store.enforce_retention)
+        await reinit_server_objects()
+        await asyncio.to_thread(
+                blob_store.collect_garbage,
+                {server.archipelago_file_hash
+                 for server in state_cache.all()},
+                settings.ARCHIPELAGO_FILE_TMP_MAX_AGE
+                )
+        await hub_outbox.start()
+        self.flush_task = asyncio.create_task(
+                state_cache.run_writer(
+                    settings.STATE_CACHE_WRITE_DELAY,
+                    settings.STATE_CACHE_FLUSH_INTERVAL
+                    )
+                )
+        self.event_task = asyncio.create_task(
+                event_writer.run(settings.SERVER_EVENTS_FLUSH_INTERVAL)
+                )
+        self.log_task = asyncio.create_task(
+                log_store.run(settings.SERVER_LOG_FLUSH_INTERVAL)
+                )
+        self.sample_task = asyncio.create_task(
+                resource_sampler.run(settings.SERVER_SAMPLE_INTERVAL)
+                )
+
+    async def stop(self):
+        if settings.SERVER_STOP_ON_SHUTDOWN:
+            await stop_running_servers()
+        else:
+            await detach_running_servers()
+        await hub_outbox.stop()
+        if self.sample_task is not None:
+            self.sample_task.cancel()
+            await asyncio.gather(self.sample_task, return_exceptions=True)
+            self.sample_task = None
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+            self.flush_task = None
+        state_cache.flush()
+        if self.event_task is not None:
+            self.event_task.cancel()
+            await asyncio.gather(self.event_task, return_exceptions=True)
+            self.event_task = None
+        event_writer.flush()
+        if self.log_task is not None:
+            self.log_task.cancel()
+            await asyncio.gather(self.log_task, return_exceptions=True)
+            self.log_task = None
+        log_store.flush()
+        shutdown_pool()
+
+
+node_runtime = NodeRuntime()
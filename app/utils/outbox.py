@@ -0,0 +1,284 @@
+import asyncio
+import hashlib
+import logging
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+import httpx
+from sqlmodel import func, select
+from app.core.config import settings
+from app.db import session_handler
+from app.models.notifications import (
+        HubNotification,
+        HubNotificationBatchBody,
+        HubEventEnum
+        )
+from app.models.servers import ServerFailureReasonEnum
+from app.utils.metrics import hub_callback_seconds, hub_callback_failures
+from app.utils.state_cache import state_cache
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Failed starts go where hubs always got the outcome of a start, the event
+# and state in the body tell them apart
+EVENT_PATHS = {HubEventEnum.failed: HubEventEnum.started.value}
+
+
+def utcnow() -> datetime:
+    # Stored naive, sqlite drops the timezone anyway
+    return datetime.utcnow()
+
+
+class HubOutbox():
+    """
+    Delivers server state transitions to hubs.
+
+    Every transition is written to the hub_notification table first, so it
+    survives node restarts. A worker task delivers due notifications over
+    a shared connection pool, batching per hub and retrying failures with
+    exponential backoff. The notifications of a server are delivered one
+    at a time in order, a later one waits until the one before it was
+    delivered or given up on, so a retried transition never reaches the
+    hub after a newer one.
+    """
+    def __init__(self):
+        self.client: httpx.AsyncClient | None = None
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.task: asyncio.Task | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._in_flight: set[int] = set()
+
+    def enqueue(self, server_id: int, event: HubEventEnum,
+                failure_reason: ServerFailureReasonEnum | None = None
+                ) -> HubNotification | None:
+        """
+        Stores a notification for the hub that started the server, returns
+        None if no hub has registered a callback for it
+        """
+        server = state_cache.get(server_id)
+        if server is None or server.callback_url is None:
+            return None
+        now = utcnow()
+        notification = HubNotification(
+                server_id=server_id,
+                hub_id=server.hub_id,
+                game_id=server.game_id,
+                callback_url=server.callback_url,
+                event=event,
+                failure_reason=failure_reason.value if failure_reason
+                else None,
+                idempotency_key=uuid.uuid4().hex,
+                created_at=now,
+                next_attempt_at=now
+                )
+        # The hub must never hear of a state the node could lose, so it is
+        # written behind in the same transaction as the pending state
+        # writes, and delivered once it is
+        state_cache.write(notification, self.kick)
+        return notification
+
+    def kick(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self.client = httpx.AsyncClient(
+                timeout=settings.HUB_CALLBACK_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=settings.HUB_CALLBACK_MAX_CONNECTIONS
+                    )
+                )
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+        self.loop = None
+
+    async def run(self):
+        while True:
+            try:
+                next_attempt_at = await self.deliver_due()
+            except Exception:
+                logger.exception("Delivering hub notifications failed")
+                next_attempt_at = None
+            timeout = settings.HUB_CALLBACK_POLL_INTERVAL
+            if next_attempt_at is not None:
+                until_due = (next_attempt_at - utcnow()).total_seconds()
+                timeout = max(0, min(timeout, until_due))
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    @staticmethod
+    def load_pending() -> list[HubNotification]:
+        """
+        The oldest pending notification of every server, by when they are
+        due
+        """
+        is_pending = HubNotification.delivered_at.is_(None) & \
+            HubNotification.gave_up.is_(False)
+        heads = select(func.min(HubNotification.id)).where(is_pending) \
+            .group_by(HubNotification.server_id)
+        session = next(session_handler.get_session())
+        try:
+            return session.exec(
+                    select(HubNotification)
+                    .where(HubNotification.id.in_(heads))
+                    .order_by(HubNotification.next_attempt_at)
+                    .limit(settings.HUB_CALLBACK_BATCH_SIZE)
+                    ).all()
+        finally:
+            session.close()
+
+    async def deliver_due(self) -> datetime | None:
+        """
+        Delivers every due notification, returns when the next pending
+        notification is due
+        """
+        pending = await asyncio.to_thread(self.load_pending)
+        now = utcnow()
+        by_hub = defaultdict(list)
+        next_attempt_at = None
+        for notification in pending:
+            if notification.id in self._in_flight:
+                continue
+            if notification.next_attempt_at > now:
+                next_attempt_at = notification.next_attempt_at
+                break
+            by_hub[(notification.callback_url, notification.hub_id)].append(
+                    notification
+                    )
+        await asyncio.gather(*[self.deliver(notifications)
+                               for notifications in by_hub.values()])
+        if by_hub or len(pending) == settings.HUB_CALLBACK_BATCH_SIZE:
+            # The next notifications of the servers that were delivered to
+            # are due now, and there might be more due notifications than
+            # fit in one batch
+            return now
+        return next_attempt_at
+
+    async def deliver(self, notifications: list[HubNotification]):
+        """
+        Delivers notifications that all go to the same hub
+        """
+        notifications = [n for n in notifications
+                         if n.id not in self._in_flight]
+        if not notifications:
+            return
+        ids = [notification.id for notification in notifications]
+        self._in_flight.update(ids)
+        kind = "single" if len(notifications) == 1 else "batch"
+        try:
+            started = time.perf_counter()
+            if len(notifications) == 1:
+                errors = [await self.post_single(notifications[0])]
+            else:
+                errors = await self.post_batch(notifications)
+            hub_callback_seconds.labels(kind).observe(
+                    time.perf_counter() - started
+                    )
+            hub_callback_failures.labels(kind).inc(
+                    sum(error is not None for error in errors)
+                    )
+            await asyncio.to_thread(self.record_results, notifications,
+                                    errors)
+        finally:
+            self._in_flight.difference_update(ids)
+
+    async def post(self, url: str, body: dict,
+                   idempotency_key: str) -> httpx.Response:
+        return await self.client.post(
+                url,
+                json=body,
+                headers={"Idempotency-Key": idempotency_key}
+                )
+
+    async def post_single(self, notification: HubNotification) -> str | None:
+        callback_url = notification.callback_url.rstrip("/")
+        path = EVENT_PATHS.get(notification.event, notification.event.value)
+        url = (f"{callback_url}/hubs/{notification.hub_id}/games/"
+               f"{notification.game_id}/{path}")
+        try:
+            response = await self.post(
+                    url,
+                    notification.to_body().model_dump(mode="json"),
+                    notification.idempotency_key
+                    )
+        except httpx.HTTPError as e:
+            return f"{type(e).__name__}: {e}"
+        if not response.is_success:
+            return f"HTTP {response.status_code}"
+        return None
+
+    async def post_batch(self, notifications: list[HubNotification]
+                         ) -> list[str | None]:
+        first = notifications[0]
+        callback_url = first.callback_url.rstrip("/")
+        url = f"{callback_url}/hubs/{first.hub_id}/games/events"
+        body = HubNotificationBatchBody(
+                events=[n.to_body() for n in notifications]
+                )
+        idempotency_key = hashlib.sha256("".join(
+            n.idempotency_key for n in notifications
+            ).encode()).hexdigest()
+        try:
+            response = await self.post(url, body.model_dump(mode="json"),
+                                       idempotency_key)
+        except httpx.HTTPError as e:
+            return [f"{type(e).__name__}: {e}"] * len(notifications)
+        if response.status_code in [404, 405]:
+            # Hub does not support batches, fall back to one by one
+            return [await self.post_single(n) for n in notifications]
+        if not response.is_success:
+            return [f"HTTP {response.status_code}"] * len(notifications)
+        return [None] * len(notifications)
+
+    def record_results(self, notifications: list[HubNotification],
+                       errors: list[str | None]):
+        now = utcnow()
+        session = next(session_handler.get_session())
+        for notification, error in zip(notifications, errors):
+            db_notification = session.get(HubNotification, notification.id)
+            if db_notification is None:
+                continue
+            if error is None:
+                db_notification.delivered_at = now
+            else:
+                db_notification.attempts += 1
+                db_notification.last_error = error
+                if db_notification.attempts >= \
+                        settings.HUB_CALLBACK_MAX_ATTEMPTS:
+                    db_notification.gave_up = True
+                    logger.error(
+                            "Giving up on hub notification "
+                            f"{db_notification.idempotency_key} "
+                            f"({db_notification.event.value} for server "
+                            f"{db_notification.server_id}): {error}"
+                            )
+                else:
+                    backoff = min(
+                            settings.HUB_CALLBACK_BACKOFF_BASE
+                            * 2 ** (db_notification.attempts - 1),
+                            settings.HUB_CALLBACK_BACKOFF_MAX
+                            )
+                    db_notification.next_attempt_at = \
+                        now + timedelta(seconds=backoff)
+            session.add(db_notification)
+        session.commit()
+        session.close()
+
+
+hub_outbox = HubOutbox()
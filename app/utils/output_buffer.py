@@ -0,0 +1,84 @@
+import asyncio
+from app.models.servers import ServerOutput, ServerOutputLine
+
+
+class OutputRingBuffer():
+    """
+    Fixed capacity buffer of output lines, every line gets a monotonically
+    increasing sequence number. Once full, the oldest lines are overwritten.
+
+    Readers wait for new lines with wait, appending only wakes the readers
+    that are waiting at that moment, so any number of readers cost the
+    writer the same.
+    """
+    def __init__(self, capacity: int, max_line_length: int):
+        self.capacity = capacity
+        self.max_line_length = max_line_length
+        self._lines: list[tuple[str, str] | None] = [None] * capacity
+        self._waiters: set[asyncio.Future] = set()
+        self.next_seq = 0
+
+    def __len__(self):
+        return self.next_seq - self.first_seq
+
+    @property
+    def first_seq(self) -> int:
+        return max(0, self.next_seq - self.capacity)
+
+    def append(self, line: str, stream: str = "stdout") -> int:
+        if len(line) > self.max_line_length:
+            line = line[:self.max_line_length]
+        seq = self.next_seq
+        self._lines[seq % self.capacity] = (stream, line)
+        self.next_seq = seq + 1
+        if self._waiters:
+            waiters, self._waiters = self._waiters, set()
+            for waiter in waiters:
+                # Readers can be on another loop than the writer
+                waiter.get_loop().call_soon_threadsafe(self._wake, waiter)
+        return seq
+
+    @staticmethod
+    def _wake(waiter: asyncio.Future):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    def since(self, seq: int, limit: int | None = None) -> ServerOutput:
+        """
+        Returns the lines with a sequence number >= seq, lines that have
+        already been overwritten are skipped
+        """
+        start = max(seq, self.first_seq)
+        end = self.next_seq
+        if limit is not None:
+            end = min(end, start + limit)
+        lines = []
+        for line_seq in range(start, end):
+            stream, line = self._lines[line_seq % self.capacity]
+            lines.append(ServerOutputLine(seq=line_seq, stream=stream,
+                                          line=line))
+        return ServerOutput(first_seq=self.first_seq,
+                            next_seq=self.next_seq,
+                            lines=lines)
+
+    def tail(self, count: int) -> ServerOutput:
+        return self.since(self.next_seq - count)
+
+    async def wait(self, seq: int, limit: int | None = None,
+                   timeout: float | None = None) -> ServerOutput:
+        """
+        Like since, but waits up to timeout seconds for a line if there is
+        none yet
+        """
+        if seq >= self.next_seq:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.add(waiter)
+            try:
+                # Checked again, a line might have been appended in between
+                if seq >= self.next_seq:
+                    await asyncio.wait_for(waiter, timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._waiters.discard(waiter)
+        return self.since(seq, limit)
@@ -0,0 +1,190 @@
+import asyncio
+import json
+import logging
+from typing import AsyncIterator, Literal
+from fastapi import HTTPException, WebSocket, WebSocketDisconnect
+from pydantic import BaseModel, ValidationError
+from app.core.config import settings
+from app.models.servers import ServerOutputBatch
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Seconds a subscription waits for new lines before asking again, only
+# bounds how long a wait for output of a stopped server lasts
+OUTPUT_WAIT_TIMEOUT = 30.0
+
+_SLOW = object()
+
+
+class SlowViewerException(Exception):
+    pass
+
+
+class OutputSubscribeMessage(BaseModel):
+    """
+    Sent by a viewer to follow (or stop following) the output of a server,
+    starting at line since, or at the next new line without it
+    """
+    action: Literal["subscribe", "unsubscribe"]
+    server_id: int
+    since: int | None = None
+
+
+class OutputViewer():
+    """
+    Streams the output of any number of servers to one client.
+
+    Every subscription has a task that waits for new lines in the output
+    buffer of its server and queues them for the client, so a viewer never
+    adds work to the reading of the server output. The queue is bounded,
+    a viewer that does not keep up is disconnected.
+    """
+    def __init__(self, controller, queue_size: int | None = None,
+                 batch_lines: int | None = None):
+        self.controller = controller
+        self.queue_size = queue_size or \
+            settings.SERVER_OUTPUT_STREAM_QUEUE_SIZE
+        self.batch_lines = batch_lines or \
+            settings.SERVER_OUTPUT_STREAM_BATCH_LINES
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.tasks: dict[int, asyncio.Task] = {}
+
+    async def subscribe(self, server_id: int, since: int | None = None):
+        """
+        Raises HTTPException if the server does not exist
+        """
+        if since is None:
+            since = (await self.controller.read_output(server_id, None, 1,
+                                                       1)).next_seq
+        self.unsubscribe(server_id)
+        self.tasks[server_id] = asyncio.create_task(
+                self.follow(server_id, since)
+                )
+
+    def unsubscribe(self, server_id: int):
+        task = self.tasks.pop(server_id, None)
+        if task is not None:
+            task.cancel()
+
+    async def follow(self, server_id: int, since: int):
+        while True:
+            try:
+                output = await self.controller.wait_for_output(
+                        server_id, since, self.batch_lines,
+                        OUTPUT_WAIT_TIMEOUT
+                        )
+            except HTTPException as e:
+                self.put({"server_id": server_id,
+                          "status_code": e.status_code,
+                          "detail": e.detail})
+                self.tasks.pop(server_id, None)
+                return
+            if not output.lines:
+                continue
+            skipped = max(0, output.lines[0].seq - since)
+            self.put(ServerOutputBatch(server_id=server_id,
+                                       skipped=skipped,
+                                       **output.model_dump()))
+            since = output.lines[-1].seq + 1
+
+    def put(self, message: ServerOutputBatch | dict):
+        if self.queue.qsize() >= self.queue_size:
+            logger.info("Disconnecting output viewer that fell behind")
+            for task in self.tasks.values():
+                task.cancel()
+            self.tasks = {}
+            # Whatever is queued is dropped, the viewer is gone anyway
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(_SLOW)
+            return
+        self.queue.put_nowait(message)
+
+    async def get(self) -> ServerOutputBatch | dict:
+        message = await self.queue.get()
+        if message is _SLOW:
+            raise SlowViewerException("Viewer fell behind")
+        return message
+
+    def close(self):
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks = {}
+
+    async def handle_messages(self, websocket: WebSocket):
+        """
+        Handles subscribe messages until the client disconnects
+        """
+        while True:
+            data = await websocket.receive_text()
+            try:
+                message = OutputSubscribeMessage.model_validate(
+                        json.loads(data)
+                        )
+            except (ValueError, ValidationError) as e:
+                self.put({"status_code": 422, "detail": str(e)})
+                continue
+            if message.action == "unsubscribe":
+                self.unsubscribe(message.server_id)
+                continue
+            try:
+                await self.subscribe(message.server_id, message.since)
+            except HTTPException as e:
+                self.put({"server_id": message.server_id,
+                          "status_code": e.status_code,
+                          "detail": e.detail})
+
+    async def send_messages(self, websocket: WebSocket):
+        while True:
+            message = await self.get()
+            if isinstance(message, ServerOutputBatch):
+                message = message.model_dump(mode="json")
+            await asyncio.wait_for(
+                    websocket.send_json(message),
+                    settings.SERVER_OUTPUT_STREAM_SEND_TIMEOUT
+                    )
+
+    async def serve_websocket(self, websocket: WebSocket):
+        receiver = asyncio.create_task(self.handle_messages(websocket))
+        sender = asyncio.create_task(self.send_messages(websocket))
+        try:
+            done, _ = await asyncio.wait(
+                    [receiver, sender], return_when=asyncio.FIRST_COMPLETED
+                    )
+            error = done.pop().exception()
+            if isinstance(error, (SlowViewerException,
+                                  asyncio.TimeoutError)):
+                await websocket.close(code=1008, reason="Viewer fell behind")
+            elif error is not None and \
+                    not isinstance(error, WebSocketDisconnect):
+                raise error
+        finally:
+            receiver.cancel()
+            sender.cancel()
+            self.close()
+
+    async def stream_events(self) -> AsyncIterator[str]:
+        """
+        Yields the output of the subscribed server as server-sent events,
+        the id of every event is the sequence number of the line
+        """
+        try:
+            while True:
+                try:
+                    message = await self.get()
+                except SlowViewerException:
+                    yield "event: error\ndata: Viewer fell behind\n\n"
+                    return
+                if isinstance(message, dict):
+                    yield f"event: error\ndata: {message['detail']}\n\n"
+                    return
+                if message.skipped:
+                    yield f"event: skipped\ndata: {message.skipped}\n\n"
+                for line in message.lines:
+                    data = line.line.replace("\n", "\ndata: ")
+                    yield (f"id: {line.seq}\nevent: {line.stream}\n"
+                           f"data: {data}\n\n")
+        finally:
+            self.close()
@@ -0,0 +1,94 @@
+import asyncio
+import os
+import select
+import signal
+
+
+def open_pidfd(pid: int) -> int | None:
+    """
+    Opens a pidfd for pid, returns None if the platform does not support it
+    or the process is already gone
+    """
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+
+def pid_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def has_exited(pid: int, pidfd: int | None) -> bool:
+    """
+    A pidfd becomes readable once the process has exited, without one
+    a zombie still counts as running until it is reaped
+    """
+    if pidfd is not None:
+        readable, _, _ = select.select([pidfd], [], [], 0)
+        return bool(readable)
+    return not pid_exists(pid)
+
+
+def read_cmdline(pid: int) -> list[str] | None:
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            cmdline = f.read()
+    except OSError:
+        return None
+    return [arg.decode(errors="replace")
+            for arg in cmdline.split(b"\0") if arg]
+
+
+async def wait_for_exit(pid: int, pidfd: int | None,
+                        timeout: float | None) -> bool:
+    """
+    Waits until the process exits or the timeout has passed, returns whether
+    the process has exited. Works from any event loop, not only the one the
+    process was spawned in, since it does not rely on the child watcher.
+    """
+    if pidfd is None:
+        return await poll_for_exit(pid, timeout)
+    loop = asyncio.get_running_loop()
+    exited = loop.create_future()
+
+    def on_readable():
+        if not exited.done():
+            exited.set_result(None)
+
+    loop.add_reader(pidfd, on_readable)
+    try:
+        await asyncio.wait_for(exited, timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        loop.remove_reader(pidfd)
+
+
+async def poll_for_exit(pid: int, timeout: float | None,
+                        interval: float = 0.1) -> bool:
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    while pid_exists(pid):
+        if deadline is not None and loop.time() >= deadline:
+            return False
+        await asyncio.sleep(interval)
+    return True
+
+
+def signal_process_group(pid: int, sig: signal.Signals) -> None:
+    """
+    Servers are started in their own session, signalling the whole group
+    also reaches processes started by wrapper scripts
+    """
+    try:
+        os.killpg(pid, sig)
+    except ProcessLookupError:
+        pass
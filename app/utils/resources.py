@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import NamedTuple
+from app.core.config import settings
+from app.models.servers import (
+        NodeResources,
+        ServerResources,
+        ServerResourceSample
+        )
+from app.utils.metrics import Gauge, registry
+from app.utils.state_cache import state_cache
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+class ProcessStat(NamedTuple):
+    cpu_ticks: int
+    # Tells a process apart from a later one that got the same pid
+    start_ticks: int
+    rss_bytes: int
+    open_fds: int
+
+
+def read_process(pid: int) -> ProcessStat | None:
+    """
+    Reads what a process uses from /proc, None if it is gone
+    """
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read()
+        with open(f"/proc/{pid}/statm", "rb") as f:
+            statm = f.read()
+        open_fds = len(os.listdir(f"/proc/{pid}/fd"))
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        return None
+    # The command name can have spaces and parentheses, fields are counted
+    # from after its closing parenthesis, starting with field 3 (state)
+    fields = stat[stat.rindex(b")") + 2:].split()
+    utime, stime, start_ticks = int(fields[11]), int(fields[12]), \
+        int(fields[19])
+    return ProcessStat(utime + stime, start_ticks,
+                       int(statm.split()[1]) * PAGE_SIZE, open_fds)
+
+
+def read_memory() -> tuple[int, int]:
+    """
+    Returns the total and available memory of the machine in bytes
+    """
+    values = {}
+    with open("/proc/meminfo") as f:
+        for line in f:
+            name, value = line.split(":", 1)
+            if name in ["MemTotal", "MemAvailable"]:
+                values[name] = int(value.split()[0]) * 1024
+    return values.get("MemTotal", 0), values.get("MemAvailable", 0)
+
+
+class ResourceSampler():
+    """
+    Samples the processes of all servers in one pass every interval, from
+    a single task, so sampling does not need a timer per server
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.history: dict[int, deque[ServerResourceSample]] = {}
+        # The last stat of every process and when it was read, for the CPU
+        self._last: dict[int, tuple[ProcessStat, float]] = {}
+
+    def sample(self):
+        at = datetime.utcnow()
+        now = time.monotonic()
+        pids = {server.id: server.process_id for server in state_cache.all()
+                if server.process_id is not None}
+        samples = {}
+        for server_id, pid in pids.items():
+            stat = read_process(pid)
+            if stat is None:
+                continue
+            cpu_percent = None
+            last = self._last.get(server_id)
+            if last is not None and last[0].start_ticks == stat.start_ticks \
+                    and now > last[1]:
+                cpu_percent = (stat.cpu_ticks - last[0].cpu_ticks) \
+                    / CLOCK_TICKS / (now - last[1]) * 100
+            self._last[server_id] = (stat, now)
+            samples[server_id] = ServerResourceSample(
+                    at=at, cpu_percent=cpu_percent,
+                    rss_bytes=stat.rss_bytes, open_fds=stat.open_fds
+                    )
+        with self._lock:
+            # Servers without a process have nothing to show anymore
+            for server_id in list(self.history):
+                if server_id not in samples:
+                    del self.history[server_id]
+                    self._last.pop(server_id, None)
+            for server_id, sample in samples.items():
+                self.history.setdefault(
+                        server_id,
+                        deque(maxlen=settings.SERVER_SAMPLE_HISTORY)
+                        ).append(sample)
+
+    async def run(self, interval: float):
+        while True:
+            try:
+                await asyncio.to_thread(self.sample)
+            except Exception:
+                logger.exception("Sampling server processes failed")
+            await asyncio.sleep(interval)
+
+    def current(self) -> dict[int, ServerResourceSample]:
+        with self._lock:
+            return {server_id: history[-1]
+                    for server_id, history in self.history.items()}
+
+    def peaks(self) -> dict[int, tuple[float, int]]:
+        """
+        The highest CPU and memory every sampled server had recently
+        """
+        with self._lock:
+            return {server_id: (max((sample.cpu_percent or 0
+                                     for sample in history), default=0),
+                                max(sample.rss_bytes for sample in history))
+                    for server_id, history in self.history.items()
+                    if history}
+
+    def resources(self, server_id: int) -> ServerResources:
+        with self._lock:
+            history = list(self.history.get(server_id, []))
+        return ServerResources(server_id=server_id,
+                               current=history[-1] if history else None,
+                               history=history)
+
+    def node_resources(self) -> NodeResources:
+        current = self.current()
+        memory_total, memory_available = read_memory()
+        return NodeResources(
+                cpu_count=os.cpu_count() or 1,
+                memory_total_bytes=memory_total,
+                memory_available_bytes=memory_available,
+                load_average=list(os.getloadavg()),
+                servers_sampled=len(current),
+                cpu_percent=sum(sample.cpu_percent or 0
+                                for sample in current.values()),
+                rss_bytes=sum(sample.rss_bytes for sample in current.values()),
+                open_fds=sum(sample.open_fds for sample in current.values()),
+                servers=[ServerResources(server_id=server_id, current=sample)
+                         for server_id, sample in sorted(current.items())]
+                )
+
+    def clear(self):
+        with self._lock:
+            self.history = {}
+            self._last = {}
+
+
+resource_sampler = ResourceSampler()
+
+
+def current_values(field: str):
+    def collect() -> dict[tuple[str, ...], float]:
+        return {(str(server_id),): getattr(sample, field)
+                for server_id, sample in resource_sampler.current().items()
+                if getattr(sample, field) is not None}
+    return collect
+
+
+registry.register(Gauge("archipelago_server_cpu_percent",
+                        "Percent of one core a server process used",
+                        ("server_id",), current_values("cpu_percent")))
+registry.register(Gauge("archipelago_server_rss_bytes",
+                        "Resident memory of a server process",
+                        ("server_id",), current_values("rss_bytes")))
+registry.register(Gauge("archipelago_server_open_fds",
+                        "Open file descriptors of a server process",
+                        ("server_id",), current_values("open_fds")))
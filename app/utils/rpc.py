@@ -0,0 +1,223 @@
+import asyncio
+import inspect
+import json
+import logging
+import os
+import socket
+import struct
+from typing import Any, Awaitable, Callable
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from app.utils.metrics import current_route
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Every frame is a 4 byte big endian length followed by that many bytes of
+# UTF-8 JSON. Requests are {"id", "method", "params"}, responses are
+# {"id", "result"} or {"id", "error": {"status_code", "detail"}}
+HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class RpcException(Exception):
+    def __init__(self, status_code: int, detail: Any):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class RpcConnectionException(Exception):
+    pass
+
+
+async def read_frame(reader: asyncio.StreamReader) -> dict | None:
+    """
+    Reads one frame, returns None at EOF
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError:
+        return None
+    (size,) = HEADER.unpack(header)
+    if size > MAX_FRAME_SIZE:
+        raise RpcConnectionException(f"Frame of {size} bytes is too large")
+    return json.loads(await reader.readexactly(size))
+
+
+def write_frame(writer: asyncio.StreamWriter, message: dict):
+    data = json.dumps(message, separators=(",", ":")).encode()
+    writer.write(HEADER.pack(len(data)) + data)
+
+
+RpcHandler = Callable[..., Awaitable[Any] | Any]
+
+
+class RpcServer():
+    """
+    Serves handlers over a Unix socket. Requests on one connection are
+    handled concurrently, responses are sent as they complete.
+    """
+    def __init__(self, path: str, handlers: dict[str, RpcHandler]):
+        self.path = path
+        self.handlers = handlers
+        self.server: asyncio.AbstractServer | None = None
+        self.tasks: set[asyncio.Task] = set()
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Bound owner only from the start, chmod after bind would leave a
+        # window in which other users can connect
+        umask = os.umask(0o177)
+        try:
+            sock.bind(self.path)
+        except OSError:
+            sock.close()
+            raise
+        finally:
+            os.umask(umask)
+        self.server = await asyncio.start_unix_server(self.handle_connection,
+                                                      sock=sock)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def handle_connection(self, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter):
+        # Tracked so stop can close connections that are still open
+        self.tasks.add(asyncio.current_task())
+        try:
+            while (request := await read_frame(reader)) is not None:
+                task = asyncio.create_task(self.handle_request(request,
+                                                               writer))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+        except (ConnectionError, RpcConnectionException) as e:
+            logger.warning(f"RPC connection closed: {e}")
+        finally:
+            writer.close()
+            self.tasks.discard(asyncio.current_task())
+
+    async def handle_request(self, request: dict,
+                             writer: asyncio.StreamWriter):
+        response = {"id": request.get("id")}
+        # The task of the request has its own context
+        current_route.set(f"rpc:{request.get('method')}")
+        try:
+            handler = self.handlers.get(request.get("method"))
+            if handler is None:
+                raise RpcException(404, "Unknown method "
+                                        f"{request.get('method')}")
+            result = handler(**request.get("params", {}))
+            if inspect.isawaitable(result):
+                result = await result
+            response["result"] = jsonable_encoder(result)
+        except (HTTPException, RpcException) as e:
+            response["error"] = {"status_code": e.status_code,
+                                 "detail": e.detail}
+        except Exception as e:
+            logger.exception(f"RPC {request.get('method')} failed")
+            response["error"] = {"status_code": 500, "detail": str(e)}
+        if writer.is_closing():
+            return
+        write_frame(writer, response)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+class RpcClient():
+    """
+    Multiplexes calls over one connection per event loop, reconnecting
+    after the connection was lost
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        self.read_task: asyncio.Task | None = None
+        self.pending: dict[int, asyncio.Future] = {}
+        self.next_id = 0
+        self._connect_lock: asyncio.Lock | None = None
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            await self.close()
+            self.loop = loop
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self.writer is not None and not self.writer.is_closing():
+                return
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(
+                        self.path)
+            except OSError as e:
+                raise RpcConnectionException(
+                        f"Could not connect to {self.path}: {e}")
+            self.read_task = asyncio.create_task(self.read_responses(reader))
+
+    async def read_responses(self, reader: asyncio.StreamReader):
+        error = RpcConnectionException("Connection to supervisor lost")
+        try:
+            while (response := await read_frame(reader)) is not None:
+                future = self.pending.pop(response.get("id"), None)
+                if future is None or future.done():
+                    continue
+                if "error" in response:
+                    future.set_exception(RpcException(
+                        response["error"]["status_code"],
+                        response["error"]["detail"]
+                        ))
+                else:
+                    future.set_result(response.get("result"))
+        except (ConnectionError, RpcConnectionException) as e:
+            error = RpcConnectionException(str(e))
+        finally:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self.pending.clear()
+
+    async def call(self, method: str, **params) -> Any:
+        await self.connect()
+        self.next_id += 1
+        request_id = self.next_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            write_frame(self.writer, {"id": request_id, "method": method,
+                                      "params": jsonable_encoder(params)})
+            await self.writer.drain()
+        except (ConnectionError, AttributeError) as e:
+            self.pending.pop(request_id, None)
+            raise RpcConnectionException(f"Sending {method} failed: {e}")
+        return await future
+
+    async def close(self):
+        read_task, self.read_task = self.read_task, None
+        if read_task is None:
+            return
+        if self.loop is asyncio.get_running_loop():
+            read_task.cancel()
+            await asyncio.gather(read_task, return_exceptions=True)
+        elif not self.loop.is_closed():
+            # The connection belongs to another loop, closing the task
+            # there also closes the writer
+            self.loop.call_soon_threadsafe(read_task.cancel)
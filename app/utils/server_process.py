@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import os
+from pathlib import Path
+from typing import Callable
+from app.core.config import settings
+from app.utils.files import punch_hole, remove_file
+from app.utils.inotify import add_watch
+from app.utils.process import poll_for_exit
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def offset_path(log_path: Path) -> Path:
+    return log_path.with_name(log_path.name + ".offset")
+
+
+def load_offset(log_path: Path) -> int:
+    """
+    Where reading the log stopped in a previous run of the node, 0 if it
+    never read it
+    """
+    try:
+        offset = int(offset_path(log_path).read_text())
+        size = os.path.getsize(log_path)
+    except (OSError, ValueError):
+        return 0
+    return offset if offset <= size else 0
+
+
+def save_offset(log_path: Path, offset: int):
+    path = offset_path(log_path)
+    tmp_path = path.with_name(path.name + ".part")
+    tmp_path.write_text(str(offset))
+    os.replace(tmp_path, path)
+
+
+class LogTailer():
+    """
+    Follows a log file the process appends its output to, from offset on.
+    read only returns no data once the process has exited and everything
+    it wrote was read, like a pipe at EOF. It sleeps until inotify reports
+    a write or the pidfd the exit, or polls where there is no inotify.
+
+    Output is consumed once the reader asks for more after it, consumed
+    output is freed from the disk every LOG_RECLAIM_SIZE bytes and where
+    it ends is saved, so an adopting node resumes from there.
+    """
+    def __init__(self, path: Path, process_exited: Callable[[], bool],
+                 offset: int = 0, pidfd: int | None = None):
+        self.path = path
+        # Writable, punching holes needs it
+        self.fd = os.open(path, os.O_RDWR)
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        self.position = offset
+        # Where the last complete line that was read ends, and the one the
+        # reader got and asked for more after
+        self.line_end = offset
+        self.consumed = offset
+        self.reclaimed = 0
+        self.watch = add_watch(path)
+        # A copy, every fd can only have one reader in a loop
+        self.pidfd = os.dup(pidfd) if pidfd is not None else None
+        self.process_exited = process_exited
+        self.exited = False
+
+    async def read(self, n: int) -> bytes:
+        self.consume()
+        while self.fd is not None:
+            data = os.read(self.fd, n)
+            if data:
+                newline = data.rfind(b"\n")
+                if newline != -1:
+                    self.line_end = self.position + newline + 1
+                self.position += len(data)
+                return data
+            if self.exited:
+                break
+            if self.process_exited():
+                # Read once more, the process might have written output
+                # right before exiting
+                self.exited = True
+                continue
+            await self.wait()
+        self.close()
+        return b""
+
+    async def wait(self):
+        if self.watch is None:
+            await asyncio.sleep(settings.SERVER_LOG_POLL_INTERVAL)
+            return
+        # Without a pidfd, the process closing the file on exit wakes this
+        # up, the timeout is for the exit that is noticed after that
+        watcher, wd = self.watch
+        await watcher.wait(wd, settings.SERVER_LOG_EXIT_CHECK_INTERVAL,
+                           self.pidfd)
+
+    def consume(self):
+        self.consumed = self.line_end
+        if self.consumed - self.reclaimed >= \
+                settings.SERVER_LOG_RECLAIM_SIZE:
+            # Saved first, the output before it is gone after
+            save_offset(self.path, self.consumed)
+            if not punch_hole(self.fd, self.consumed):
+                logger.warning(f"Could not free read output of {self.path}")
+            self.reclaimed = self.consumed
+
+    def close(self):
+        if self.fd is None:
+            return
+        fd, self.fd = self.fd, None
+        if self.watch is not None:
+            watcher, wd = self.watch
+            self.watch = None
+            watcher.remove(wd)
+        if self.pidfd is not None:
+            pidfd, self.pidfd = self.pidfd, None
+            os.close(pidfd)
+        try:
+            if self.exited:
+                # Nothing writes to it anymore
+                os.ftruncate(fd, 0)
+                remove_file(offset_path(self.path))
+            else:
+                save_offset(self.path, self.consumed)
+        except OSError:
+            logger.exception(f"Could not save where {self.path} was read")
+        finally:
+            os.close(fd)
+
+
+class FifoWriter():
+    """
+    Writes commands to the stdin fifo of a server. Not bound to an event
+    loop, so commands can be sent from any of them.
+    """
+    def __init__(self, path: Path):
+        # Fails with ENXIO if the process does not have the fifo open
+        self.fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        self.buffer = b""
+
+    def write(self, data: bytes):
+        self.buffer += data
+
+    async def drain(self):
+        while self.buffer:
+            if self.fd is None:
+                raise BrokenPipeError("Fifo is closed")
+            try:
+                written = os.write(self.fd, self.buffer)
+            except BlockingIOError:
+                await asyncio.sleep(settings.SERVER_LOG_POLL_INTERVAL)
+                continue
+            self.buffer = self.buffer[written:]
+
+    def close(self):
+        if self.fd is not None:
+            fd, self.fd = self.fd, None
+            os.close(fd)
+
+
+class ServerProcess():
+    """
+    An ArchipelagoServer process, either spawned by this node or adopted
+    from a previous run of the node. The process only holds on to files,
+    so it outlives the node.
+    """
+    def __init__(self, pid: int, stdin: FifoWriter, stdout: LogTailer,
+                 stderr: LogTailer,
+                 child: asyncio.subprocess.Process | None = None):
+        self.pid = pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.child = child
+
+    async def wait(self):
+        if self.child is not None:
+            await self.child.wait()
+        else:
+            # Not our child, whoever inherited it reaps it
+            await poll_for_exit(self.pid, None)
+
+    def close(self):
+        self.stdin.close()
+        self.stdout.close()
+        self.stderr.close()
+
+
+def attach_server_process(pid: int, stdin_path: Path, stdout_path: Path,
+                          stderr_path: Path,
+                          process_exited: Callable[[], bool],
+                          pidfd: int | None,
+                          child: asyncio.subprocess.Process | None = None
+                          ) -> ServerProcess:
+    stdin = FifoWriter(stdin_path)
+    try:
+        stdout = LogTailer(stdout_path, process_exited,
+                           load_offset(stdout_path), pidfd)
+    except OSError:
+        stdin.close()
+        raise
+    try:
+        stderr = LogTailer(stderr_path, process_exited,
+                           load_offset(stderr_path), pidfd)
+    except OSError:
+        stdin.close()
+        stdout.close()
+        raise
+    return ServerProcess(pid, stdin, stdout, stderr, child)
+
+
+async def spawn_server_process(args: list[str], stdin_path: Path,
+                               stdout_path: Path, stderr_path: Path
+                               ) -> asyncio.subprocess.Process:
+    """
+    Starts the process in its own session with stdout and stderr appended
+    to log files and stdin coming from a fifo, so it keeps running when the
+    node goes away. Appending keeps writes at the end when read output is
+    freed.
+    """
+    for path in [stdin_path, stdout_path, stderr_path,
+                 offset_path(stdout_path), offset_path(stderr_path)]:
+        remove_file(path)
+    os.mkfifo(stdin_path, 0o600)
+    # Opened read-write, so the process never sees EOF on stdin while no
+    # node is attached
+    stdin_fd = os.open(stdin_path, os.O_RDWR)
+    try:
+        with open(stdout_path, "ab") as stdout, \
+                open(stderr_path, "ab") as stderr:
+            return await asyncio.subprocess.create_subprocess_exec(
+                    *args,
+                    stdin=stdin_fd,
+                    stdout=stdout,
+                    stderr=stderr,
+                    start_new_session=True,
+                    )
+    finally:
+        os.close(stdin_fd)
@@ -1,3 +1,7 @@
+import heapq
+import socket
+import threading
+from typing import Iterable
 from pydantic import BaseModel, ConfigDict
 from sqlmodel import select
 from app.models.servers import Server
@@ -12,28 +16,143 @@ class ServerManager(BaseModel):
     servers: dict[int, AsyncServer]
 
 
+class PortsExhaustedException(Exception):
+    pass
+
+
 class PortHandler():
-    def get_new_port(self) -> int:
+    """
+    Hands out ports in [port_start, port_end] from an in-memory free heap.
+
+    The heap is seeded from the DB once, after that reserving and releasing
+    never touches the DB. All bookkeeping happens under one lock so
+    concurrent creates can never get the same port. The node seeds it on
+    startup, code on the event loop that might come first seeds it with
+    ensure_seeded.
+    """
+    def __init__(self, port_start: int, port_end: int,
+                 check_bound: bool = True):
+        self.port_start = port_start
+        self.port_end = port_end
+        self.check_bound = check_bound
+        self._lock = threading.Lock()
+        self._free: list[int] = []
+        self._allocated: set[int] = set()
+        # Free in our books, but bound by something else on the host
+        self._host_bound: set[int] = set()
+        self._seeded = False
+
+    def seed(self, used_ports: Iterable[int | None]) -> None:
+        with self._lock:
+            self._seed(used_ports)
+
+    def _seed(self, used_ports: Iterable[int | None]) -> None:
+        self._allocated = {
+                port for port in used_ports
+                if port is not None
+                and self.port_start <= port <= self.port_end
+                }
+        self._free = [port for port in
+                      range(self.port_start, self.port_end + 1)
+                      if port not in self._allocated]
+        heapq.heapify(self._free)
+        self._host_bound = set()
+        self._seeded = True
+
+    def seed_once(self, used_ports: Iterable[int | None]) -> None:
+        with self._lock:
+            if not self._seeded:
+                self._seed(used_ports)
+
+    def _ensure_seeded(self) -> None:
+        if self._seeded:
+            return
+        # Read outside of the lock, nobody waits on it for the DB
         session = next(session_handler.get_session())
-        # Using where on port forces index to be sorted
-        statement = select(Server).where(
-                Server.port > settings.ARCHIPELAGO_PORT_START-1
-                )
-        servers = session.exec(statement)
-
-        # Finds lowest unused port above ARCHIPELAGO_PORT_START
-        last_port = settings.ARCHIPELAGO_PORT_START - 1
-        for server in servers:
-            if server.port - 1 != last_port:
-                session.close()
-                return last_port + 1
-            last_port = server.port
-        if last_port + 1 > settings.ARCHIPELAGO_PORT_END:
-            return -1
-        else:
-            return last_port + 1
+        used_ports = session.exec(select(Server.port)).all()
+        session.close()
+        self.seed_once(used_ports)
+
+    async def ensure_seeded(self) -> None:
+        if self._seeded:
+            return
+        async with session_handler.async_session() as session:
+            used_ports = (await session.exec(select(Server.port))).all()
+        self.seed_once(used_ports)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._free = []
+            self._allocated = set()
+            self._host_bound = set()
+            self._seeded = False
+
+    @staticmethod
+    def is_port_bound(port: int) -> bool:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            # Archipelago binds with SO_REUSEADDR as well, so TIME_WAIT
+            # sockets should not make a port look taken
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind(("", port))
+            except OSError:
+                return True
+        return False
+
+    def _take(self, count: int) -> list[int]:
+        taken = []
+        while self._free and len(taken) < count:
+            port = heapq.heappop(self._free)
+            if self.check_bound and self.is_port_bound(port):
+                self._host_bound.add(port)
+            else:
+                taken.append(port)
+        return taken
+
+    def reserve(self, count: int = 1) -> list[int]:
+        """
+        Atomically reserves count ports, either all of them or none
+        """
+        self._ensure_seeded()
+        with self._lock:
+            taken = self._take(count)
+            if len(taken) < count and self._host_bound:
+                # Ports bound by someone else might have been freed since
+                for port in self._host_bound:
+                    heapq.heappush(self._free, port)
+                self._host_bound = set()
+                taken += self._take(count - len(taken))
+            if len(taken) < count:
+                for port in taken:
+                    heapq.heappush(self._free, port)
+                raise PortsExhaustedException(
+                        f"Not enough free ports, requested {count}"
+                        )
+            self._allocated.update(taken)
+            return taken
+
+    def free_count(self) -> int:
+        """
+        Before the heap is seeded every port counts as free
+        """
+        with self._lock:
+            if not self._seeded:
+                return self.port_end - self.port_start + 1
+            return len(self._free) + len(self._host_bound)
+
+    def get_new_port(self) -> int:
+        return self.reserve(1)[0]
+
+    def release(self, port: int | None) -> None:
+        with self._lock:
+            if port not in self._allocated:
+                return
+            self._allocated.remove(port)
+            heapq.heappush(self._free, port)
 
 
 server_manager = ServerManager(servers={})
 
-port_handler = PortHandler()
+port_handler = PortHandler(settings.ARCHIPELAGO_PORT_START,
+                           settings.ARCHIPELAGO_PORT_END,
+                           check_bound=settings.ARCHIPELAGO_PORT_CHECK_BOUND)
@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import threading
+from typing import Any, Callable
+from sqlalchemy import update
+from sqlmodel import Session, SQLModel, select
+from app.models.servers import Server, ServerStateEnum
+from app.db import session_handler
+from app.utils.change_feed import change_feed
+from app.utils.metrics import Gauge, registry
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class ServerStateCache():
+    """
+    Authoritative in-process copy of the server table.
+
+    Reads are served from memory, writes update the cached row and are
+    written behind to the DB: while the writer task runs, writes made in
+    quick succession are collected and written in one transaction.
+    Without the writer every write is written through. Writes that fail to
+    reach the DB stay dirty and are retried. Rows of other tables that
+    must not be written without the state, like hub notifications, can be
+    handed to the same transaction.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        # Held while writing, so an older set of writes can never be
+        # committed after a newer one
+        self._flush_lock = threading.Lock()
+        self._servers: dict[int, Server] = {}
+        self._dirty: dict[int, dict[str, Any]] = {}
+        # Deleted servers, fetch must not load them again while their row
+        # is being deleted
+        self._evicted: set[int] = set()
+        # Other rows to write, and what to call once they are written
+        self._objects: list[tuple[SQLModel, Callable[[], None] | None]] = []
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._wakeup: asyncio.Event | None = None
+
+    def load_all(self, session: Session) -> list[Server]:
+        # Writes still held back would be lost with the old cache
+        self.flush()
+        servers = session.exec(select(Server)).all()
+        with self._lock:
+            self._servers = {s.id: Server.model_validate(s) for s in servers}
+            self._dirty = {}
+            self._evicted = set()
+            return list(self._servers.values())
+
+    def add(self, server: Server) -> Server:
+        cached = Server.model_validate(server)
+        with self._lock:
+            self._servers[cached.id] = cached
+            self._dirty.pop(cached.id, None)
+            self._evicted.discard(cached.id)
+        change_feed.publish(cached.id, cached.state, cached.failure_reason)
+        return cached
+
+    def get(self, server_id: int) -> Server | None:
+        with self._lock:
+            return self._servers.get(server_id)
+
+    async def fetch(self, server_id: int) -> Server | None:
+        """
+        Like get, but also finds rows created outside of the node API in
+        the DB, everything else is loaded at startup or added on creation
+        """
+        cached = self.get(server_id)
+        if cached is not None:
+            return cached
+        async with session_handler.async_session() as session:
+            db_server = await session.get(Server, server_id)
+        with self._lock:
+            if db_server is None or server_id in self._evicted:
+                return None
+            return self._servers.setdefault(server_id,
+                                            Server.model_validate(db_server))
+
+    def get_state(self, server_id: int) -> ServerStateEnum | None:
+        server = self.get(server_id)
+        return server.state if server else None
+
+    def all(self) -> list[Server]:
+        with self._lock:
+            return list(self._servers.values())
+
+    def update(self, server_id: int, **fields) -> Server:
+        server = self.get(server_id)
+        if server is None:
+            raise KeyError(f"Server {server_id} not found")
+        with self._lock:
+            old_state = server.state
+            for key, value in fields.items():
+                setattr(server, key, value)
+            self._dirty.setdefault(server_id, {}).update(fields)
+        if "state" in fields and fields["state"] != old_state:
+            change_feed.publish(server_id, server.state,
+                                server.failure_reason)
+        self.schedule_flush()
+        return server
+
+    def write(self, obj: SQLModel,
+              written: Callable[[], None] | None = None) -> None:
+        """
+        Writes obj with the state writes that are pending now, in the same
+        transaction, and calls written once it was committed
+        """
+        with self._lock:
+            self._objects.append((obj, written))
+        self.schedule_flush()
+
+    def schedule_flush(self) -> None:
+        if self._loop is None:
+            self.flush()
+        else:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def evict(self, server_id: int) -> None:
+        with self._lock:
+            server = self._servers.pop(server_id, None)
+            self._dirty.pop(server_id, None)
+            self._evicted.add(server_id)
+        if server is not None:
+            change_feed.publish(server_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._servers = {}
+            self._dirty = {}
+            self._evicted = set()
+
+    def flush(self) -> bool:
+        """
+        Writes the dirty rows, together with the objects handed to write,
+        in one transaction. What could not be written is kept for the next
+        flush.
+        """
+        with self._flush_lock:
+            with self._lock:
+                dirty, objects = self._dirty, self._objects
+                self._dirty, self._objects = {}, []
+            if not dirty and not objects:
+                return True
+            try:
+                session = next(session_handler.get_session())
+                try:
+                    for server_id, fields in dirty.items():
+                        session.execute(update(Server)
+                                        .where(Server.id == server_id)
+                                        .values(**fields))
+                    session.add_all([obj for obj, _ in objects])
+                    session.commit()
+                    for obj, _ in objects:
+                        session.refresh(obj)
+                finally:
+                    session.close()
+            except Exception:
+                logger.exception("Flushing server state failed, will retry")
+                with self._lock:
+                    # Newer writes win over the ones that failed
+                    for server_id, fields in dirty.items():
+                        if server_id not in self._servers:
+                            continue
+                        merged = {**fields, **self._dirty.get(server_id, {})}
+                        self._dirty[server_id] = merged
+                    self._objects = objects + self._objects
+                return False
+        for _, written in objects:
+            if written is not None:
+                written()
+        return True
+
+    async def run_writer(self, delay: float, retry_interval: float):
+        """
+        Writes dirty rows delay seconds after the first write of a batch,
+        and retries failed writes every retry_interval seconds
+        """
+        self._wakeup = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(),
+                                           retry_interval)
+                except asyncio.TimeoutError:
+                    pass
+                await asyncio.sleep(delay)
+                self._wakeup.clear()
+                await asyncio.to_thread(self.flush)
+        finally:
+            self._loop = None
+            self._wakeup = None
+
+
+state_cache = ServerStateCache()
+
+
+def count_states() -> dict[tuple[str, ...], float]:
+    counts = {(state.value,): 0.0 for state in ServerStateEnum}
+    for server in state_cache.all():
+        counts[(server.state.value,)] += 1
+    return counts
+
+
+registry.register(Gauge("archipelago_servers",
+                        "Servers on this node in each state", ("state",),
+                        count_states))